@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# bed_mesh.py -- Apply bed leveling on the host
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import numpy
+nan = numpy.nan
+
+from command import parse
+from commands import Move
+from commands import AutoBedLevel
+from commands import BedLevelingState
+from mutator import Mutator
+from columns import Columns
+from columns import X, Y, Z, E
+
+# Where AUTO_BED_LEVELING_BILINEAR probes with our Configuration.h:
+# PROBING_MARGIN 5, but the probe (NOZZLE_TO_PROBE_OFFSET -43.5 X)
+# can't get further right than X_MAX_POS - 43.5
+MESH_MIN = (5.0, 5.0)
+MESH_MAX = (201.5, 230.0)
+
+class MeshError(ValueError):
+    pass
+
+class BedMesh:
+    def __init__(self, grid, mesh_min=MESH_MIN, mesh_max=MESH_MAX, fade=0.0):
+        self.grid = numpy.array(grid, dtype=float) # [y][x] like Marlin prints
+        if self.grid.ndim != 2 or min(self.grid.shape) < 2:
+            raise MeshError(f"Need at least a 2x2 mesh: {self.grid.shape}")
+        self.min = numpy.array(mesh_min, dtype=float)
+        self.max = numpy.array(mesh_max, dtype=float)
+        (ny, nx) = self.grid.shape
+        self.spacing = (self.max - self.min) / (nx - 1, ny - 1)
+        self.fade = fade
+
+    @property
+    def lines_x(self):
+        return self.min[X] + numpy.arange(self.grid.shape[1]) * self.spacing[X]
+
+    @property
+    def lines_y(self):
+        return self.min[Y] + numpy.arange(self.grid.shape[0]) * self.spacing[Y]
+
+    @classmethod
+    def from_text(cls, lines, *args, **kwargs):
+        # Captured M420 V or G29 output, possibly with OctoPrint's Recv:
+        columns = None
+        rows = dict()
+        for line in lines:
+            for prefix in ('Recv:', 'echo:'):
+                if line.startswith(prefix):
+                    line = line[len(prefix):]
+            words = line.split()
+            if len(words) == 0:
+                continue
+            try:
+                header = [int(w) for w in words]
+            except ValueError:
+                pass
+            else:
+                if header == list(range(len(header))):
+                    columns = len(header)
+                    rows = dict()
+                continue
+            if columns is None or len(words) != columns + 1:
+                continue
+            try:
+                row = int(words[0])
+                values = [float(w) for w in words[1:]]
+            except ValueError:
+                continue
+            rows[row] = values
+        if len(rows) == 0:
+            raise MeshError("No bilinear leveling grid found")
+        grid = [rows[y] for y in sorted(rows)]
+        return cls(grid, *args, **kwargs)
+
+    @classmethod
+    def from_file(cls, file_name, *args, **kwargs):
+        INFO(f"Reading mesh from {file_name}")
+        with open(file_name, 'r') as fh:
+            return cls.from_text(fh, *args, **kwargs)
+
+    def correction(self, x, y, z=None):
+        (ny, nx) = self.grid.shape
+        gx = (numpy.clip(x, self.min[X], self.max[X]) - self.min[X])
+        gx /= self.spacing[X]
+        gy = (numpy.clip(y, self.min[Y], self.max[Y]) - self.min[Y])
+        gy /= self.spacing[Y]
+        ix = numpy.minimum(numpy.floor(gx).astype(int), nx - 2)
+        iy = numpy.minimum(numpy.floor(gy).astype(int), ny - 2)
+        tx = gx - ix
+        ty = gy - iy
+        g = self.grid
+        dz = (
+            g[iy, ix] * (1 - tx) * (1 - ty)
+            + g[iy, ix + 1] * tx * (1 - ty)
+            + g[iy + 1, ix] * (1 - tx) * ty
+            + g[iy + 1, ix + 1] * tx * ty
+            )
+        if z is not None and self.fade > 0.0:
+            dz *= numpy.clip(1.0 - z / self.fade, 0.0, 1.0)
+        return dz
+
+    def crossings(self, start, delta):
+        # Fraction of the way along each move where it crosses a grid line,
+        # sorted, nan where it doesn't, always ending the move at 1.0
+        lines_x = self.lines_x
+        lines_y = self.lines_y
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            tx = (lines_x[None, :] - start[:, X, None]) / delta[:, X, None]
+            ty = (lines_y[None, :] - start[:, Y, None]) / delta[:, Y, None]
+        t = numpy.concatenate(
+            (tx, ty, numpy.ones((len(start), 1))),
+            axis=1,
+            )
+        t[~((t > 0.0) & (t < 1.0))] = nan
+        t[:, -1] = 1.0
+        t = numpy.sort(t, axis=1) # nans sort last
+        t[:, 1:][numpy.diff(t, axis=1) == 0.0] = nan # crossing a corner
+        return numpy.sort(t, axis=1)
+
+class BedMeshCompensation(Mutator):
+    def __init__(self, script, mesh):
+        self.mesh = mesh
+        super().__init__(script)
+
+    def plan(self):
+        columns = Columns(self.original)
+        known = (
+            columns.is_move
+            & ~numpy.isnan(columns.before[:, :Z+1]).any(axis=1)
+            & ~numpy.isnan(columns.after[:, :Z+1]).any(axis=1)
+            )
+        moves = numpy.flatnonzero(known)
+        start = columns.before[moves]
+        delta = columns.delta[moves]
+        t = self.mesh.crossings(start, delta)
+        valid = ~numpy.isnan(t)
+        row, col = numpy.nonzero(valid)
+        points = start[row] + delta[row] * t[row, col, None]
+        points[:, Z] += self.mesh.correction(
+            points[:, X],
+            points[:, Y],
+            points[:, Z],
+            )
+        counts = valid.sum(axis=1)
+        ends = numpy.cumsum(counts)
+        self.segments = dict()
+        for mi, ci in enumerate(moves):
+            self.segments[ci] = points[ends[mi]-counts[mi]:ends[mi]]
+        INFO(f"{len(points) - len(moves)} extra moves for the bed mesh")
+
+    def process(self):
+        self.plan()
+        super().process()
+
+    def disable_firmware(self, ci, old):
+        self.replace(ci, old, [
+            parse("M420 S0 ; bed mesh applied by bed_mesh.py")
+            ])
+
+    def compensate(self, ci, old):
+        points = self.segments[ci]
+        for si in range(len(points)):
+            position = list(points[si])
+            if si == len(points) - 1:
+                position[E] = old.after.e.position
+            elif numpy.isnan(position[E]):
+                position[E] = None
+            if si == 0:
+                if hasattr(old, 'F'):
+                    feedrate = old.F / 60.0
+                else:
+                    feedrate = None
+                comment = old.comment
+            else:
+                feedrate = None
+                comment = None
+            self.replace(ci, old, [
+                Move.to(self.state, position, feedrate, comment)
+                ])
+
+    def process_command(self, ci, old):
+        if ci == 0 and not (
+            isinstance(old, AutoBedLevel)
+            or (isinstance(old, BedLevelingState) and hasattr(old, 'S'))
+            ):
+            # Those turn it off themselves or get an M420 S0 of their own
+            self.disable_firmware(ci, old)
+        if isinstance(old, AutoBedLevel):
+            self.keep(ci, old)
+            return self.disable_firmware(ci, old)
+        if isinstance(old, BedLevelingState):
+            if getattr(old, 'S', 0.0) != 0.0:
+                return self.disable_firmware(ci, old)
+            return self.keep(ci, old)
+        if ci in self.segments:
+            return self.compensate(ci, old)
+        return self.keep(ci, old)
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+# calibrate.py -- Fit the time estimate to how long a print really took
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./streamer.py /dev/ttyUSB0 input.gcode --log print.log
+Then: ./calibrate.py input.gcode print.log [--save calibration.json]
+Or: ./calibrate.py --check, to see that made up logs are read right
+Also reads OctoPrint's serial.log. Every ok has a time, and every ok is
+for a line of input.gcode, so each stretch between oks can be compared
+with what the analysis says it should take. Then ./scheduler.py
+--calibration calibration.json uses the fitted factors.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import json
+from datetime import datetime
+
+import numpy
+
+from script import Script
+from columns import Columns
+from planner import Planner
+from thermal import HEATERS
+from thermal import ThermalSimulation
+from thermal import load_heaters
+from commands import Home
+from streamer import strip
+from streamer import with_checksum
+from machine_state import MachineState
+from marlin import BLOCK_BUFFER_SIZE
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+# Seconds for each command split up by where they come from:
+# move: what Script.analyze() says, distance over feedrate, and dwells
+# accel: more for speeding up and slowing down, if every move stopped
+# junction: less for not stopping between moves (negative)
+# heater: waiting for M109/M190, from thermal.py
+# command: 1 for every line sent, for the time it takes to get it there
+FEATURES = ('move', 'accel', 'junction', 'heater', 'command')
+# What the estimate is without any calibration
+DEFAULT_FACTORS = {
+    'move': 1.0,
+    'accel': 0.0,
+    'junction': 0.0,
+    'heater': 1.0,
+    'command': 0.0,
+    }
+# Lines after the last one matched to look for the next, past whatever the
+# host sent that wasn't in the file (M105, M110...)
+MATCH_WINDOW = 16
+# Fewer layers than this for each factor and it's fitted to each ok instead
+LAYERS_PER_FACTOR = 2
+
+def trapezoid_time(length, nominal, accel, entry, exit):
+    # Like planner.Block.plan(), for arrays of them
+    accel_distance = (nominal**2 - entry**2) / (2.0 * accel)
+    decel_distance = (nominal**2 - exit**2) / (2.0 * accel)
+    short = accel_distance + decel_distance > length
+    peak = numpy.clip(
+        (2.0 * accel * length + exit**2 - entry**2) / (4.0 * accel),
+        0.0,
+        length,
+        )
+    accel_distance = numpy.where(short, peak, accel_distance)
+    decel_distance = numpy.where(short, length - peak, decel_distance)
+    cruise = numpy.where(
+        short,
+        numpy.sqrt(entry**2 + 2.0 * accel * peak),
+        nominal,
+        )
+    return (
+        (cruise - entry) / accel
+        + (length - accel_distance - decel_distance) / cruise
+        + (cruise - exit) / accel
+        )
+
+def features(commands, heaters=HEATERS, simulation=None, planner=None):
+    # One row for each command, one column for each of FEATURES
+    n = len(commands)
+    x = numpy.zeros((n, len(FEATURES)))
+    columns = Columns(commands)
+    start = commands[0].before.time if n > 0 else None
+    x[:, 0] = numpy.nan_to_num(numpy.diff(
+        columns.time,
+        prepend=0.0 if start is None else start,
+        ))
+    if planner is None:
+        planner = Planner(commands)
+    if len(planner.blocks) > 0:
+        index = {id(command): ci for ci, command in enumerate(commands)}
+        blocks = planner.blocks
+        cis = numpy.array([index[id(block.command)] for block in blocks])
+        length = numpy.array([block.length for block in blocks])
+        nominal = numpy.array([block.nominal for block in blocks])
+        accel = numpy.array([block.accel for block in blocks])
+        safe = numpy.array([block.safe_speed for block in blocks])
+        planned = numpy.array([block.time for block in blocks])
+        stopping = trapezoid_time(length, nominal, accel, safe, safe)
+        x[cis, 1] = stopping - length / nominal
+        x[cis, 2] = planned - stopping
+    if simulation is None:
+        simulation = ThermalSimulation(commands, heaters)
+    x[:, 3] = simulation.wait
+    x[:, 4] = [len(strip(command.g_code)) > 0 for command in commands]
+    return x
+
+class Calibration:
+    def __init__(self, factors=None):
+        self.factors = dict(DEFAULT_FACTORS)
+        if factors is not None:
+            self.factors.update(factors)
+
+    @property
+    def coefficients(self):
+        return numpy.array([self.factors[f] for f in FEATURES])
+
+    def predict(self, x):
+        # Seconds for each row of features()
+        return x @ self.coefficients
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, 'r') as fh:
+            return cls(json.load(fh))
+
+    def save(self, file_name):
+        with open(file_name, 'w') as fh:
+            json.dump(self.factors, fh, indent=4)
+
+def parse_line(line):
+    # (time, '>' or '<', text) from streamer.py --log:
+    # "1602345600.123 > N5 G1 X10*34"
+    # or OctoPrint's serial.log:
+    # "2020-10-10 12:00:00,123 - Send: N5 G1 X10*34"
+    for marker, direction in ((' - Send: ', '>'), (' - Recv: ', '<')):
+        if marker in line:
+            (stamp, text) = line.split(marker, 1)
+            try:
+                when = datetime.strptime(stamp.strip(), '%Y-%m-%d %H:%M:%S,%f')
+            except ValueError:
+                return None
+            return (when.timestamp(), direction, text.strip())
+    words = line.split(None, 2)
+    if len(words) < 2 or words[1] not in ('<', '>'):
+        return None
+    try:
+        when = float(words[0])
+    except ValueError:
+        return None
+    return (when, words[1], words[2].strip() if len(words) > 2 else '')
+
+def sent_line(text):
+    # "N5 G1 X10*34" -> (5, "G1 X10"), (None, text) without a number
+    if text.startswith('N') and '*' in text:
+        (number, _, rest) = text.partition(' ')
+        try:
+            return (int(number[1:]), rest.rpartition('*')[0].strip())
+        except ValueError:
+            pass
+    return (None, text)
+
+def read_log(lines):
+    # (lines the printer took in the order it took them, when each one was
+    # ok'd)
+    taken = [] # in the order they went out
+    slots = dict() # (M110s so far, N): where in taken, resends replace it
+    epoch = 0
+    received = []
+    when_received = []
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+        (when, direction, text) = parsed
+        if direction == '<':
+            received.append(text)
+            when_received.append(when)
+            continue
+        (n, body) = sent_line(text)
+        if body.startswith('M110'):
+            # Line numbers start again
+            epoch += 1
+        if n is None:
+            taken.append(body)
+        elif (epoch, n) in slots:
+            taken[slots[(epoch, n)]] = body
+        else:
+            slots[(epoch, n)] = len(taken)
+            taken.append(body)
+    received = numpy.array(received, dtype=object)
+    when_received = numpy.array(when_received)
+    is_ok = numpy.array([text.startswith('ok') for text in received], dtype=bool)
+    # The ok after a Resend:, or after a bit of a line Marlin flushed,
+    # isn't for a line
+    flush = numpy.array([
+        text.lower().startswith(('resend:', 'rs:', 'echo:unknown command'))
+        for text in received
+        ], dtype=bool)
+    after_flush = numpy.concatenate(([False], flush[:-1]))
+    oks = when_received[is_ok & ~after_flush]
+    if len(oks) != len(taken):
+        WARNING(f"{len(taken)} lines sent but {len(oks)} oks, using the first")
+    count = min(len(oks), len(taken))
+    return (taken[:count], oks[:count])
+
+def check_read_log():
+    # Logs read_log() has got wrong before, and what it should say.
+    # OctoPrint's connect handshake sends M115 before any line numbers.
+    handshake = (
+        ('>', 'M115'),
+        ('<', 'FIRMWARE_NAME:Marlin'),
+        ('<', 'ok'),
+        ('>', with_checksum('M110 N0', 0)),
+        ('<', 'ok'),
+        ('>', with_checksum('G28', 1)),
+        ('>', with_checksum('G1 X10', 2)),
+        ('<', 'ok'),
+        ('<', 'ok'),
+        )
+    # N2 gets mangled, N3 is already on its way and gets thrown out too
+    resend = (
+        ('>', with_checksum('M110 N0', 0)),
+        ('<', 'ok'),
+        ('>', with_checksum('G28', 1)),
+        ('>', 'M105'),
+        ('>', with_checksum('G1 X10', 2)),
+        ('>', with_checksum('G1 X20', 3)),
+        ('<', 'ok'),
+        ('<', 'ok T:20.0 /0.0 B:20.0 /0.0'),
+        ('<', 'Error:checksum mismatch, Last Line: 1'),
+        ('<', 'Resend: 2'),
+        ('<', 'ok'),
+        ('<', 'echo:Unknown command: "X20*99"'),
+        ('<', 'ok'),
+        ('>', with_checksum('G1 X10', 2)),
+        ('>', with_checksum('G1 X20', 3)),
+        ('<', 'ok'),
+        ('<', 'ok'),
+        )
+    failed = 0
+    for name, log, expected in (
+        ('handshake', handshake, ['M115', 'M110 N0', 'G28', 'G1 X10']),
+        ('resend', resend, ['M110 N0', 'G28', 'M105', 'G1 X10', 'G1 X20']),
+        ):
+        lines = [f"{t:0.3f} {d} {text}" for t, (d, text) in enumerate(log)]
+        (taken, oks) = read_log(lines)
+        oked = [t for t, (d, text) in enumerate(log) if text.startswith('ok')]
+        oked = [t for t in oked if not log[t-1][1].startswith(('Resend:', 'echo:'))]
+        if taken != expected or list(oks) != oked[:len(taken)]:
+            ERROR(f"read_log() {name}: {list(zip(taken, oks))}")
+            failed += 1
+        else:
+            INFO(f"read_log() {name}: OK")
+    return failed == 0
+
+def align(commands, taken, oks):
+    # When each command was ok'd, nan for ones that weren't sent or that
+    # couldn't be matched up
+    expected = [
+        (strip(command.g_code), ci)
+        for ci, command in enumerate(commands)
+        if len(strip(command.g_code)) > 0
+        ]
+    done = numpy.full(len(commands), numpy.nan)
+    p = 0
+    skipped = 0
+    for (text, when) in zip(taken, oks):
+        squashed = text.replace(' ', '')
+        for j in range(p, min(p + MATCH_WINDOW, len(expected))):
+            (line, ci) = expected[j]
+            if line == text or line.replace(' ', '') == squashed:
+                done[ci] = when
+                p = j + 1
+                break
+        else:
+            skipped += 1
+    INFO(
+        f"Matched {numpy.count_nonzero(~numpy.isnan(done))} of"
+        f" {len(expected)} lines, {skipped} sent lines weren't in the file"
+        )
+    return done
+
+def finished(commands, done, planner, lag):
+    # Marlin says ok for a move as soon as it's in the planner, not when
+    # it's done. Once the planner's full, that's when the move lag moves
+    # before it finished. Anything that waits (M109, G4, G28...) lets the
+    # planner run dry first, so the last lag moves before it finish
+    # sometime before its ok, and the ones at the end sometime after the
+    # log stops. Those and everything that doesn't take time are nan, and
+    # get counted with the next one that isn't.
+    finish = numpy.full(len(commands), numpy.nan)
+    planned = {id(block.command) for block in planner.blocks}
+    moves = []
+    for ci, command in enumerate(commands):
+        if id(command) in planned:
+            moves.append(ci)
+        elif getattr(command, 'waits', False) or isinstance(command, Home):
+            finish[ci] = done[ci]
+            moves = []
+        else:
+            continue
+        if len(moves) > lag:
+            finish[moves[-1 - lag]] = done[ci]
+    return finish
+
+class Replay:
+    def __init__(
+        self,
+        script,
+        log_lines,
+        heaters=HEATERS,
+        calibration=None,
+        lag=BLOCK_BUFFER_SIZE - 1,
+        ):
+        commands = script.commands
+        self.commands = commands
+        self.calibration = calibration or Calibration()
+        planner = Planner(commands)
+        self.x = features(commands, heaters, planner=planner)
+        (taken, oks) = read_log(log_lines)
+        done = finished(commands, align(commands, taken, oks), planner, lag)
+        # Everything between one ok and the next is what the second one
+        # took, so compare sums over those stretches
+        self.cis = numpy.flatnonzero(~numpy.isnan(done))
+        if len(self.cis) < 2:
+            raise ValueError("Not enough of the log matches the gcode")
+        running = numpy.concatenate((
+            numpy.zeros((1, len(FEATURES))),
+            numpy.cumsum(self.x, axis=0),
+            ))
+        ends = self.cis[1:] + 1
+        starts = self.cis[:-1] + 1
+        self.stretch_x = running[ends] - running[starts]
+        self.actual = numpy.diff(done[self.cis])
+        columns = Columns(commands)
+        self.layer = columns.layer[self.cis[1:]]
+        self.layer_z = columns.layer_z
+        self.codes = numpy.array(
+            [commands[ci].g_code.split(None, 1)[0] for ci in self.cis[1:]],
+            dtype=object,
+            )
+
+    def by_layer(self, values):
+        # Sums for each layer, layer -1 is everything before the first one
+        layers = self.layer + 1
+        if values.ndim == 1:
+            return numpy.bincount(layers, weights=values)
+        return numpy.stack(
+            [numpy.bincount(layers, weights=column) for column in values.T],
+            axis=1,
+            )
+
+    def fit(self):
+        # Least squares on layer times, or on each stretch if there aren't
+        # enough layers. Factors for things that never happen stay as
+        # they are.
+        x = self.by_layer(self.stretch_x)
+        y = self.by_layer(self.actual)
+        if len(y) < LAYERS_PER_FACTOR * len(FEATURES):
+            (x, y) = (self.stretch_x, self.actual)
+        used = numpy.any(x != 0.0, axis=0)
+        fixed = self.calibration.coefficients
+        rest = y - x[:, ~used] @ fixed[~used]
+        (fitted, *_) = numpy.linalg.lstsq(x[:, used], rest, rcond=None)
+        factors = dict(self.calibration.factors)
+        for f, value in zip(numpy.array(FEATURES)[used], fitted):
+            factors[f] = float(value)
+            if value < 0.0 and f != 'junction':
+                WARNING(f"{f} came out negative, the log may not fit the gcode")
+        return Calibration(factors)
+
+    def report(self, fitted, all_layers=False):
+        predicted = self.calibration.predict(self.stretch_x)
+        corrected = fitted.predict(self.stretch_x)
+        lines = []
+        actual = self.actual.sum()
+        for name, total in (
+            ("Predicted", predicted.sum()),
+            ("Fitted", corrected.sum()),
+            ):
+            lines.append(
+                f"{name}: {total:0.1f} s, actual {actual:0.1f} s,"
+                f" {(total - actual) / actual:+0.1%}"
+                )
+        lines.append(' '.join(
+            f"{f} {fitted.factors[f]:0.4g}" for f in FEATURES
+            ))
+        lines.append(f"{'code':>6} {'count':>7} {'actual':>9} {'predicted':>9} {'fitted':>9}")
+        (codes, which) = numpy.unique(self.codes.astype(str), return_inverse=True)
+        count = numpy.bincount(which)
+        sums = [
+            numpy.bincount(which, weights=values)
+            for values in (self.actual, predicted, corrected)
+            ]
+        for i in numpy.argsort(-sums[0]):
+            lines.append(
+                f"{codes[i]:>6} {count[i]:>7} {sums[0][i]:>9.1f}"
+                f" {sums[1][i]:>9.1f} {sums[2][i]:>9.1f}"
+                )
+        lines.append(f"{'layer':>6} {'z':>7} {'actual':>9} {'predicted':>9} {'fitted':>9}")
+        layer_sums = [
+            self.by_layer(values) for values in (self.actual, predicted, corrected)
+            ]
+        error = numpy.abs(layer_sums[1] - layer_sums[0])
+        shown = numpy.arange(len(layer_sums[0]))
+        if not all_layers:
+            shown = numpy.sort(numpy.argsort(-error)[:10])
+        for i in shown:
+            here = self.layer == i - 1
+            z = self.layer_z[self.cis[1:][here]]
+            z = z[~numpy.isnan(z)]
+            lines.append(
+                f"{i - 1:>6} {z[0] if len(z) > 0 else numpy.nan:>7.2f}"
+                f" {layer_sums[0][i]:>9.1f} {layer_sums[1][i]:>9.1f}"
+                f" {layer_sums[2][i]:>9.1f}"
+                )
+        return "\n".join(lines)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Fit the print time estimate to a log of a real print'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        nargs='?',
+        help="The gcode that was printed",
+        )
+    arguments.add_argument(
+        'log',
+        metavar='print.log',
+        type=str,
+        nargs='?',
+        help="streamer.py --log or OctoPrint's serial.log",
+        )
+    arguments.add_argument(
+        '--check',
+        action='store_true',
+        help="Check reading logs against some made up ones, and exit",
+        )
+    arguments.add_argument(
+        '--calibration',
+        type=str,
+        metavar='calibration.json',
+        help="Compare against these factors instead of none",
+        )
+    arguments.add_argument(
+        '--save',
+        type=str,
+        metavar='calibration.json',
+        help="Save the fitted factors",
+        )
+    arguments.add_argument(
+        '--heaters',
+        type=str,
+        metavar='heaters.json',
+        help="Heater constants from thermal.py --fit (default: built in)",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--all-layers',
+        action='store_true',
+        help="Show every layer, not just the ten furthest off",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.check:
+        sys.exit(0 if check_read_log() else 1)
+    if args.input is None or args.log is None:
+        arguments.error("input.gcode and print.log are needed")
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    heaters = HEATERS
+    if args.heaters is not None:
+        heaters = load_heaters(args.heaters)
+    lag = profile.block_buffer_size - 1
+    calibration = None
+    if args.calibration is not None:
+        calibration = Calibration.load(args.calibration)
+    script = Script.from_file(args.input)
+    script.analyze()
+    with open(args.log, 'r') as fh:
+        replay = Replay(script, fh, heaters, calibration, lag)
+    fitted = replay.fit()
+    print(replay.report(fitted, args.all_layers))
+    if args.save is not None:
+        fitted.save(args.save)
+
+if __name__ == '__main__':
+    main()
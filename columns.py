@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+# columns.py -- Analyzed G-code script as numpy arrays
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+from array import array
+from math import hypot
+from math import isnan
+
+import numpy
+
+from command import load_codes
+import command
+from commands import Move
+from commands import SetOffset
+from commands import Absolute
+from commands import Relative
+from commands import AbsoluteE
+from commands import RelativeE
+from commands import Home
+from commands import Park
+from commands import SetHeadTemp
+from commands import SetBedTemp
+from commands import SetFeedrateMult
+from commands import SetFlowMult
+from commands import SetAxisFeedrateLimit
+from commands import SetStepsPerUnit
+from commands import Dwell
+from machine_state import MachineState
+
+X = 0
+Y = 1
+Z = 2
+E = 3
+
+ROW = 18
+
+def state_row(state):
+    return (
+        state.x.position,
+        state.y.position,
+        state.z.position,
+        state.e.position,
+        state.feedrate,
+        state.feedrate_mult,
+        state.flowrate_mult,
+        state.x.speed_limit,
+        state.y.speed_limit,
+        state.z.speed_limit,
+        state.e.speed_limit,
+        state.time,
+        state.x.steps_per_unit,
+        state.y.steps_per_unit,
+        state.z.steps_per_unit,
+        state.e.steps_per_unit,
+        state.head_temp,
+        state.bed_temp,
+        )
+
+# What scan() has to know about, anything else leaves the row alone
+SCANNED = (
+    Move,
+    SetOffset,
+    Absolute,
+    Relative,
+    AbsoluteE,
+    RelativeE,
+    Home,
+    Park,
+    SetHeadTemp,
+    SetBedTemp,
+    SetFeedrateMult,
+    SetFlowMult,
+    SetAxisFeedrateLimit,
+    SetStepsPerUnit,
+    Dwell,
+    )
+
+def scan(lines, unknown=None, malformed=None):
+    # (line number, is it a Move, state_row() after it) for each line, like
+    # parsing and analyzing but only for what goes in the columns, and
+    # without making any Commands. The row is the same list every time,
+    # so copy it to keep it. Codes command.py doesn't know are like NoOp,
+    # with their line numbers in unknown. So are ones with a word that
+    # needs a number and hasn't got one, like G92 E, in malformed.
+    load_codes()
+    kinds = dict()
+    for code, c in command.codes.items():
+        kinds[code] = None
+        for kind in SCANNED:
+            if issubclass(c, kind):
+                kinds[code] = kind
+                break
+    # What the first word means, mostly G1, looked up once each
+    first_words = dict()
+    state = MachineState()
+    row = [numpy.nan if v is None else float(v) for v in state_row(state)]
+    offset = [axis.offset for axis in state.axes]
+    relative = [axis.relative for axis in state.axes]
+    for ln, line in enumerate(lines, 1):
+        words = line.split(';', 1)[0].split()
+        if len(words) == 0:
+            yield (ln, False, row)
+            continue
+        first = words[0]
+        try:
+            if first in first_words:
+                kind = first_words[first]
+            elif first[0] in 'GM':
+                code = f"{first[0]}{float(first[1:])}".replace('.0', '')
+                kind = first_words[first] = kinds[code]
+            else:
+                raise KeyError(first)
+            if kind is not None:
+                args = {
+                    w[0]: float(w[1:]) if len(w) > 1 else ''
+                    for w in words[1:]
+                    }
+        except (KeyError, ValueError):
+            if unknown is not None:
+                unknown.append(ln)
+            yield (ln, False, row)
+            continue
+        if kind is None:
+            yield (ln, False, row)
+            continue
+        if kind is not Home and '' in args.values():
+            # Only G28 has words that mean something on their own
+            if malformed is not None:
+                malformed.append(ln)
+            yield (ln, False, row)
+            continue
+        if kind is Move:
+            if 'F' in args:
+                row[4] = args['F'] / 60.0 # mm/s not mm/m as in gcode!
+            (x, y, z, e) = row[0:4]
+            for ai, letter in enumerate('XYZE'):
+                if letter in args:
+                    if relative[ai]:
+                        row[ai] += args[letter]
+                    else:
+                        row[ai] = offset[ai] + args[letter]
+            feedrate = row[4]
+            if not isnan(feedrate):
+                dist = hypot(row[0] - x, row[1] - y, row[2] - z)
+                if dist > 0.0:
+                    row[11] += dist / feedrate
+                elif not isnan(row[3] - e):
+                    row[11] += abs(row[3] - e) / feedrate
+            yield (ln, True, row)
+            continue
+        if kind is SetOffset:
+            for ai, letter in enumerate('XYZE'):
+                if letter in args:
+                    if isnan(row[ai]) and letter == 'E':
+                        # Like Axis.set_offset(), no home for E
+                        row[ai] = args[letter]
+                        offset[ai] = 0.0
+                    elif isnan(row[ai]):
+                        offset[ai] = 0.0 - args[letter]
+                    else:
+                        offset[ai] = row[ai] - args[letter]
+        elif kind is Absolute or kind is Relative:
+            relative = [kind is Relative] * 4
+        elif kind is AbsoluteE or kind is RelativeE:
+            relative[3] = kind is RelativeE
+        elif kind is Home:
+            row[0:3] = (0.0, 0.0, 0.0)
+        elif kind is Park:
+            row[0:3] = (numpy.nan, numpy.nan, numpy.nan)
+        elif kind is SetHeadTemp or kind is SetBedTemp:
+            target = args.get('S', args.get('R'))
+            if target is not None:
+                row[16 if kind is SetHeadTemp else 17] = target
+        elif kind is SetFeedrateMult and 'S' in args:
+            row[5] = args['S'] / 100
+        elif kind is SetFlowMult and 'S' in args:
+            row[6] = args['S'] / 100
+        elif kind is SetAxisFeedrateLimit or kind is SetStepsPerUnit:
+            first = 7 if kind is SetAxisFeedrateLimit else 12
+            for ai, letter in enumerate('XYZE'):
+                if letter in args:
+                    row[first + ai] = args[letter]
+        elif kind is Dwell:
+            if 'P' in args:
+                row[11] += args['P'] / 1000.0
+            elif 'S' in args:
+                row[11] += args['S']
+        yield (ln, False, row)
+
+# One row per command, positions that aren't known yet are nan
+class Columns:
+    def __init__(self, commands):
+        self.commands = commands
+        DEBUG(f"Columns for {len(commands)} commands")
+        # Each command's before is the one before it's after, when they've
+        # been analyzed in order, so only look at each state once
+        if len(commands) > 0 and all(
+            commands[ci].before is commands[ci-1].after
+            for ci in range(1, len(commands))
+            ):
+            states = [commands[0].before] + [c.after for c in commands]
+            rows = numpy.array(list(map(state_row, states)), dtype=float)
+            before = rows[:-1]
+            after = rows[1:]
+        else:
+            before = numpy.array(
+                [state_row(c.before) for c in commands],
+                dtype=float,
+                ).reshape((-1, ROW))
+            after = numpy.array(
+                [state_row(c.after) for c in commands],
+                dtype=float,
+                ).reshape((-1, ROW))
+        is_move = numpy.array(
+            [isinstance(c, Move) for c in commands],
+            dtype=bool,
+            )
+        self.set_rows(before, after, is_move)
+
+    @classmethod
+    def from_lines(cls, lines, unknown=None, malformed=None):
+        # The same columns straight from the gcode with scan(), for files
+        # too big to keep analyzed Commands for. commands is None.
+        new = cls.__new__(cls)
+        new.commands = None
+        rows = array('d')
+        is_move = bytearray()
+        for (ln, move, row) in scan(lines, unknown, malformed):
+            rows.extend(row)
+            is_move.append(move)
+        after = numpy.frombuffer(rows, dtype=float).reshape((-1, ROW))
+        start = [numpy.nan if v is None else v for v in state_row(MachineState())]
+        before = numpy.concatenate(([start], after))[:-1]
+        # A Move's F is its before's feedrate too
+        before[:, 4] = after[:, 4]
+        DEBUG(f"Columns for {len(after)} lines")
+        new.set_rows(before, after, numpy.frombuffer(is_move, dtype=bool))
+        return new
+
+    def set_rows(self, before, after, is_move):
+        self.before = before[:, 0:4]
+        self.after = after[:, 0:4]
+        self.feedrate = before[:, 4] # mm/s
+        self.feedrate_mult = before[:, 5]
+        self.flowrate_mult = before[:, 6]
+        self.speed_limit = before[:, 7:11] # mm/s from M203
+        self.time = after[:, 11]
+        self.steps_per_unit = before[:, 12:16] # from M92
+        self.head_temp = before[:, 16] # targets, not what it's at
+        self.bed_temp = before[:, 17]
+        self.is_move = is_move
+
+    def __len__(self):
+        return len(self.is_move)
+
+    @property
+    def delta(self):
+        return self.after - self.before
+
+    def axis_speed(self, max_feedrate, dist=None):
+        # The fastest each move can go with every axis under its M203
+        # limit, or max_feedrate before there is one. nan if nothing moves.
+        if dist is None:
+            dist = self.dist_xyz
+        delta = self.delta
+        limits = numpy.where(
+            numpy.isnan(self.speed_limit),
+            numpy.array(max_feedrate, dtype=float),
+            self.speed_limit,
+            )
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Like nanmin, without warning about moves where no axis moves
+            speed = limits * dist[:, None] / numpy.abs(delta)
+            speed = numpy.where(
+                (delta != 0.0) & ~numpy.isnan(speed),
+                speed,
+                numpy.inf,
+                ).min(axis=1)
+        speed[numpy.isinf(speed)] = numpy.nan
+        return speed
+
+    @property
+    def dist_xy(self):
+        return numpy.hypot(self.delta[:, X], self.delta[:, Y])
+
+    @property
+    def dist_xyz(self):
+        return numpy.linalg.norm(self.delta[:, :E], axis=1)
+
+    @property
+    def printing(self):
+        delta = self.delta
+        return self.is_move & (delta[:, E] > 0.0) & (self.dist_xy > 0.0)
+
+    @property
+    def layer(self):
+        # Counts up every time something gets printed higher than before,
+        # -1 until the first thing is printed
+        z = numpy.where(self.printing, self.after[:, Z], numpy.nan)
+        top = numpy.nan_to_num(numpy.fmax.accumulate(z), nan=-numpy.inf)
+        # Compared, not subtracted, since -inf - -inf is nan
+        higher = top > numpy.concatenate(([-numpy.inf], top[:-1]))
+        return numpy.cumsum(higher) - 1
+
+    @property
+    def layer_z(self):
+        z = numpy.where(self.printing, self.after[:, Z], numpy.nan)
+        return numpy.fmax.accumulate(z)
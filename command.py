@@ -24,6 +24,8 @@ WARNING = logger.warning
 ERROR = logger.error
 CRITICAL = logger.critical
 
+from math import hypot
+
 import numpy as np
 
 from machine_state import MachineState
@@ -63,28 +65,40 @@ class Command:
                 )
             }
     
+    # These use hypot instead of numpy since they're called for every move
     @property
     def head_dist(self):
+        before = self.before
+        after = self.after
         if (
-            self.after.pos_vec_xyz is None
-            or self.before.pos_vec_xyz is None
+            after.x.position is None
+            or after.y.position is None
+            or after.z.position is None
+            or before.x.position is None
+            or before.y.position is None
+            or before.z.position is None
             ):
             return None
-        return np.linalg.norm(
-            self.after.pos_vec_xyz
-            - self.before.pos_vec_xyz
+        return hypot(
+            after.x.position - before.x.position,
+            after.y.position - before.y.position,
+            after.z.position - before.z.position,
             )
     
     @property
     def head_dist_xy(self):
+        before = self.before
+        after = self.after
         if (
-            self.after.pos_vec_xy is None
-            or self.before.pos_vec_xy is None
+            after.x.position is None
+            or after.y.position is None
+            or before.x.position is None
+            or before.y.position is None
             ):
             return None
-        return np.linalg.norm(
-            self.after.pos_vec_xy
-            - self.before.pos_vec_xy
+        return hypot(
+            after.x.position - before.x.position,
+            after.y.position - before.y.position,
             )
 
     @property
@@ -113,8 +127,8 @@ class Command:
 
     @property
     def moves_head(self):
-        before = self.before.positions
-        after = self.after.positions
+        before = self.before.position
+        after = self.after.position
         dist_sq = 0.0
         for ai in range(3):
             if before[ai] == after[ai]:
@@ -159,6 +173,9 @@ def parse_arg(arg):
         v = float(v)
     return (l, v)
 
+# The rest of the line is a string, not arguments
+TEXT_CODES = {'M117', 'M118'}
+
 codes = None
 
 def load_codes():
@@ -185,7 +202,10 @@ def _parse(g_code):
     else:
         args = g_code
         comment = None
-    args = {a[0]: a[1] for a in map(parse_arg, args.split())}
+    words = args.split()
+    if len(words) > 0 and words[0] in TEXT_CODES:
+        words = words[:1]
+    args = {a[0]: a[1] for a in map(parse_arg, words)}
     if len(args) == 0:
         r = NoOp(g_code, args, comment)
         assert r is not None
@@ -199,6 +219,20 @@ def _parse(g_code):
         raise ParseError(f"Unknown command: {g_code}")
     return r
 
+def format_arg(letter, value):
+    if value == '':
+        return letter
+    text = f"{value:0.5f}".rstrip('0').rstrip('.')
+    if text == '-0':
+        text = '0'
+    return f"{letter}{text}"
+
+def unparse(args, comment=None):
+    g_code = ' '.join(format_arg(k, v) for k, v in args.items())
+    if comment is not None:
+        g_code = f"{g_code} ;{comment}"
+    return g_code
+
 def parse(g_code):
     try:
         r = _parse(g_code)
@@ -27,6 +27,8 @@ CRITICAL = logger.critical
 from machine_state import MachineState
 from command import Control
 from command import NoOp
+from command import parse
+from command import unparse
 
 # These are in the order I added them
 
@@ -39,25 +41,28 @@ class Move(Control):
                 self.after.feedrate = value/60.0 # mm/s not mm/m as in gcode!
             else:
                 getattr(self.after, axis.lower()).move(value)
+        head_dist = self.head_dist
+        head_dist_e = self.head_dist_e
         if self.before.feedrate is not None:
-            if self.head_dist > 0:
+            if head_dist is not None and head_dist > 0:
                 self.after.time = (
                     self.before.time 
-                    + (self.head_dist / self.before.feedrate)
+                    + (head_dist / self.before.feedrate)
                     )
-            else:
+            elif head_dist_e is not None:
                 self.after.time = (
                     self.before.time 
-                    + (self.head_dist_e / self.before.feedrate)
+                    + (abs(head_dist_e) / self.before.feedrate)
                     )
+        head_dist_xy = self.head_dist_xy
         if (
             self.head_dist_z == 0.0
-            and self.head_dist_xy is not None
-            and self.head_dist_xy > 0
-            and self.head_dist_e is not None
-            and self.head_dist_e > 0
+            and head_dist_xy is not None
+            and head_dist_xy > 0
+            and head_dist_e is not None
+            and head_dist_e > 0
             ):
-            e_xy = self.head_dist_e / self.head_dist_xy
+            e_xy = head_dist_e / head_dist_xy
             if (
                 self.after.min_e_xy is None
                 or self.after.min_e_xy > e_xy
@@ -68,26 +73,54 @@ class Move(Control):
                 or self.after.max_e_xy < e_xy
                 ):
                 self.after.max_e_xy = e_xy
+    
+    @classmethod
+    def to(cls, before, position, feedrate=None, comment=None):
+        args = {'G': 1.0}
+        for letter, axis, value in zip('XYZE', before.axes, position):
+            if value is None:
+                continue
+            if (
+                axis.position is not None
+                and round(value, 5) == round(axis.position, 5)
+                ):
+                continue
+            if axis.relative:
+                args[letter] = value - axis.position
+            else:
+                args[letter] = value - axis.offset
+        if feedrate is not None:
+            args['F'] = feedrate * 60.0 # mm/m in gcode
+        return parse(unparse(args, comment))
 
 class MoveAlt(Move):
     code = 'G1'
 
-class SetHeadTemp(Control):
+class SetTemp(Control):
+    @property
+    def target(self):
+        if hasattr(self, 'S'):
+            return self.S
+        return self.R # M109 R waits for cooling too
+
+class SetHeadTemp(SetTemp):
     code = 'M109'
     waits = True
+    heater = 'head'
     
     def _evolve(self):
-        self.after.head_temp = self.S
+        self.after.head_temp = self.target
 
 class PreheatHeadTemp(SetHeadTemp):
     code = 'M104'
     waits = False
 
-class SetBedTemp(Control):
+class SetBedTemp(SetTemp):
     code = 'M190'
     waits = True
+    heater = 'bed'
     def _evolve(self):
-        self.after.bed_temp = self.S
+        self.after.bed_temp = self.target
 
 class PreheatBedTemp(SetBedTemp):
     code = 'M140'
@@ -97,7 +130,7 @@ class SetOffset(Control):
     code = 'G92'
     def _evolve(self):
         for axis, value in self.aargs.items():
-            getattr(self.after, axis.lower()).set_offset(value)
+            getattr(self.after, axis.lower()).set_offset(value, axis != 'E')
             
 
 class Informational(NoOp):
@@ -110,6 +143,28 @@ class Ignored(Control):
 class ReportTemps(Informational):
     code = 'M105'
 
+class Message(Informational):
+    code = 'M117'
+    @property
+    def text(self):
+        return self.g_code.split(';', 1)[0].strip()[len(self.code)+1:]
+
+class Echo(Message):
+    code = 'M118'
+
+class Dwell(Control):
+    code = 'G4'
+    waits = True
+    def _evolve(self):
+        if hasattr(self, 'P'):
+            self.after.time += self.P / 1000.0
+        elif hasattr(self, 'S'):
+            self.after.time += self.S
+
+class FinishMoves(Informational):
+    code = 'M400'
+    waits = True
+
 class AbsoluteE(Control):
     code = 'M82'
     def _evolve(self):
@@ -202,7 +257,7 @@ class Absolute(Control):
     code = 'G90'
     def _evolve(self):
         for axis in self.after.axes:
-            axis.relative = True
+            axis.relative = False
 
 class DisableSteppers(Control):
     code = 'M84'
@@ -210,8 +265,19 @@ class DisableSteppers(Control):
         self.after.steppers = False
         self.after.homed = False
 
+class SetStepsPerUnit(Control):
+    code = 'M92'
+    def _evolve(self):
+        for axis, value in self.aargs.items():
+            getattr(self.after, axis.lower()).steps_per_unit = value
+
 class SetAxisFeedrateLimit(Control):
     code = 'M203'
     def _evolve(self):
         for axis, value in self.aargs.items():
             getattr(self.after, axis.lower()).speed_limit = value
+
+class RelativeE(Control):
+    code = 'M83'
+    def _evolve(self):
+        self.after.e.relative = True
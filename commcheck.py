@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# commcheck.py -- Measure how fast and how reliably the serial link to the printer is
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./commcheck.py /dev/ttyUSB0 [--baud 500000] > build.json
+       ./commcheck.py --fake [--error-rate 0.01] > fake.json
+Like flash.sh's commcheck: M118 lines of each length, echoed back, but with
+numbers for each length and pipelining depth.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import json
+import os
+import random
+import select
+import time
+
+import numpy
+
+from streamer import Protocol
+from streamer import Streamer
+from streamer import open_serial
+from streamer import with_checksum
+from marlin import CONFIG_DIR
+from marlin import load_profile
+from machine_state import MachineState
+import fake_printer
+
+# From marlin_config/Configuration_adv.h, including the N and checksum and
+# the terminating null
+MAX_CMD_SIZE = 96
+LINES = 100 # of each length, like flash.sh
+LENGTHS = (0, 8, 16, 32, 48, 64, 76)
+DEPTHS = (1, 2, 4, 0) # lines in flight, 0 for as many as fit
+PERCENTILES = (50, 90, 99)
+
+def payload(rng, length):
+    # Digits, like $RANDOM$RANDOM...
+    return ''.join(rng.choice('0123456789') for _ in range(length))
+
+def hello(fd, timeout=10.0):
+    # Like flash.sh: M118 ping until it answers, then let the rest drain
+    # so the first run doesn't see an ok it didn't ask for
+    start = time.monotonic()
+    partial = b''
+    answered = False
+    last = 0.0
+    while not answered:
+        now = time.monotonic()
+        if now - start > timeout:
+            raise TimeoutError(f"No answer to M118 ping in {timeout} s")
+        if now - last > 1.0:
+            os.write(fd, b"M118 ping\n")
+            last = now
+        (readable, _, _) = select.select([fd], [], [], 0.1)
+        if len(readable) > 0:
+            partial += os.read(fd, 4096)
+            *lines, partial = partial.split(b'\n')
+            for line in lines:
+                DEBUG(f"< {line!r}")
+                if b'ping' in line:
+                    answered = True
+    while len(select.select([fd], [], [], 0.2)[0]) > 0:
+        os.read(fd, 4096)
+
+def run(fd, length, depth, lines, rng, **options):
+    protocol = Protocol(depth=depth if depth > 0 else None, **options)
+    sent = dict()
+    latencies = []
+    def on_sent(n):
+        sent[n] = time.monotonic()
+    def on_ack(n):
+        if n in sent and n > 0:
+            latencies.append(time.monotonic() - sent.pop(n))
+    protocol.on_sent = on_sent
+    protocol.on_ack = on_ack
+    expected = [payload(rng, length) for _ in range(lines)]
+    echoed = []
+    errors = []
+    def on_message(message):
+        if message.isdigit():
+            echoed.append(message)
+        elif message.startswith('Error:'):
+            errors.append(message)
+        else:
+            DEBUG(f"< {message}")
+    elapsed = Streamer(fd, protocol, on_message=on_message).run(
+        f"M118 {text}" for text in expected
+        )
+    if length > 0:
+        mangled = sum(a != b for a, b in zip(expected, echoed))
+        mangled += abs(len(expected) - len(echoed))
+    else:
+        mangled = 0 # M118 with nothing says nothing
+    latencies = numpy.array(latencies) * 1000.0 # ms
+    result = {
+        'length': length,
+        'depth': depth,
+        'lines': lines,
+        'bytes': protocol.sent_bytes,
+        'seconds': elapsed,
+        'lines_per_second': lines / elapsed,
+        'bytes_per_second': protocol.sent_bytes / elapsed,
+        'latency_ms': {
+            f"p{p}": float(numpy.percentile(latencies, p)) for p in PERCENTILES
+            },
+        'resends': protocol.resends,
+        'resend_rate': protocol.resends / lines,
+        'errors': len(errors),
+        'echo_errors': mangled,
+        }
+    result['latency_ms']['max'] = float(latencies.max())
+    return result
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Benchmark the serial link to the printer'
+        )
+    arguments.add_argument(
+        'port',
+        type=str,
+        nargs='?',
+        help="Serial port, like /dev/ttyUSB0",
+        )
+    arguments.add_argument(
+        '--fake',
+        action='store_true',
+        help="Check against fake_printer.py instead of a real printer",
+        )
+    arguments.add_argument(
+        '--error-rate',
+        type=float,
+        help="For --fake, fraction of lines to corrupt (default: %(default)s)",
+        default=0.0,
+        )
+    arguments.add_argument(
+        '--baud',
+        type=int,
+        help="(default: from the config)",
+        default=None,
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Buffer sizes from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--lengths',
+        type=lambda s: [int(l) for l in s.split(',')],
+        help="M118 message lengths (default: %(default)s)",
+        default=list(LENGTHS),
+        )
+    arguments.add_argument(
+        '--depths',
+        type=lambda s: [int(d) for d in s.split(',')],
+        help="Lines in flight, 0 for character counting (default: %(default)s)",
+        default=list(DEPTHS),
+        )
+    arguments.add_argument(
+        '--lines',
+        type=int,
+        help="Lines of each length at each depth (default: %(default)s)",
+        default=LINES,
+        )
+    arguments.add_argument(
+        '--no-checksum',
+        action='store_true',
+        help="Don't send line numbers and checksums",
+        )
+    arguments.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.port is None and not args.fake:
+        arguments.error("Need a port or --fake")
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    baud = args.baud or profile.baudrate
+    options = {
+        'rx_buffer_size': profile.rx_buffer_size,
+        'bufsize': profile.bufsize,
+        'advanced_ok': profile.advanced_ok,
+        'checksums': not args.no_checksum,
+        }
+    printer = None
+    if args.fake:
+        printer = fake_printer.FakePrinter(
+            rx_buffer_size=profile.rx_buffer_size,
+            bufsize=profile.bufsize,
+            block_buffer_size=profile.block_buffer_size,
+            baud=baud,
+            advanced_ok=profile.advanced_ok,
+            error_rate=args.error_rate,
+            seed=args.seed,
+            )
+        (port, stop) = fake_printer.start(printer)
+    else:
+        port = args.port
+    rng = random.Random(args.seed)
+    runs = []
+    fd = open_serial(port, baud)
+    try:
+        hello(fd)
+        for length in args.lengths:
+            size = len(with_checksum(f"M118 {'0' * length}", args.lines)) + 1
+            if size > MAX_CMD_SIZE - 1:
+                WARNING(f"Skipping {length}, {size} bytes is over MAX_CMD_SIZE")
+                continue
+            for depth in args.depths:
+                result = run(fd, length, depth, args.lines, rng, **options)
+                INFO(
+                    f"l={length} depth={depth or 'chars'}:"
+                    f" {result['lines_per_second']:0.0f} lines/s"
+                    f" {result['bytes_per_second']:0.0f} bytes/s"
+                    f" p50 {result['latency_ms']['p50']:0.2f} ms"
+                    f" p99 {result['latency_ms']['p99']:0.2f} ms"
+                    f" {result['resends']} resends"
+                    f" {result['echo_errors']} bad echoes"
+                    )
+                runs.append(result)
+    finally:
+        os.close(fd)
+        if printer is not None:
+            stop.set()
+    report = {
+        'port': 'fake' if args.fake else port,
+        'baud': baud,
+        'marlin_config': os.path.abspath(args.marlin_config),
+        'rx_buffer_size': profile.rx_buffer_size,
+        'bufsize': profile.bufsize,
+        'advanced_ok': profile.advanced_ok,
+        'checksums': not args.no_checksum,
+        'when': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'runs': runs,
+        }
+    if printer is not None:
+        report['error_rate'] = args.error_rate
+        report['fake'] = printer.stats()
+    json.dump(report, sys.stdout, indent=1)
+    print()
+
+if __name__ == '__main__':
+    main()
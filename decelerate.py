@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# decelerate.py -- Slow down printing moves before retracting
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./decelerate.py <input.gcode> [-o output.gcode] [--slow-e mm]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+from collections import deque
+
+import numpy
+
+from command import NoOp
+from command import parse
+from command import unparse
+from commands import Move
+from mutator import Mutator
+from script import Script
+
+SLOW_E_MM = 0.5 # mm of filament before the retract to slow down over
+SLOW_XY_RATE = 2.0 # mm/s by the time it gets to the retract
+SLOW_BEFORE = 'retract' # retract or any (anything that isn't extruding)
+# Travel moves and comments between the last extrusion and the retract
+# are held back too, this is just so they can't pile up forever
+MAX_PENDING = 256
+
+def extrusion(command):
+    if not isinstance(command, Move):
+        return 0.0
+    e = command.head_dist_e
+    if e is None or e < 0.0:
+        return 0.0
+    return e
+
+def retracts(command):
+    if not isinstance(command, Move):
+        return False
+    e = command.head_dist_e
+    return e is not None and e < 0.0
+
+class ExtrusionDecelerator(Mutator):
+    def __init__(
+        self,
+        script=None,
+        slow_e=SLOW_E_MM,
+        slow_rate=SLOW_XY_RATE,
+        before=SLOW_BEFORE,
+        max_pending=MAX_PENDING,
+        ):
+        assert before in ('retract', 'any')
+        self.slow_e = slow_e # mm
+        self.slow_rate = slow_rate # mm/s
+        self.before = before
+        self.max_pending = max_pending
+        self.pending = deque() # (ci, command, e)
+        self.pending_e = 0.0
+        self.slowed = 0
+        super().__init__(script)
+
+    def pop(self):
+        (ci, old, e) = self.pending.popleft()
+        self.pending_e -= e
+        self.keep(ci, old)
+
+    def flush(self):
+        while len(self.pending) > 0:
+            self.pop()
+        self.pending_e = 0.0
+
+    def finish(self):
+        self.flush()
+        INFO(f"Slowed down {self.slowed} moves")
+
+    def hold(self, ci, old):
+        e = extrusion(old)
+        self.pending.append((ci, old, e))
+        self.pending_e += e
+        # Once there's more than slow_e after it, the first can't be slowed
+        while (
+            len(self.pending) > self.max_pending
+            or (
+                len(self.pending) > 0
+                and self.pending_e - self.pending[0][2] > self.slow_e
+                )
+            ):
+            self.pop()
+
+    def decelerate(self, end):
+        # All at once now we know how far each one is from the retract
+        held = list(self.pending)
+        self.pending.clear()
+        self.pending_e = 0.0
+        e = numpy.array([h[2] for h in held])
+        e_to_retract = e[::-1].cumsum()[::-1] - e # after each one
+        feedrate = numpy.array( # Move puts F in before
+            [h[1].before.feedrate for h in held],
+            dtype=float,
+            )
+        slowed = (
+            self.slow_rate * (self.slow_e - e_to_retract)
+            + feedrate * e_to_retract
+            ) / self.slow_e
+        slow = (
+            (e > 0.0)
+            & (feedrate > self.slow_rate) # nan (unknown) isn't
+            & (e_to_retract <= self.slow_e)
+            )
+        slowing = False # the last F that went out was a slowed one
+        for hi, (ci, old, _) in enumerate(held):
+            if slow[hi] and old.moves_head:
+                args = old.args
+                args['F'] = slowed[hi] * 60.0 # mm/m in gcode
+                self.replace(ci, old, [
+                    parse(unparse(args, " slowed by decelerate.py"))
+                    ])
+                self.slowed += 1
+                slowing = True
+            elif (
+                slowing
+                and isinstance(old, Move)
+                and not hasattr(old, 'F')
+                and not numpy.isnan(feedrate[hi])
+                ):
+                # Without an F of its own it would go at the slowed rate
+                args = old.args
+                args['F'] = feedrate[hi] * 60.0
+                self.replace(ci, old, [
+                    parse(unparse(args, " restored by decelerate.py"))
+                    ])
+                slowing = False
+            else:
+                if isinstance(old, Move) and hasattr(old, 'F'):
+                    slowing = False
+                self.keep(ci, old)
+        # The retract and whatever comes after it shouldn't stay slow
+        if slowing:
+            return end.before.feedrate
+        return None
+
+    def process_command(self, ci, old):
+        if self.slow_e <= 0.0:
+            return self.keep(ci, old)
+        if isinstance(old, NoOp):
+            if len(self.pending) > 0:
+                return self.hold(ci, old)
+            return self.keep(ci, old)
+        e = extrusion(old)
+        if self.before == 'retract':
+            ends = retracts(old)
+            holds = isinstance(old, Move) and (e > 0.0 or len(self.pending) > 0)
+        else:
+            ends = e == 0.0
+            holds = not ends
+        if ends and len(self.pending) > 0:
+            restore = self.decelerate(old)
+            if restore is not None and not hasattr(old, 'F'):
+                if isinstance(old, Move):
+                    args = old.args
+                    args['F'] = restore * 60.0
+                    return self.replace(ci, old, [
+                        parse(unparse(args, " restored by decelerate.py"))
+                        ])
+                # Something that isn't a move, with moves still to come
+                self.replace(ci, old, [parse(unparse(
+                    {'G': 1.0, 'F': restore * 60.0},
+                    " restored by decelerate.py",
+                    ))])
+        elif holds:
+            return self.hold(ci, old)
+        else:
+            self.flush()
+        return self.keep(ci, old)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Slow down printing moves before retracting'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input_slow.gcode)",
+        )
+    arguments.add_argument(
+        '--slow-e',
+        type=float,
+        help="(mm of filament) (default: %(default)s)",
+        default=SLOW_E_MM,
+        )
+    arguments.add_argument(
+        '--slow-rate',
+        type=float,
+        help="(mm/s) (default: %(default)s)",
+        default=SLOW_XY_RATE,
+        )
+    arguments.add_argument(
+        '--before',
+        choices=('retract', 'any'),
+        help="Slow down before retracts or any pause in extrusion"
+        " (default: %(default)s)",
+        default=SLOW_BEFORE,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.output is None:
+        args.output = '_slow.'.join(args.input.rsplit('.', 1))
+    decelerator = ExtrusionDecelerator(
+        slow_e=args.slow_e,
+        slow_rate=args.slow_rate,
+        before=args.before,
+        )
+    with open(args.input, 'r') as fh:
+        Script.write(decelerator.stream(Script.read(fh)), args.output)
+
+if __name__ == '__main__':
+    main()
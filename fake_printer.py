@@ -0,0 +1,665 @@
+#!/usr/bin/env python3
+
+# fake_printer.py -- Pretend to be Marlin on a pty, for testing hosts without a printer
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./fake_printer.py [--error-rate 0.01] [--speed 10] [--advanced-ok]
+Prints the pty to point the host at, like ./streamer.py /dev/pts/5 ...
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+from math import sqrt
+
+from command import NoOp
+from command import _parse
+from commands import Move
+from commands import SetTemp
+from commands import Dwell
+from commands import Home
+from commands import AutoBedLevel
+from machine_state import MachineState
+from planner import Block
+from thermal import HEATERS
+from thermal import TEMP_WINDOW
+from thermal import POWER_REPORT_MAX
+from starvation import PARSE_TIME
+from starvation import PLAN_TIME
+from streamer import checksum
+from marlin import BAUDRATE
+from marlin import BLOCK_BUFFER_SIZE
+from marlin import BUFSIZE
+from marlin import CONFIG_DIR
+from marlin import MIN_SEGMENT_TIME
+from marlin import RX_BUFFER_SIZE
+from marlin import load_profile
+
+# From marlin_config/Configuration.h and Configuration_adv.h
+HOMING_FEEDRATE = (20.0, 20.0, 10.0) # mm/s XYZ
+KEEPALIVE_INTERVAL = 2.0 # s, HOST_KEEPALIVE_FEATURE
+PROBE_POINTS = 16 # GRID_MAX_POINTS_X * GRID_MAX_POINTS_Y
+# Not from the config, about what the real one takes
+PROBE_TIME = 2.0 # s each
+HEATING_REPORT_INTERVAL = 1.0 # s, M109/M190 print temperatures this often
+SD_WRITE_TIME = 1e-5 # s a byte, about what an SD card on SPI manages
+
+FIRMWARE = "FIRMWARE_NAME:Marlin fake_printer.py PROTOCOL_VERSION:1.0 EXTRUDER_COUNT:1"
+CAPABILITIES = (
+    "AUTOREPORT_TEMP",
+    "EMERGENCY_PARSER",
+    "HOST_ACTION_COMMANDS",
+    "SDCARD",
+    )
+
+def open_pty():
+    # (master, path) for the host to open
+    (master, slave) = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    # Holding the slave open keeps reads on the master from failing with
+    # EIO whenever the host closes the port
+    return (master, slave, os.ttyname(slave))
+
+def message_text(text):
+    # M118 A1 and E1 prefix the message, P picks the port
+    words = text.split(' ', 1)
+    text = words[1] if len(words) > 1 else ''
+    prefix = ''
+    while len(text) >= 2 and text[0] in 'AEP' and text[1] in '0123456789':
+        if text[:2] == 'A1':
+            prefix = '//action:'
+        elif text[:2] == 'E1':
+            prefix = 'echo:'
+        text = text[2:].lstrip()
+    return prefix + text
+
+# Marlin's view of the world: bytes trickle in at the baud rate and pile up
+# in the RX buffer while it's busy, it reads them into the command queue
+# between commands, and moves wait for room in the planner. Everything runs
+# on the same clock as time.monotonic(), feed() and advance() take now.
+class FakePrinter:
+    def __init__(
+        self,
+        rx_buffer_size=RX_BUFFER_SIZE,
+        bufsize=BUFSIZE,
+        block_buffer_size=BLOCK_BUFFER_SIZE,
+        baud=BAUDRATE,
+        advanced_ok=False,
+        slowdown=True,
+        min_segment_time=MIN_SEGMENT_TIME,
+        error_rate=0.0,
+        speed=1.0,
+        heaters=HEATERS,
+        seed=None,
+        ):
+        self.rx_buffer_size = rx_buffer_size
+        self.bufsize = bufsize
+        self.block_buffer_size = block_buffer_size
+        self.byte_time = 10.0 / baud # 8N1
+        self.advanced_ok = advanced_ok
+        self.slowdown = slowdown
+        self.min_segment_time = min_segment_time
+        self.error_rate = error_rate
+        self.speed = speed # how much faster than real moves and heating go
+        self.heaters = heaters
+        self.random = random.Random(seed)
+        self.wire = deque() # [arrival of first byte, bytes]
+        self.wire_free = 0.0
+        self.rx = bytearray()
+        self.queue = deque() # (n, text)
+        self.last_n = 0
+        self.busy_until = None
+        self.outbox = [] # (time, text)
+        self.planner = deque() # Blocks, the first one is moving
+        self.block_end = None
+        self.exit_speed = None
+        self.last_end = None # when the planner last ran out
+        self.waited = True
+        self.state = MachineState()
+        for axis in self.state.axes:
+            axis.position = 0.0
+        self.temps = {name: heater.ambient for name, heater in heaters.items()}
+        self.setpoints = {name: 0.0 for name in heaters}
+        self.heat_time = None
+        self.report_interval = 0.0 # M155
+        self.saving = None # M28's file name
+        self.files = dict() # the SD card, {name: [line, ...]}
+        self.next_report = None
+        self.clock = None
+        # For whoever's testing the host
+        self.received_bytes = 0
+        self.dropped_bytes = 0
+        self.max_rx = 0
+        self.commands = 0
+        self.errors = 0
+        self.starved = 0
+        self.starved_time = 0.0
+
+    def feed(self, data, now):
+        if len(data) == 0:
+            return
+        start = max(now, self.wire_free)
+        self.wire.append([start, bytes(data)])
+        self.wire_free = start + len(data) * self.byte_time
+        self.received_bytes += len(data)
+
+    def arrive(self, t):
+        # Bytes that made it across the wire by t go into the RX buffer, or
+        # nowhere if it's full
+        while len(self.wire) > 0:
+            chunk = self.wire[0]
+            (start, data) = chunk
+            # Times are around 1e4 s, so allow for rounding
+            count = min(len(data), int((t - start) / self.byte_time + 1e-6))
+            if count <= 0:
+                break
+            room = max(0, self.rx_buffer_size - 1 - len(self.rx))
+            self.rx += data[:min(count, room)]
+            self.dropped_bytes += max(0, count - room)
+            self.max_rx = max(self.max_rx, len(self.rx))
+            if count == len(data):
+                self.wire.popleft()
+            else:
+                chunk[0] = start + count * self.byte_time
+                chunk[1] = data[count:]
+
+    def line_arrives(self):
+        # When the next whole line will be in the RX buffer
+        if b'\n' in self.rx:
+            return self.clock
+        for (start, data) in self.wire:
+            newline = data.find(b'\n')
+            if newline >= 0:
+                return start + (newline + 1) * self.byte_time
+        return None
+
+    def say(self, t, text):
+        self.outbox.append((t, text))
+
+    def ok(self, t, n):
+        if self.advanced_ok:
+            blocks = self.block_buffer_size - 1 - len(self.planner)
+            free = self.bufsize - len(self.queue)
+            if n is None:
+                self.say(t, f"ok P{blocks} B{free}")
+            else:
+                self.say(t, f"ok N{n} P{blocks} B{free}")
+        else:
+            self.say(t, "ok")
+
+    def resend(self, t, error):
+        # Marlin's flush_and_request_resend()
+        self.errors += 1
+        self.say(t, f"Error:{error}, Last Line: {self.last_n}")
+        self.say(t, f"Resend: {self.last_n + 1}")
+        self.say(t, "ok")
+        self.rx.clear()
+
+    def read_commands(self, t):
+        # get_serial_commands(), between commands
+        while len(self.queue) < self.bufsize and b'\n' in self.rx:
+            end = self.rx.index(b'\n')
+            raw = bytes(self.rx[:end])
+            del self.rx[:end+1]
+            if (
+                len(raw) > 0
+                and self.error_rate > 0.0
+                and self.random.random() < self.error_rate
+                ):
+                raw = bytearray(raw)
+                raw[self.random.randrange(len(raw))] ^= 0x01
+                raw = bytes(raw)
+            text = raw.decode('ascii', errors='replace')
+            text = text.split(';', 1)[0].strip()
+            if len(text) == 0:
+                continue
+            n = None
+            if text[0] == 'N':
+                (number, _, rest) = text.partition(' ')
+                try:
+                    n = int(number[1:])
+                except ValueError:
+                    n = -1
+                if '*' not in rest:
+                    self.resend(t, "No Checksum with line number")
+                    return
+                (body, _, cs) = text.rpartition('*')
+                rest = rest.rpartition('*')[0].strip()
+                if n != self.last_n + 1 and not rest.startswith('M110'):
+                    self.resend(t, "Line Number is not Last Line Number+1")
+                    return
+                if cs.strip() != str(checksum(body)):
+                    self.resend(t, "checksum mismatch")
+                    return
+                self.last_n = n
+                text = rest
+            elif '*' in text:
+                self.resend(t, "No Line Number with checksum")
+                return
+            elif self.saving is not None and text.upper() != 'M29':
+                self.resend(t, "No Checksum with line number")
+                return
+            self.queue.append((n, text))
+
+    def heat(self, t):
+        if self.heat_time is not None and t > self.heat_time:
+            dt = (t - self.heat_time) * self.speed
+            for name, heater in self.heaters.items():
+                self.temps[name] = heater.advance(
+                    self.temps[name],
+                    self.setpoints[name],
+                    dt,
+                    )
+        self.heat_time = t
+
+    def temperatures(self):
+        words = []
+        for name, key in (('head', 'T'), ('bed', 'B')):
+            if name in self.temps:
+                words.append(
+                    f"{key}:{self.temps[name]:0.2f} /{self.setpoints[name]:0.2f}"
+                    )
+        for name, key in (('head', '@'), ('bed', 'B@')):
+            if name not in self.temps:
+                continue
+            heater = self.heaters[name]
+            temp = self.temps[name]
+            if temp < self.setpoints[name] - TEMP_WINDOW:
+                power = POWER_REPORT_MAX
+            elif self.setpoints[name] > 0.0:
+                # Just enough to hold it
+                power = min(
+                    POWER_REPORT_MAX,
+                    heater.loss * (temp - heater.ambient)
+                    / heater.power * POWER_REPORT_MAX,
+                    )
+            else:
+                power = 0.0
+            words.append(f"{key}:{power:0.0f}")
+        return ' '.join(words)
+
+    def planner_run(self, t):
+        # Finish the blocks that are done by t and start the next ones
+        while self.block_end is not None and self.block_end <= t:
+            end = self.block_end
+            self.planner.popleft()
+            self.block_end = None
+            if len(self.planner) > 0:
+                self.start_block(end)
+            else:
+                self.last_end = end
+                self.exit_speed = None
+
+    def start_block(self, t):
+        # Lookahead only as far as what's in the planner right now
+        block = self.planner[0]
+        entry = block.safe_speed
+        if self.exit_speed is not None:
+            entry = min(self.exit_speed, block.junction_speed(block.prev))
+        if len(self.planner) > 1:
+            exit = self.planner[1].junction_speed(block)
+        else:
+            exit = block.safe_speed
+        reach = 2.0 * block.accel * block.length
+        block.exit = min(exit, sqrt(entry**2 + reach))
+        block.entry = min(entry, sqrt(block.exit**2 + reach))
+        block.plan()
+        self.exit_speed = block.exit
+        self.block_end = t + block.time / self.speed
+
+    def drain(self):
+        while self.block_end is not None:
+            self.planner_run(self.block_end)
+        return self.last_end
+
+    def plan(self, t, command):
+        block = Block(command)
+        if block.length == 0.0:
+            return t
+        self.planner_run(t)
+        while len(self.planner) >= self.block_buffer_size - 1:
+            # Marlin sits in plan_buffer_line() until there's room
+            t = self.block_end
+            self.planner_run(t)
+        queued = len(self.planner)
+        segment_time = block.length / block.nominal
+        if (
+            self.slowdown
+            and 1 < queued < self.block_buffer_size // 2
+            and segment_time < self.min_segment_time
+            ):
+            segment_time += 2.0 * (self.min_segment_time - segment_time) / queued
+            block.nominal = block.length / segment_time
+        t += PLAN_TIME
+        if queued > 0:
+            block.prev = self.planner[-1]
+        self.planner.append(block)
+        if queued == 0:
+            if (
+                not self.waited
+                and self.last_end is not None
+                and t > self.last_end
+                ):
+                # Ran out of moves in the middle of printing
+                self.starved += 1
+                self.starved_time += t - self.last_end
+            self.waited = False
+            self.start_block(t)
+        return t
+
+    def home_time(self, command, before):
+        axes = [
+            a for a in 'XYZ' if hasattr(command, a)
+            ] or ['X', 'Y', 'Z']
+        seconds = 0.0
+        for ai, axis in enumerate(before.axes[:3]):
+            if 'XYZ'[ai] in axes:
+                # Fast to the switch, back off and bump slowly
+                seconds += abs(axis.position or 0.0) / HOMING_FEEDRATE[ai]
+                seconds += 1.0
+        if isinstance(command, AutoBedLevel):
+            seconds += PROBE_POINTS * PROBE_TIME
+        return seconds
+
+    def busy(self, start, end, heater=None):
+        # HOST_KEEPALIVE_FEATURE, or temperatures while heating
+        if heater is None:
+            t = start + KEEPALIVE_INTERVAL
+            while t < end:
+                self.say(t, "echo:busy: processing")
+                t += KEEPALIVE_INTERVAL
+            return
+        t = start + HEATING_REPORT_INTERVAL
+        while t < end:
+            self.heat(t)
+            self.say(t, f" {self.temperatures()} W:?")
+            t += HEATING_REPORT_INTERVAL
+
+    def execute(self, t, n, text):
+        # Returns when it's done, and says whatever it says
+        self.commands += 1
+        t += PARSE_TIME
+        code = text.split(' ', 1)[0].upper()
+        if self.saving is not None:
+            # Between M28 and M29 everything goes to the file instead
+            if code != 'M29':
+                self.files[self.saving].append(text)
+                return (t + (len(text) + 1) * SD_WRITE_TIME, True)
+            self.say(t, "Done saving file.")
+            self.saving = None
+            return (t, True)
+        if code == 'M105':
+            self.heat(t)
+            # The temperatures are the ok
+            self.say(t, f"ok {self.temperatures()}")
+            return (t, False)
+        elif code == 'M110':
+            (_, _, rest) = text.partition('N')
+            try:
+                self.last_n = int(rest.split()[0])
+            except (ValueError, IndexError):
+                pass
+        elif code == 'M114':
+            position = ' '.join(
+                f"{a}:{axis.position:0.2f}"
+                for a, axis in zip('XYZE', self.state.axes)
+                )
+            self.say(t, f"{position} Count {position}")
+        elif code == 'M115':
+            self.say(t, FIRMWARE)
+            for capability in CAPABILITIES:
+                self.say(t, f"Cap:{capability}:1")
+        elif code == 'M118':
+            self.say(t, message_text(text))
+        elif code == 'M28':
+            # Marlin only writes 8.3 names
+            self.saving = text.partition(' ')[2].strip().upper()
+            self.files[self.saving] = []
+            self.say(t, f"Writing to file: {self.saving}")
+            return (t, True)
+        elif code == 'M155':
+            (_, _, rest) = text.partition('S')
+            try:
+                self.report_interval = float(rest.split()[0])
+            except (ValueError, IndexError):
+                self.report_interval = 0.0
+            self.next_report = t + self.report_interval
+        try:
+            command = _parse(text)
+        except (KeyError, ValueError):
+            if len(code) < 2 or code[0] not in 'GMT' or not code[1:].isdigit():
+                # Like the tail of a line that was half in the RX buffer
+                # when it got flushed
+                self.say(t, f"echo:Unknown command: \"{text}\"")
+            else:
+                DEBUG(f"Not modelled: {text}")
+            command = NoOp(text, {}, None)
+        before = self.state
+        self.state = command.evolve(before)
+        if isinstance(command, Move):
+            return (self.plan(t, command), True)
+        if isinstance(command, SetTemp) and command.heater in self.setpoints:
+            self.heat(t)
+            self.setpoints[command.heater] = command.target
+        if not (getattr(command, 'waits', False) or isinstance(command, Home)):
+            return (t, True)
+        # Everything else waits for the moves to finish first
+        end = self.drain()
+        start = t if end is None else max(t, end)
+        self.waited = True
+        if isinstance(command, Dwell):
+            done = start + (self.state.time - before.time) / self.speed
+            self.busy(start, done)
+        elif isinstance(command, Home):
+            done = start + self.home_time(command, before) / self.speed
+            self.busy(start, done)
+        elif isinstance(command, SetTemp) and command.heater in self.heaters:
+            self.heat(start)
+            wait = self.heaters[command.heater].wait_time(
+                self.temps[command.heater],
+                command.target,
+                cooling=not hasattr(command, 'S'),
+                )
+            if wait == float('inf'):
+                wait = 0.0
+            done = start + wait / self.speed
+            self.busy(start, done, command.heater)
+        else:
+            done = start
+        return (done, True)
+
+    def advance(self, now):
+        # Run Marlin up to now, returns what it said
+        if self.clock is None:
+            self.clock = now
+            self.heat_time = now
+        while True:
+            t = self.clock
+            if self.busy_until is not None:
+                if self.busy_until > now:
+                    break
+                t = self.busy_until
+                self.busy_until = None
+                self.queue.popleft()
+            self.clock = t
+            self.arrive(t)
+            self.read_commands(t)
+            if len(self.queue) == 0:
+                t = self.line_arrives()
+                if t is None or t > now:
+                    break
+                self.clock = max(self.clock, t)
+                continue
+            (n, text) = self.queue[0]
+            (done, ok) = self.execute(t, n, text)
+            if ok:
+                self.ok(done, n)
+            self.busy_until = done
+        self.clock = max(self.clock, now)
+        self.arrive(now)
+        self.planner_run(now)
+        while self.report_interval > 0.0 and self.next_report <= now:
+            self.heat(self.next_report)
+            self.say(self.next_report, f" {self.temperatures()}")
+            self.next_report += self.report_interval
+        self.outbox.sort(key=lambda said: said[0])
+        out = []
+        while len(self.outbox) > 0 and self.outbox[0][0] <= now:
+            out.append(self.outbox.pop(0)[1] + '\n')
+        return ''.join(out).encode('ascii')
+
+    def next_event(self):
+        # When advance() will have something new to say
+        times = [said[0] for said in self.outbox]
+        if self.busy_until is not None:
+            times.append(self.busy_until)
+        else:
+            arrives = self.line_arrives()
+            if arrives is not None:
+                times.append(arrives)
+        if self.report_interval > 0.0:
+            times.append(self.next_report)
+        if len(times) == 0:
+            return None
+        return min(times)
+
+    def stats(self):
+        return {
+            'received_bytes': self.received_bytes,
+            'dropped_bytes': self.dropped_bytes,
+            'max_rx': self.max_rx,
+            'commands': self.commands,
+            'errors': self.errors,
+            'starved': self.starved,
+            'starved_time': float(self.starved_time),
+            }
+
+    def serve(self, fd, stop=None):
+        out = b''
+        while stop is None or not stop.is_set():
+            now = time.monotonic()
+            out += self.advance(now)
+            wait = 0.1
+            event = self.next_event()
+            if event is not None:
+                wait = min(wait, max(0.0, event - now))
+            writing = [fd] if len(out) > 0 else []
+            (readable, writable, _) = select.select([fd], writing, [], wait)
+            if len(writable) > 0:
+                sent = os.write(fd, out)
+                out = out[sent:]
+            if len(readable) > 0:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    return
+                self.feed(data, time.monotonic())
+
+def start(printer=None):
+    # For tests: a FakePrinter on a pty in a thread, returns the pty's path
+    # and an Event to stop it with
+    if printer is None:
+        printer = FakePrinter()
+    (master, slave, path) = open_pty()
+    stop = threading.Event()
+    def serve():
+        try:
+            printer.serve(master, stop)
+        finally:
+            os.close(master)
+            os.close(slave)
+    threading.Thread(target=serve, daemon=True).start()
+    return (path, stop)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Pretend to be a Marlin printer on a pty'
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Buffer sizes and limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--advanced-ok',
+        action='store_true',
+        help="Send ok N P B even if the config doesn't have ADVANCED_OK",
+        )
+    arguments.add_argument(
+        '--error-rate',
+        type=float,
+        help="Fraction of lines to corrupt (default: %(default)s)",
+        default=0.0,
+        )
+    arguments.add_argument(
+        '--speed',
+        type=float,
+        help="Move and heat this many times faster than real (default: %(default)s)",
+        default=1.0,
+        )
+    arguments.add_argument(
+        '--seed',
+        type=int,
+        help="For --error-rate",
+        default=None,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    printer = FakePrinter(
+        rx_buffer_size=profile.rx_buffer_size,
+        bufsize=profile.bufsize,
+        block_buffer_size=profile.block_buffer_size,
+        baud=profile.baudrate,
+        advanced_ok=args.advanced_ok or profile.advanced_ok,
+        slowdown=profile.slowdown,
+        min_segment_time=profile.min_segment_time,
+        error_rate=args.error_rate,
+        speed=args.speed,
+        seed=args.seed,
+        )
+    (master, slave, path) = open_pty()
+    print(path, flush=True)
+    try:
+        printer.serve(master)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for key, value in printer.stats().items():
+            INFO(f"{key}: {value}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+# farm.py -- Drive a bunch of printers from one process
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./farm.py --printer left=/dev/ttyUSB0 --printer right=/dev/ttyUSB1 \\
+           job1.gcode job2.gcode ... > results.json
+       ./farm.py --fake 4 --speed 100 job1.gcode job2.gcode ...
+Instead of an OctoPrint for each printer: jobs go to whichever printer is
+free, each printer gets streamer.py's flow control and reports its
+temperatures with M155, all in one asyncio loop.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from streamer import QUIET
+from streamer import TIMEOUT
+from streamer import PrinterError
+from streamer import Protocol
+from streamer import open_serial
+from marlin import BAUDRATE
+from marlin import CONFIG_DIR
+from marlin import load_profile
+from machine_state import MachineState
+from telemetry import Telemetry
+import fake_printer
+
+TEMP_POLL = 5 # s between temperature reports, M155 S
+# Lines read from the file ahead of what's been sent, so a big job doesn't
+# end up in memory
+WINDOW = 64
+STATUS_INTERVAL = 10.0 # s
+HELLO_TIMEOUT = 10.0 # s, Marlin takes a couple of seconds after a reset
+
+OFFLINE = 'offline'
+CONNECTING = 'connecting'
+IDLE = 'idle'
+PRINTING = 'printing'
+FAILED = 'failed'
+
+class Printer:
+    # Streamer, but driven by the event loop instead of select(), so one
+    # process can keep any number of them going
+    def __init__(
+        self,
+        name,
+        port,
+        baud=BAUDRATE,
+        timeout=TIMEOUT,
+        poll=TEMP_POLL,
+        **options
+        ):
+        self.name = name
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        self.poll = poll
+        self.options = options # for Protocol
+        self.fd = None
+        self.loop = None
+        self.protocol = None
+        self.out = b''
+        self.writing = False
+        self.greeting = b''
+        self.heard = 0.0
+        self.quiet_handle = None
+        self.changed = asyncio.Event()
+        self.state = OFFLINE
+        self.error = None
+        self.telemetry = Telemetry()
+        self.job = None
+        self.job_bytes = 0
+        self.read_bytes = 0
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.state = CONNECTING
+        self.fd = open_serial(self.port, self.baud)
+        self.loop.add_reader(self.fd, self.readable)
+        await asyncio.wait_for(self.hello(), HELLO_TIMEOUT)
+        self.protocol = Protocol(**self.options)
+        # AUTO_REPORT_TEMPERATURES, so nothing has to poll in between the
+        # moves
+        self.protocol.push(f"M155 S{self.poll}")
+        self.pump()
+        self.state = IDLE
+        INFO(f"{self.name}: connected on {self.port}")
+
+    async def hello(self):
+        # Opening the port resets most boards, and Marlin doesn't hear
+        # anything until it's booted. No line number, so it's fine whatever
+        # Marlin thinks the last one was.
+        while b'ok' not in self.greeting:
+            os.write(self.fd, b"M105\n")
+            try:
+                await asyncio.wait_for(self.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+        # Let the rest of the oks go by, the Protocol didn't ask for them
+        while True:
+            self.greeting = b''
+            await asyncio.sleep(0.2)
+            if len(self.greeting) == 0:
+                break
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.loop.remove_reader(self.fd)
+        if self.writing:
+            self.loop.remove_writer(self.fd)
+            self.writing = False
+        if self.quiet_handle is not None:
+            self.quiet_handle.cancel()
+            self.quiet_handle = None
+        os.close(self.fd)
+        self.fd = None
+        if self.state != FAILED:
+            self.state = OFFLINE
+
+    def fail(self, error):
+        ERROR(f"{self.name}: {error}")
+        self.error = error
+        self.state = FAILED
+        self.changed.set()
+
+    def readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.loop.remove_reader(self.fd)
+            return self.fail(PrinterError(f"{self.port}: {e}"))
+        self.heard = time.monotonic()
+        self.changed.set()
+        if self.protocol is None:
+            self.greeting += data
+            return
+        try:
+            messages = self.protocol.receive(data)
+        except PrinterError as e:
+            return self.fail(e)
+        for message in messages:
+            if self.telemetry.feed(message) is None:
+                DEBUG(f"{self.name} < {message}")
+        self.pump()
+
+    def pump(self):
+        # Send whatever the Protocol has room for, the rest when the port
+        # can take it
+        protocol = self.protocol
+        if self.fd is None or self.error is not None:
+            return
+        self.out += protocol.data()
+        if len(self.out) > 0:
+            try:
+                sent = os.write(self.fd, self.out)
+                self.out = self.out[sent:]
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                return self.fail(PrinterError(f"{self.port}: {e}"))
+        if len(self.out) > 0 and not self.writing:
+            self.loop.add_writer(self.fd, self.pump)
+            self.writing = True
+        elif len(self.out) == 0 and self.writing:
+            self.loop.remove_writer(self.fd)
+            self.writing = False
+        if (
+            protocol.holding is not None
+            and len(self.out) == 0
+            and self.quiet_handle is None
+            ):
+            # No tcdrain() here, it blocks. Character counting keeps less
+            # than the RX buffer in the kernel, so QUIET covers it.
+            self.quiet_handle = self.loop.call_later(QUIET, self.check_quiet)
+
+    def check_quiet(self):
+        self.quiet_handle = None
+        if self.protocol.holding is None:
+            return
+        wait = self.heard + QUIET - time.monotonic()
+        if wait > 0.0:
+            self.quiet_handle = self.loop.call_later(wait, self.check_quiet)
+            return
+        self.protocol.quiet()
+        self.pump()
+
+    async def wait(self):
+        # Until something comes in from the printer
+        self.changed.clear()
+        await self.changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    async def watch(self):
+        # For oks that never came
+        while self.error is None:
+            await asyncio.sleep(1.0)
+            protocol = self.protocol
+            now = time.monotonic()
+            if (
+                len(protocol.in_flight) > 0
+                and now - self.heard > self.timeout
+                ):
+                WARNING(f"{self.name}: No ok for {self.timeout} s")
+                protocol.lost()
+                self.heard = now
+                self.pump()
+
+    async def print_file(self, file_name):
+        INFO(f"{self.name}: printing {file_name}")
+        protocol = self.protocol
+        self.state = PRINTING
+        self.job = file_name
+        self.job_bytes = os.path.getsize(file_name)
+        self.read_bytes = 0
+        start = time.monotonic()
+        (lines, resends) = (protocol.lines, protocol.resends)
+        with open(file_name, 'r') as fh:
+            for g_code in fh:
+                while len(protocol.pending) >= WINDOW:
+                    await self.wait()
+                protocol.push(g_code)
+                self.read_bytes += len(g_code)
+                self.pump()
+        while not protocol.done or len(self.out) > 0:
+            await self.wait()
+        elapsed = time.monotonic() - start
+        INFO(f"{self.name}: finished {file_name} in {elapsed:0.1f} s")
+        self.state = IDLE
+        self.job = None
+        return {
+            'file': file_name,
+            'printer': self.name,
+            'seconds': elapsed,
+            'lines': protocol.lines - lines,
+            'resends': protocol.resends - resends,
+            }
+
+    async def work(self, queue, results):
+        # Jobs off the queue until it's empty or something goes wrong
+        try:
+            await self.connect()
+        except (OSError, PrinterError, asyncio.TimeoutError) as e:
+            self.fail(e if isinstance(e, PrinterError) else PrinterError(
+                f"{self.port}: no answer"
+                ))
+            self.close()
+            return
+        watcher = asyncio.create_task(self.watch())
+        try:
+            while not queue.empty():
+                file_name = queue.get_nowait()
+                try:
+                    results.append(await self.print_file(file_name))
+                except PrinterError as e:
+                    # Whatever's on the bed needs a person, so the job
+                    # doesn't go to another printer
+                    results.append({
+                        'file': file_name,
+                        'printer': self.name,
+                        'error': str(e),
+                        })
+                    break
+        finally:
+            watcher.cancel()
+            self.close()
+
+    def status(self):
+        status = {
+            'name': self.name,
+            'port': self.port,
+            'state': self.state,
+            'temps': self.telemetry.last_temps(),
+            }
+        if self.job is not None:
+            status['job'] = self.job
+            status['progress'] = self.read_bytes / max(self.job_bytes, 1)
+        if self.error is not None:
+            status['error'] = str(self.error)
+        return status
+
+    def status_line(self):
+        words = [f"{self.name}: {self.state}"]
+        if self.job is not None:
+            words.append(
+                f"{self.job} {self.read_bytes / max(self.job_bytes, 1):0.0%}"
+                )
+        for heater, (actual, target) in sorted(self.telemetry.last_temps().items()):
+            words.append(f"{heater} {actual:0.0f}/{target or 0.0:0.0f}")
+        return ' '.join(words)
+
+async def report(printers, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for printer in printers:
+            INFO(printer.status_line())
+
+async def run(printers, jobs, interval=STATUS_INTERVAL):
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    results = []
+    reporter = asyncio.create_task(report(printers, interval))
+    try:
+        await asyncio.gather(*(
+            printer.work(queue, results) for printer in printers
+            ))
+    finally:
+        reporter.cancel()
+    while not queue.empty():
+        results.append({'file': queue.get_nowait(), 'error': "no printer"})
+    return results
+
+def printer_arg(text):
+    (name, sep, port) = text.partition('=')
+    if sep == '':
+        (name, port) = (os.path.basename(text), text)
+    return (name, port)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Print a queue of gcode files on several printers'
+        )
+    arguments.add_argument(
+        'jobs',
+        metavar='job.gcode',
+        type=str,
+        nargs='+',
+        help="Gcode files, printed in order as printers come free",
+        )
+    arguments.add_argument(
+        '--printer',
+        type=printer_arg,
+        metavar='NAME=PORT',
+        action='append',
+        default=[],
+        help="A printer's serial port, like left=/dev/ttyUSB0",
+        )
+    arguments.add_argument(
+        '--fake',
+        type=int,
+        metavar='N',
+        help="Add N fake_printer.py printers",
+        default=0,
+        )
+    arguments.add_argument(
+        '--speed',
+        type=float,
+        help="For --fake, how much faster than real they go (default: %(default)s)",
+        default=1.0,
+        )
+    arguments.add_argument(
+        '--error-rate',
+        type=float,
+        help="For --fake, fraction of lines to corrupt (default: %(default)s)",
+        default=0.0,
+        )
+    arguments.add_argument(
+        '--baud',
+        type=int,
+        help="(default: from the config)",
+        default=None,
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Buffer sizes from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--poll',
+        type=int,
+        help="Seconds between temperature reports, M155 S"
+        " (default: %(default)s)",
+        default=TEMP_POLL,
+        )
+    arguments.add_argument(
+        '--status-interval',
+        type=float,
+        help="Seconds between status lines (default: %(default)s)",
+        default=STATUS_INTERVAL,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if len(args.printer) == 0 and args.fake == 0:
+        arguments.error("Need at least one --printer or --fake")
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    baud = args.baud or profile.baudrate
+    options = dict(
+        baud=baud,
+        poll=args.poll,
+        rx_buffer_size=profile.rx_buffer_size,
+        bufsize=profile.bufsize,
+        advanced_ok=profile.advanced_ok,
+        )
+    ports = list(args.printer)
+    stops = []
+    for i in range(args.fake):
+        (port, stop) = fake_printer.start(fake_printer.FakePrinter(
+            rx_buffer_size=profile.rx_buffer_size,
+            bufsize=profile.bufsize,
+            block_buffer_size=profile.block_buffer_size,
+            baud=baud,
+            advanced_ok=profile.advanced_ok,
+            error_rate=args.error_rate,
+            speed=args.speed,
+            ))
+        ports.append((f"fake{i}", port))
+        stops.append(stop)
+    printers = [Printer(name, port, **options) for (name, port) in ports]
+    try:
+        results = asyncio.run(run(printers, args.jobs, args.status_interval))
+    finally:
+        for stop in stops:
+            stop.set()
+    json.dump({
+        'printers': [printer.status() for printer in printers],
+        'jobs': results,
+        }, sys.stdout, indent=1)
+    print()
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -75,22 +75,9 @@ function hello {
 }
 
 function commcheck {
-	max=$((96-6)) # -6 for "M118 \n"
-	send M118 $r
-	for (( l = 0; l < max ; l++ )) ; do
-	for i in {1..100} ; do
-		s="$RANDOM$RANDOM$RANDOM$RANDOM$RANDOM"
-		s="$s$s$s$s$s"
-		s="${s:0:l}"
-		send M118 $s >/dev/null
-		while [[ "$RESPONSE" != *$s* ]] ; do
-			IFS='' read -sr RESPONSE <&99 || true
-			#echo "< $RESPONSE"
-		done
-	done
-		echo "l=$l passed"
-	done
-	ok
+	# Latency, lines/s and resends for each length and pipelining depth
+	python3 "$(dirname "${BASH_SOURCE[0]}")/commcheck.py" "$SERIAL" \
+		> "commcheck-$(date +%Y%m%d-%H%M%S).json"
 }
 
 function main {
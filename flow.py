@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# flow.py -- Print as fast as the hotend can melt plastic
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./flow.py <input.gcode> [-o output.gcode] [--max-flow mm3/s]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+from math import pi
+
+import numpy
+
+from mutator import FeedrateMutator
+from script import Script
+from columns import Columns
+from columns import E
+from machine_state import MachineState
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+# From marlin_config/Configuration.h
+FILAMENT_DIAMETER = 1.75 # mm, DEFAULT_NOMINAL_FILAMENT_DIA
+# What a stock E3D V6 style hotend can melt with PLA
+MAX_FLOW = 11.0 # mm^3/s
+# Only speed up moves this far under MAX_FLOW, and only up to it
+HEADROOM = 0.9
+MAX_SPEEDUP = 1.5 # times the slicer's feedrate
+MAX_PRINT_SPEED = 100.0 # mm/s
+
+class FlowLimit(FeedrateMutator):
+    def __init__(
+        self,
+        script,
+        max_flow=MAX_FLOW,
+        filament_diameter=FILAMENT_DIAMETER,
+        headroom=HEADROOM,
+        max_speedup=MAX_SPEEDUP,
+        max_speed=MAX_PRINT_SPEED,
+        profile=None,
+        ):
+        if profile is None:
+            profile = load_profile()
+        self.profile = profile
+        self.max_flow = max_flow # mm^3/s
+        self.filament_diameter = filament_diameter # mm
+        self.headroom = headroom
+        self.max_speedup = max_speedup
+        self.max_speed = max_speed # mm/s
+        super().__init__(script)
+
+    def plan(self):
+        columns = Columns(self.original)
+        delta = columns.delta
+        dist = columns.dist_xyz
+        area = pi * (self.filament_diameter / 2.0) ** 2
+        speed = columns.feedrate * columns.feedrate_mult # mm/s
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            extrudes = (
+                columns.is_move
+                & (dist > 0.0)
+                & (delta[:, E] > 0.0)
+                & (speed > 0.0)
+                )
+            # mm^3 per mm of head movement
+            volume = delta[:, E] * columns.flowrate_mult * area / dist
+            flow = volume * speed # mm^3/s
+            flow_speed = self.max_flow / volume
+        # Every axis including E under its M203 limit
+        axis_speed = columns.axis_speed(self.profile.max_feedrate)
+        faster = numpy.minimum.reduce([
+            speed * self.max_speedup,
+            flow_speed * self.headroom,
+            axis_speed,
+            numpy.full(len(speed), self.max_speed),
+            ])
+        new_speed = speed.copy()
+        capped = extrudes & (flow > self.max_flow)
+        new_speed[capped] = flow_speed[capped]
+        raised = (
+            extrudes
+            & (flow < self.max_flow * self.headroom)
+            & (faster > speed)
+            )
+        new_speed[raised] = faster[raised]
+        # Back to what the F word should say
+        self.feedrate = columns.feedrate.copy()
+        changed = capped | raised
+        self.feedrate[changed] = (
+            new_speed[changed] / columns.feedrate_mult[changed]
+            )
+        self.changed = changed
+        old_time = numpy.sum(dist[changed] / speed[changed])
+        new_time = numpy.sum(dist[changed] / new_speed[changed])
+        self.saved = old_time - new_time
+        INFO(f"Capped {capped.sum()} moves over {self.max_flow} mm^3/s")
+        INFO(f"Sped up {raised.sum()} moves")
+        if extrudes.any():
+            INFO(
+                f"Max flow: {numpy.max(flow[extrudes]):0.2f} ->"
+                f" {numpy.max((volume * new_speed)[extrudes]):0.2f} mm^3/s"
+                )
+        INFO(f"Estimated time saved: {self.saved:0.1f} s")
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Limit (and raise) feedrates to the hotend\'s max flow'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input_flow.gcode)",
+        )
+    arguments.add_argument(
+        '--max-flow',
+        type=float,
+        help="(mm^3/s) (default: %(default)s)",
+        default=MAX_FLOW,
+        )
+    arguments.add_argument(
+        '--filament-diameter',
+        type=float,
+        help="(mm) (default: %(default)s)",
+        default=FILAMENT_DIAMETER,
+        )
+    arguments.add_argument(
+        '--headroom',
+        type=float,
+        help="Only speed up to this fraction of --max-flow"
+        " (default: %(default)s)",
+        default=HEADROOM,
+        )
+    arguments.add_argument(
+        '--max-speedup',
+        type=float,
+        help="Times the original feedrate (1 disables) (default: %(default)s)",
+        default=MAX_SPEEDUP,
+        )
+    arguments.add_argument(
+        '--max-speed',
+        type=float,
+        help="(mm/s) Don't speed up printing moves past this"
+        " (default: %(default)s)",
+        default=MAX_PRINT_SPEED,
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    if args.output is None:
+        args.output = '_flow.'.join(args.input.rsplit('.', 1))
+    script = Script.from_file(args.input)
+    flow = FlowLimit(
+        script,
+        max_flow=args.max_flow,
+        filament_diameter=args.filament_diameter,
+        headroom=args.headroom,
+        max_speedup=args.max_speedup,
+        max_speed=args.max_speed,
+        profile=profile,
+        )
+    flow.to_file(args.output)
+    print(f"Estimated time saved: {flow.saved:0.1f} s")
+
+if __name__ == '__main__':
+    main()
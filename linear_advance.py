@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# linear_advance.py -- Apply linear advance on the host
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+from command import parse
+from commands import Move
+from commands import LinearAdvanceFactor
+from mutator import Mutator
+from planner import Planner
+
+# Segments shorter than this get merged into their neighbour
+MIN_SEGMENT_MM = 0.2
+
+# Does what Marlin's LIN_ADVANCE does, so it can be turned off (M900 K0)
+# and the stepper ISR doesn't have to. The pressure in the nozzle is K times
+# the extrusion rate, so printing moves get split where the planner stops
+# accelerating and starts decelerating, and each piece gets the change in
+# pressure added to its E.
+class LinearAdvance(Mutator):
+    def __init__(self, script, k=None, min_segment=MIN_SEGMENT_MM):
+        self.k = k
+        self.min_segment = min_segment
+        self.pressure = 0.0 # mm of filament, also how far E is shifted
+        self.split = 0
+        super().__init__(script)
+
+    def process(self):
+        self.planner = Planner(self.original)
+        self.disabled = False
+        super().process()
+        INFO(f"Split {self.split} moves for linear advance")
+        if self.pressure != 0.0:
+            WARNING(f"Ended with {self.pressure:0.5} mm of pressure advance")
+
+    def get_k(self, command):
+        if self.k is not None:
+            return self.k
+        if command.before.la_k is not None:
+            return command.before.la_k
+        return 0.0
+
+    def disable_firmware(self, ci, old):
+        self.replace(ci, old, [
+            parse("M900 K0 ; linear advance applied by linear_advance.py")
+            ])
+
+    def shifted(self, ci, old):
+        position = list(old.after.position)
+        if position[3] is not None:
+            position[3] += self.pressure
+        feedrate = None
+        if hasattr(old, 'F'):
+            feedrate = old.F / 60.0
+        self.replace(ci, old, [
+            Move.to(self.state, position, feedrate, old.comment)
+            ])
+
+    def segments(self, block):
+        segments = [s for s in block.segments if s[0] > 0.0]
+        merged = []
+        for distance, start, end in segments:
+            if len(merged) > 0 and distance < self.min_segment:
+                merged[-1] = (merged[-1][0] + distance, merged[-1][1], end)
+            elif (
+                len(merged) > 0
+                and merged[-1][0] < self.min_segment
+                ):
+                merged[-1] = (merged[-1][0] + distance, merged[-1][1], end)
+            else:
+                merged.append((distance, start, end))
+        return merged
+
+    def advance(self, ci, old, block):
+        k = self.get_k(old)
+        if block.next is not None and block.next.extrudes:
+            next_ratio = block.next.e_ratio
+        else:
+            next_ratio = 0.0
+        start = old.before.position
+        segments = self.segments(block)
+        if len(segments) > 1:
+            self.split += 1
+        travelled = 0.0
+        for si, (distance, _, end_speed) in enumerate(segments):
+            travelled += distance
+            if si == len(segments) - 1:
+                self.pressure = k * next_ratio * end_speed
+                position = list(old.after.position)
+            else:
+                self.pressure = k * block.e_ratio * end_speed
+                position = [
+                    start[ai] + block.unit[ai] * travelled
+                    for ai in range(4)
+                    ]
+            position[3] += self.pressure
+            if si == 0:
+                if hasattr(old, 'F'):
+                    feedrate = old.F / 60.0
+                else:
+                    feedrate = None
+                comment = old.comment
+            else:
+                feedrate = None
+                comment = None
+            self.replace(ci, old, [
+                Move.to(self.state, position, feedrate, comment)
+                ])
+
+    def process_command(self, ci, old):
+        if isinstance(old, LinearAdvanceFactor):
+            self.disabled = True
+            return self.disable_firmware(ci, old)
+        if not isinstance(old, Move):
+            return self.keep(ci, old)
+        if not self.disabled:
+            # Nothing's moved yet, so it's early enough
+            self.disabled = True
+            self.disable_firmware(ci, old)
+        block = self.planner[old]
+        if (
+            block is not None
+            and block.extrudes
+            and old.before.pos_vec is not None
+            ):
+            return self.advance(ci, old, block)
+        if self.pressure != 0.0:
+            return self.shifted(ci, old)
+        return self.keep(ci, old)
@@ -27,6 +27,8 @@ class Axis:
         self.max = None
         self.accel_limit = None
         self.speed_limit = None
+        self.jerk = None
+        self.steps_per_unit = None
     
     def __init__(self, other=None):
         if other is None:
@@ -34,14 +36,26 @@ class Axis:
         else:
             self.__dict__.update(other.__dict__)
     
-    def set_offset(self, off):
-        if self.position is None:
+    def copy(self):
+        # Skips __init__, MachineState copies four of these for every command
+        new = Axis.__new__(Axis)
+        new.__dict__ = self.__dict__.copy()
+        return new
+    
+    def set_offset(self, off, reference=True):
+        if self.position is None and not reference:
+            # The extruder is wherever G92 says it is, there's no home
+            self.position = off
+            self.offset = 0.0
+        elif self.position is None:
             self.offset = 0.0 - off
         else:
             self.offset = self.position - off
     
     def relative_move(self, amount):
-        self.position += amount
+        # Moving from somewhere unknown still ends up somewhere unknown
+        if self.position is not None:
+            self.position += amount
     
     def absolute_move(self, amount):
         self.position = self.offset + amount
@@ -51,6 +65,8 @@ class Axis:
             self.relative_move(amount)
         else:
             self.absolute_move(amount)
+        if self.position is None:
+            return
         if self.min is None or self.position < self.min:
             self.min = self.position
         if self.max is None or self.position > self.max:
@@ -58,6 +74,9 @@ class Axis:
         assert self.max >= self.min
     
 class MachineState:
+    # What the printer starts with, from marlin.load_profile()
+    profile = None
+
     def reset(self):
         self.x = Axis()
         self.y = Axis()
@@ -82,16 +101,26 @@ class MachineState:
         self.max_e_xy = None
         self.min_e_xy = None
         self.frequency_limit = None
+        if self.profile is not None:
+            self.profile.apply(self)
+
+    @classmethod
+    def profile_settings(cls):
+        # What the profile says, for telling apart things worked out with
+        # different ones. None without one, like when used as a library.
+        if cls.profile is None:
+            return None
+        return vars(cls.profile)
 
     def __init__(self, other=None):
         if other is None:
             self.reset()
         else:
             self.__dict__.update(other.__dict__)
-            self.x = Axis(other.x)
-            self.y = Axis(other.y)
-            self.z = Axis(other.z)
-            self.e = Axis(other.e)
+            self.x = other.x.copy()
+            self.y = other.y.copy()
+            self.z = other.z.copy()
+            self.e = other.e.copy()
 
     @property
     def axes(self):
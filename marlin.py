@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+# marlin.py -- Read the printer's limits out of Marlin's configuration headers
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./marlin.py [marlin_config/] [NAME ...]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import json
+import os
+import re
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'marlin_config')
+# Marlin includes them in this order
+HEADERS = ('Configuration.h', 'Configuration_adv.h')
+CACHE = '.profile.json'
+
+# For anything the headers don't define, what marlin_config/ has. The
+# tools all read these through load_profile(), not on their own.
+BAUDRATE = 500000
+BLOCK_BUFFER_SIZE = 32 # planner blocks, one is always left empty
+BUFSIZE = 4 # commands
+RX_BUFFER_SIZE = 128 # bytes, one is always left empty
+MIN_SEGMENT_TIME = 0.02 # s, DEFAULT_MINSEGMENTTIME with SLOWDOWN
+MIN_STEPS_PER_SEGMENT = 6 # shorter than this and Marlin drops the move
+STEPS_PER_UNIT = (80.0, 80.0, 400.0, 99.4) # XYZE
+MAX_FEEDRATE = (250.0, 250.0, 5.0, 25.0) # mm/s XYZE
+
+TOKEN = re.compile(r"""
+    (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?[uUlLfF]*)
+    | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<name>[A-Za-z_]\w*)
+    | (?P<op>&&|\|\||==|!=|<=|>=|<<|>>|[-+*/%<>!(){},?:~&|^])
+    | (?P<space>\s+)
+    """, re.VERBOSE)
+
+PY_OPS = {
+    '&&': ' and ',
+    '||': ' or ',
+    '!': ' not ',
+    '{': '(',
+    '}': ',)',
+    }
+
+def tokens(text):
+    pos = 0
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None:
+            raise ValueError(f"Can't tokenize: {text[pos:]}")
+        pos = match.end()
+        if match.lastgroup != 'space':
+            yield (match.lastgroup, match.group())
+
+def strip_comments(lines):
+    # Joins continued lines and removes // and /* */ comments
+    in_comment = False
+    pending = ''
+    for line in lines:
+        line = line.rstrip('\n')
+        out = ''
+        i = 0
+        while i < len(line):
+            if in_comment:
+                end = line.find('*/', i)
+                if end < 0:
+                    i = len(line)
+                else:
+                    in_comment = False
+                    i = end + 2
+            elif line.startswith('/*', i):
+                in_comment = True
+                i += 2
+            elif line.startswith('//', i):
+                break
+            elif line[i] == '"':
+                end = line.find('"', i + 1)
+                while end > 0 and line[end-1] == '\\':
+                    end = line.find('"', end + 1)
+                if end < 0:
+                    end = len(line) - 1
+                out += line[i:end+1]
+                i = end + 1
+            else:
+                out += line[i]
+                i += 1
+        if out.endswith('\\'):
+            pending += out[:-1] + ' '
+            continue
+        yield pending + out
+        pending = ''
+
+class Config:
+    def __init__(self, defines=None):
+        self.defines = dict() if defines is None else dict(defines)
+
+    @classmethod
+    def from_dir(cls, config_dir=CONFIG_DIR, headers=HEADERS):
+        config = cls()
+        for header in headers:
+            config.read(os.path.join(config_dir, header))
+        return config
+
+    def read(self, file_name):
+        with open(file_name, 'r', encoding='utf-8', errors='replace') as fh:
+            self.preprocess(strip_comments(fh), file_name)
+
+    def preprocess(self, lines, file_name=None):
+        # Each #if level is (taking this branch, taken a branch already,
+        # outer levels all taking theirs)
+        stack = []
+        active = True
+        for ln, line in enumerate(lines):
+            line = line.strip()
+            if not line.startswith('#'):
+                continue
+            (directive, _, rest) = line[1:].strip().partition(' ')
+            rest = rest.strip()
+            if directive in ('if', 'ifdef', 'ifndef'):
+                if directive == 'ifdef':
+                    taking = rest in self.defines
+                elif directive == 'ifndef':
+                    taking = rest not in self.defines
+                else:
+                    taking = active and self.condition(rest, file_name, ln)
+                stack.append((active and taking, taking, active))
+            elif directive == 'elif':
+                (_, taken, outer) = stack.pop()
+                taking = (
+                    outer
+                    and not taken
+                    and self.condition(rest, file_name, ln)
+                    )
+                stack.append((taking, taken or taking, outer))
+            elif directive == 'else':
+                (_, taken, outer) = stack.pop()
+                stack.append((outer and not taken, True, outer))
+            elif directive == 'endif':
+                stack.pop()
+            elif not active:
+                pass
+            elif directive == 'define':
+                self.define(rest)
+            elif directive == 'undef':
+                self.defines.pop(rest, None)
+            elif directive == 'error':
+                WARNING(f"{file_name}:{ln+1}: #error {rest}")
+            if len(stack) > 0:
+                active = stack[-1][0]
+            else:
+                active = True
+        if len(stack) > 0:
+            WARNING(f"{file_name}: {len(stack)} #if without #endif")
+
+    def define(self, rest):
+        match = re.match(r"(\w+)(\([^)]*\))?\s*(.*)", rest)
+        (name, params, body) = match.groups()
+        if params is not None:
+            # Function-like, only ever used in #if and there they're unknown
+            name += '()'
+        self.defines[name] = body.strip()
+
+    def enabled(self, name):
+        # Like Marlin's ENABLED(), only empty, 1 or true count
+        return self.defines.get(name, None) in ('', '1', 'true')
+
+    def expand(self, text, unknown, seen=()):
+        out = []
+        toks = list(tokens(text))
+        i = 0
+        while i < len(toks):
+            (kind, tok) = toks[i]
+            i += 1
+            if kind == 'number':
+                out.append(tok.rstrip('uUlLfF') or '0')
+            elif kind == 'string':
+                out.append(tok)
+            elif kind == 'op':
+                out.append(PY_OPS.get(tok, tok))
+            elif tok == 'defined':
+                if toks[i] == ('op', '('):
+                    name = toks[i+1][1]
+                    i += 3
+                else:
+                    name = toks[i][1]
+                    i += 1
+                out.append(repr(name in self.defines))
+            elif i < len(toks) and toks[i] == ('op', '('):
+                # A macro call, find its arguments
+                depth = 0
+                args = []
+                for j in range(i, len(toks)):
+                    if toks[j][1] == '(':
+                        depth += 1
+                    elif toks[j][1] == ')':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    if depth == 1 and toks[j][1] in ('(', ','):
+                        args.append([])
+                    else:
+                        args[-1].append(toks[j][1])
+                args = [''.join(arg) for arg in args]
+                i = j + 1
+                out.append(self.call(tok, args, unknown))
+            elif tok in ('true', 'false'):
+                out.append(repr(tok == 'true'))
+            elif tok in self.defines and tok not in seen:
+                body = self.defines[tok]
+                if body == '':
+                    out.append('1')
+                else:
+                    out.append(f"({self.expand(body, unknown, seen + (tok,))})")
+            else:
+                out.append(unknown(tok))
+        return ' '.join(out)
+
+    def call(self, macro, args, unknown):
+        enabled = [self.enabled(arg) for arg in args]
+        if macro == 'ENABLED':
+            return repr(enabled[0])
+        if macro == 'DISABLED':
+            return repr(not enabled[0])
+        if macro in ('ANY', 'EITHER'):
+            return repr(any(enabled))
+        if macro in ('ALL', 'BOTH'):
+            return repr(all(enabled))
+        if macro == 'NONE':
+            return repr(not any(enabled))
+        # HAS_DRIVER(), PIN_EXISTS()... are all Marlin internals
+        return unknown(macro)
+
+    def evaluate(self, text, unknown):
+        return eval(self.expand(text, unknown), {'__builtins__': {}})
+
+    def condition(self, text, file_name=None, ln=0):
+        # Like the preprocessor, anything not defined is 0
+        try:
+            return bool(self.evaluate(text, lambda name: '0'))
+        except Exception as e:
+            WARNING(f"{file_name}:{ln+1}: Can't evaluate #if {text}: {e}")
+            return False
+
+    def __contains__(self, name):
+        return name in self.defines
+
+    def __getitem__(self, name):
+        # The value as a Python number, tuple or string, or the text itself
+        # for things like MOTHERBOARD BOARD_RAMPS_14_EFB
+        body = self.defines[name]
+        if body == '':
+            return True
+        def unknown(tok):
+            raise NameError(tok)
+        try:
+            return self.evaluate(body, unknown)
+        except Exception:
+            return body
+
+    def get(self, name, default=None):
+        if name not in self.defines:
+            return default
+        return self[name]
+
+class MachineProfile:
+    def __init__(self, config):
+        self.name = config.get('CUSTOM_MACHINE_NAME')
+        self.motherboard = config.get('MOTHERBOARD')
+        self.baudrate = config.get('BAUDRATE', BAUDRATE)
+        self.steps_per_unit = tuple(config.get(
+            'DEFAULT_AXIS_STEPS_PER_UNIT',
+            STEPS_PER_UNIT,
+            ))[:4]
+        self.max_feedrate = tuple(config.get(
+            'DEFAULT_MAX_FEEDRATE',
+            MAX_FEEDRATE,
+            ))[:4] # mm/s
+        self.max_acceleration = tuple(config['DEFAULT_MAX_ACCELERATION'])[:4]
+        self.print_accel = config['DEFAULT_ACCELERATION'] # mm/s^2
+        self.retract_accel = config.get('DEFAULT_RETRACT_ACCELERATION')
+        self.travel_accel = config.get('DEFAULT_TRAVEL_ACCELERATION')
+        if config.enabled('CLASSIC_JERK'):
+            self.jerk = tuple(
+                config[f"DEFAULT_{axis}JERK"] for axis in 'XYZ'
+                ) + (config['DEFAULT_EJERK'],) # mm/s
+            self.junction_deviation = None
+        else:
+            self.jerk = (None, None, None, config.get('DEFAULT_EJERK'))
+            self.junction_deviation = config.get('JUNCTION_DEVIATION_MM')
+        self.frequency_limit = config.get('XY_FREQUENCY_LIMIT') # Hz
+        self.bed_size = (config['X_BED_SIZE'], config['Y_BED_SIZE']) # mm
+        self.min_pos = tuple(config[f"{axis}_MIN_POS"] for axis in 'XYZ')
+        self.max_pos = tuple(config[f"{axis}_MAX_POS"] for axis in 'XYZ')
+        self.min_software_endstops = config.enabled('MIN_SOFTWARE_ENDSTOPS')
+        self.max_software_endstops = config.enabled('MAX_SOFTWARE_ENDSTOPS')
+        self.filament_diameter = config.get('DEFAULT_NOMINAL_FILAMENT_DIA')
+        if config.enabled('PREVENT_COLD_EXTRUSION'):
+            self.extrude_mintemp = config.get('EXTRUDE_MINTEMP')
+        else:
+            self.extrude_mintemp = None
+        if config.enabled('PREVENT_LENGTHY_EXTRUDE'):
+            self.extrude_maxlength = config.get('EXTRUDE_MAXLENGTH')
+        else:
+            self.extrude_maxlength = None
+        self.head_maxtemp = config.get('HEATER_0_MAXTEMP')
+        self.bed_maxtemp = config.get('BED_MAXTEMP')
+        # Marlin won't heat closer to MAXTEMP than these, the defaults are
+        # from Conditionals_post.h
+        self.head_overshoot = config.get('HOTEND_OVERSHOOT', 15)
+        self.bed_overshoot = config.get('BED_OVERSHOOT', 10)
+        self.block_buffer_size = config.get('BLOCK_BUFFER_SIZE', BLOCK_BUFFER_SIZE)
+        self.bufsize = config.get('BUFSIZE', BUFSIZE)
+        self.rx_buffer_size = config.get('RX_BUFFER_SIZE', RX_BUFFER_SIZE)
+        self.advanced_ok = config.enabled('ADVANCED_OK')
+        self.slowdown = config.enabled('SLOWDOWN')
+        self.min_segment_time = config.get(
+            'DEFAULT_MINSEGMENTTIME',
+            MIN_SEGMENT_TIME * 1e6,
+            ) / 1e6 # s
+        self.min_steps_per_segment = config.get(
+            'MIN_STEPS_PER_SEGMENT',
+            MIN_STEPS_PER_SEGMENT,
+            )
+        self.linear_advance_k = None
+        if config.enabled('LIN_ADVANCE'):
+            self.linear_advance_k = config.get('LIN_ADVANCE_K')
+        self.s_curve = config.enabled('S_CURVE_ACCELERATION')
+        self.adaptive_step_smoothing = config.enabled('ADAPTIVE_STEP_SMOOTHING')
+
+    def apply(self, state):
+        # What the printer starts with before the gcode sets anything
+        for ai, axis in enumerate(state.axes):
+            axis.speed_limit = self.max_feedrate[ai]
+            axis.accel_limit = self.max_acceleration[ai]
+            axis.jerk = self.jerk[ai]
+            axis.steps_per_unit = self.steps_per_unit[ai]
+        state.print_accel = self.print_accel
+        state.retract_accel = self.retract_accel
+        state.travel_accel = self.travel_accel
+        state.frequency_limit = self.frequency_limit
+        if self.linear_advance_k is not None:
+            state.la_k = self.linear_advance_k
+
+    def __repr__(self):
+        return f"MachineProfile({self.__dict__!r})"
+
+# One per config directory, they don't change while we're running
+_profiles = dict()
+
+def header_stamps(config_dir, headers=HEADERS):
+    stamps = dict()
+    for header in headers:
+        stat = os.stat(os.path.join(config_dir, header))
+        stamps[header] = [stat.st_mtime_ns, stat.st_size]
+    return stamps
+
+def load_config(config_dir=CONFIG_DIR, headers=HEADERS):
+    # Preprocessing 6000 lines of headers takes a while, so keep the
+    # defines next to them until the headers change
+    stamps = header_stamps(config_dir, headers)
+    cache_file = os.path.join(config_dir, CACHE)
+    try:
+        with open(cache_file, 'r') as fh:
+            cached = json.load(fh)
+        if cached['stamps'] == stamps:
+            return Config(cached['defines'])
+    except (OSError, ValueError, KeyError):
+        pass
+    INFO(f"Reading {', '.join(headers)} from {config_dir}")
+    config = Config.from_dir(config_dir, headers)
+    try:
+        with open(cache_file, 'w') as fh:
+            json.dump({'stamps': stamps, 'defines': config.defines}, fh)
+    except OSError as e:
+        WARNING(f"Can't cache config: {e}")
+    return config
+
+def load_profile(config_dir=CONFIG_DIR):
+    config_dir = os.path.abspath(config_dir)
+    if config_dir not in _profiles:
+        _profiles[config_dir] = MachineProfile(load_config(config_dir))
+    return _profiles[config_dir]
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Show what Marlin\'s configuration headers define'
+        )
+    arguments.add_argument(
+        'config_dir',
+        metavar='marlin_config/',
+        nargs='?',
+        type=str,
+        help="Directory with Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        'names',
+        metavar='NAME',
+        nargs='*',
+        type=str,
+        help="Defines to show (default: the machine profile)",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if len(args.names) > 0:
+        config = load_config(args.config_dir)
+        for name in args.names:
+            print(f"{name} {config.get(name, '(not defined)')!r}")
+        return
+    profile = load_profile(args.config_dir)
+    for name, value in profile.__dict__.items():
+        print(f"{name}: {value!r}")
+
+if __name__ == '__main__':
+    main()
@@ -24,13 +24,24 @@ WARNING = logger.warning
 ERROR = logger.error
 CRITICAL = logger.critical
 
+import numpy
+
 from command import parse
+from command import unparse
+from commands import Move
 from machine_state import MachineState
 from script import Script
 
 class Mutator(Script):
+    # Mutators that only go by the commands themselves, not the state
+    # they're in, can skip analyzing in stream()
+    needs_state = True
+
     def keep(self, ci, old):
-        assert self.original[old.ln-1] is old
+        assert self.original is None or self.original[old.ln-1] is old
+        if not self.needs_state:
+            self.commands.append(old)
+            return
         new = old.copy()
         new.oln = old.oln
         self.commands.append(new)
@@ -39,22 +50,96 @@ class Mutator(Script):
     def replace(self, ci, old, replacements):
         for cj in range(len(replacements)):
             replacements[cj].oln = old.oln
-            self.analyze_one(replacements[cj])
+            if self.needs_state:
+                self.analyze_one(replacements[cj])
         self.commands.extend(replacements)
     
     def process(self):
         INFO(f"Processing: {self.__class__.__name__}")
+        self.state = MachineState()
         for ci in range(len(self.original)):
             self.process_command(ci, self.original[ci])
+        self.finish()
         for ci in range(len(self.commands)):
             self.commands[ci].ln = ci + 1
         INFO(f"Processed {self.commands[-1].ln} commands")
+        self.analyzed = True
+    
+    def finish(self):
+        # Emit anything process_command held back
+        pass
+    
+    def stream(self, commands):
+        # Like process(), but takes and yields one command at a time so only
+        # what process_command holds back is kept. Make the Mutator without
+        # a script to use this, and only from mutators that don't need to
+        # look at self.original.
+        INFO(f"Streaming: {self.__class__.__name__}")
+        self.original = None
+        self.state = MachineState()
+        before = MachineState()
+        ln = 0
+        for ci, old in enumerate(commands):
+            if old.after is None and self.needs_state:
+                before = old.evolve(before)
+            self.commands = []
+            self.process_command(ci, old)
+            for new in self.commands:
+                ln += 1
+                new.ln = ln
+                yield new
+        self.commands = []
+        self.finish()
+        for new in self.commands:
+            ln += 1
+            new.ln = ln
+            yield new
+        self.commands = None
+        INFO(f"Streamed {ln} commands")
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.analyze()
+        if self.commands is None:
+            return # for stream()
+        # Commands from another Script or Mutator have already been analyzed
+        if not self.analyzed:
+            self.analyze()
         self.original = self.commands
         self.commands = []
         self.process()
 
+# For mutators that work out every move's feedrate up front: plan() sets
+# self.feedrate (mm/s, nan to leave it alone) and self.changed, and this
+# rewrites the F words to match
+class FeedrateMutator(Mutator):
+    # On the moves that changed, instead of what they had
+    changed_comment = None
+
+    def plan(self):
+        raise NotImplementedError
+
+    def process(self):
+        self.plan()
+        super().process()
 
+    def process_command(self, ci, old):
+        if not isinstance(old, Move):
+            return self.keep(ci, old)
+        feedrate = self.feedrate[ci]
+        current = self.state.feedrate
+        if numpy.isnan(feedrate) or (
+            not self.changed[ci]
+            and (
+                hasattr(old, 'F')
+                or (current is not None and abs(current - feedrate) < 1e-3)
+                )
+            ):
+            return self.keep(ci, old)
+        # Either this one changed, or the one before it did and this one
+        # was depending on its F
+        args = old.args
+        args['F'] = feedrate * 60.0 # mm/m in gcode
+        comment = old.comment
+        if self.changed[ci] and self.changed_comment is not None:
+            comment = self.changed_comment
+        self.replace(ci, old, [parse(unparse(args, comment))])
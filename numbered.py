@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# numbered.py -- Write gcode with line numbers and checksums already on it
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./numbered.py <input.gcode> [-o output.gcode.numbered]
+Then: ./streamer.py /dev/ttyUSB0 output.gcode.numbered
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import time
+
+import numpy
+
+from streamer import INDEX_SUFFIX
+from streamer import NUMBERED_SUFFIX
+from streamer import strip
+
+# Lines encoded at once, the index arithmetic takes about 50 bytes for each
+# byte of gcode
+CHUNK = 1 << 16
+
+# "*cs\n" for every checksum, padded to the same width
+SUFFIXES = [f"*{cs}\n".encode('ascii') for cs in range(256)]
+SUFFIX_WIDTH = max(map(len, SUFFIXES))
+SUFFIX_TABLE = numpy.zeros((256, SUFFIX_WIDTH), dtype=numpy.uint8)
+for cs, suffix in enumerate(SUFFIXES):
+    SUFFIX_TABLE[cs, :len(suffix)] = numpy.frombuffer(suffix, dtype=numpy.uint8)
+SUFFIX_TABLE = SUFFIX_TABLE.ravel()
+SUFFIX_LENGTHS = numpy.array(list(map(len, SUFFIXES)), dtype=numpy.int64)
+
+def ragged(lengths):
+    # 0..length-1 for each length, all in one array
+    ends = numpy.cumsum(lengths)
+    return numpy.arange(ends[-1]) - numpy.repeat(ends - lengths, lengths)
+
+def gather(out, out_starts, buf, starts, lengths):
+    # out[out_starts[i]:][:lengths[i]] = buf[starts[i]:][:lengths[i]]
+    within = ragged(lengths)
+    out[numpy.repeat(out_starts, lengths) + within] = (
+        buf[numpy.repeat(starts, lengths) + within]
+        )
+
+def encode(lines, first=0):
+    # lines are already stripped and not empty. Returns the bytes of
+    # "N{n} {line}*{cs}\n" for each, n counting from first, and where each
+    # one starts plus where the last one ends.
+    count = len(lines)
+    text = '\n'.join(lines).encode('ascii')
+    buf = numpy.frombuffer(text, dtype=numpy.uint8)
+    lengths = numpy.fromiter(map(len, lines), dtype=numpy.int64, count=count)
+    starts = numpy.cumsum(lengths + 1) - (lengths + 1)
+    # XOR of a line is the running XOR at its end XOR the one before it
+    running = numpy.bitwise_xor.accumulate(buf)
+    line_xor = running[starts + lengths - 1] ^ numpy.where(
+        starts > 0,
+        running[numpy.maximum(starts - 1, 0)],
+        0,
+        )
+    # "N{n} " right aligned in rows of the same width
+    n = numpy.arange(first, first + count, dtype=numpy.int64)
+    width = len(str(first + count - 1))
+    powers = 10 ** numpy.arange(width - 1, -1, -1, dtype=numpy.int64)
+    digits = numpy.ones(count, dtype=numpy.int64)
+    for k in range(1, width):
+        digits += n >= 10 ** k
+    rows = numpy.zeros((count, width + 2), dtype=numpy.uint8)
+    rows[:, 1:width+1] = (n[:, None] // powers) % 10 + ord('0')
+    rows[:, width+1] = ord(' ')
+    skip = width - digits # leading zeros, the N goes on the last one
+    rows[numpy.arange(count), skip] = ord('N')
+    used = numpy.arange(width + 2)[None, :] >= skip[:, None]
+    prefix_xor = numpy.bitwise_xor.reduce(
+        numpy.where(used, rows, 0).astype(numpy.uint8),
+        axis=1,
+        )
+    prefix_lengths = digits + 2
+    prefix_starts = numpy.arange(count) * (width + 2) + skip
+    cs = (prefix_xor ^ line_xor).astype(numpy.int64)
+    suffix_lengths = SUFFIX_LENGTHS[cs]
+    total = prefix_lengths + lengths + suffix_lengths
+    out_starts = numpy.cumsum(total) - total
+    out = numpy.empty(int(total.sum()), dtype=numpy.uint8)
+    gather(out, out_starts, rows.ravel(), prefix_starts, prefix_lengths)
+    out_starts += prefix_lengths
+    gather(out, out_starts, buf, starts, lengths)
+    out_starts += lengths
+    gather(out, out_starts, SUFFIX_TABLE, cs * SUFFIX_WIDTH, suffix_lengths)
+    offsets = numpy.cumsum(total) - total
+    return (out, numpy.append(offsets, offsets[-1] + total[-1]))
+
+def chunks(g_codes, size=CHUNK):
+    # Stripped, non-empty lines, starting with M110 so the printer counts
+    # from 0 too
+    chunk = ['M110 N0']
+    for g_code in g_codes:
+        line = strip(g_code)
+        if len(line) == 0:
+            continue
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def write(g_codes, file_name):
+    # file_name gets the lines, file_name + INDEX_SUFFIX gets where each
+    # one starts as little endian int64, with the end of the file last
+    INFO(f"Saving {file_name} with line numbers and checksums")
+    start = time.perf_counter()
+    n = 0
+    offset = 0
+    with open(file_name, 'wb') as fh, \
+            open(file_name + INDEX_SUFFIX, 'wb') as index:
+        for chunk in chunks(g_codes):
+            (out, offsets) = encode(chunk, n)
+            fh.write(out.tobytes())
+            (offsets[:-1] + offset).astype('<i8').tofile(index)
+            n += len(chunk)
+            offset += int(offsets[-1])
+        numpy.array([offset], dtype='<i8').tofile(index)
+    INFO(
+        f"Saved {n - 1} lines ({offset} bytes)"
+        f" in {time.perf_counter() - start:0.2f} s"
+        )
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Number and checksum gcode ahead of time for streamer.py'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode.numbered',
+        type=str,
+        help=f"Output filename (default: input.gcode{NUMBERED_SUFFIX})",
+        )
+    args = arguments.parse_args()
+    if args.output is None:
+        args.output = args.input + NUMBERED_SUFFIX
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    with open(args.input, 'r') as fh:
+        write(fh, args.output)
+
+if __name__ == '__main__':
+    main()
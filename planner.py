@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# planner.py -- Model the firmware motion planner
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+from math import sqrt
+
+import numpy
+norm = numpy.linalg.norm
+
+from commands import Move
+
+# Used when the script doesn't set them, from marlin_config/Configuration.h
+DEFAULT_ACCELERATION = 500.0 # mm/s^2
+DEFAULT_JERK = (8.0, 8.0, 0.3, 2.5) # mm/s XYZE
+MINIMUM_PLANNER_SPEED = 0.05 # mm/s
+
+class Block:
+    def __init__(self, command):
+        self.command = command
+        before = command.before
+        after = command.after
+        self.delta = numpy.array([
+            0.0 if (a is None or b is None) else a - b
+            for a, b in zip(after.position, before.position)
+            ])
+        self.length = norm(self.delta[:3])
+        if self.length == 0.0:
+            self.length = abs(self.delta[3])
+        if self.length > 0.0:
+            self.unit = self.delta / self.length
+        else:
+            self.unit = numpy.zeros(4)
+        self.extrudes = (
+            self.delta[3] > 0.0
+            and norm(self.delta[:3]) > 0.0
+            )
+        if self.extrudes:
+            self.e_ratio = self.delta[3] / self.length
+        else:
+            self.e_ratio = 0.0
+        if self.delta[3] == 0.0:
+            accel = before.travel_accel
+        elif norm(self.delta[:3]) == 0.0:
+            accel = before.retract_accel
+        else:
+            accel = before.print_accel
+        if accel is None:
+            accel = DEFAULT_ACCELERATION
+        if before.feedrate is None:
+            nominal = float('inf')
+        else:
+            nominal = before.feedrate * before.feedrate_mult
+        self.jerk = list(DEFAULT_JERK)
+        for ai, axis in enumerate(before.axes):
+            if axis.jerk is not None:
+                self.jerk[ai] = axis.jerk
+            u = abs(self.unit[ai])
+            if u == 0.0:
+                continue
+            if axis.speed_limit is not None:
+                nominal = min(nominal, axis.speed_limit / u)
+            if axis.accel_limit is not None:
+                accel = min(accel, axis.accel_limit / u)
+        if nominal == float('inf'):
+            WARNING(f"No feedrate for: {command.g_code}")
+            nominal = DEFAULT_JERK[0]
+        self.nominal = nominal
+        self.accel = accel
+        self.entry = 0.0
+        self.exit = 0.0
+        self.stop_before = False
+        self.prev = None
+        self.next = None
+
+    @property
+    def safe_speed(self):
+        v = self.nominal
+        for ai in range(4):
+            dv = abs(self.unit[ai]) * v
+            if dv > self.jerk[ai]:
+                v *= self.jerk[ai] / dv
+        return max(v, MINIMUM_PLANNER_SPEED)
+
+    def junction_speed(self, prev):
+        if prev is None or self.stop_before:
+            return self.safe_speed
+        v = min(prev.nominal, self.nominal)
+        for ai in range(4):
+            dv = abs(prev.unit[ai] - self.unit[ai]) * v
+            if dv > self.jerk[ai]:
+                v *= self.jerk[ai] / dv
+        return max(v, MINIMUM_PLANNER_SPEED)
+
+    def plan(self):
+        a = self.accel
+        cruise = self.nominal
+        accel_distance = (cruise**2 - self.entry**2) / (2.0 * a)
+        decel_distance = (cruise**2 - self.exit**2) / (2.0 * a)
+        if accel_distance + decel_distance > self.length:
+            accel_distance = (
+                2.0 * a * self.length
+                + self.exit**2
+                - self.entry**2
+                ) / (4.0 * a)
+            accel_distance = min(max(accel_distance, 0.0), self.length)
+            decel_distance = self.length - accel_distance
+            cruise = sqrt(self.entry**2 + 2.0 * a * accel_distance)
+        self.cruise = cruise
+        self.accel_distance = accel_distance
+        self.decel_distance = decel_distance
+        self.cruise_distance = self.length - accel_distance - decel_distance
+        self.time = (
+            (cruise - self.entry) / a
+            + self.cruise_distance / cruise
+            + (cruise - self.exit) / a
+            )
+
+    @property
+    def segments(self):
+        # (distance, start speed, end speed) for accel, cruise and decel
+        return [
+            (self.accel_distance, self.entry, self.cruise),
+            (self.cruise_distance, self.cruise, self.cruise),
+            (self.decel_distance, self.cruise, self.exit),
+            ]
+
+class Planner:
+    def __init__(self, commands):
+        self.blocks = []
+        self.block_for = dict()
+        stop = True
+        for command in commands:
+            if isinstance(command, Move):
+                block = Block(command)
+                if block.length > 0.0:
+                    block.stop_before = stop
+                    stop = False
+                    if len(self.blocks) > 0:
+                        block.prev = self.blocks[-1]
+                        block.prev.next = block
+                    self.blocks.append(block)
+                    self.block_for[id(command)] = block
+            elif getattr(command, 'waits', False):
+                stop = True
+        self.plan()
+
+    def plan(self):
+        INFO(f"Planning {len(self.blocks)} blocks")
+        blocks = self.blocks
+        prev = None
+        for block in blocks:
+            block.entry = block.junction_speed(prev)
+            if prev is not None:
+                if block.stop_before:
+                    prev.exit = prev.safe_speed
+                else:
+                    prev.exit = block.entry
+            prev = block
+        if prev is not None:
+            prev.exit = prev.safe_speed
+        for block in reversed(blocks):
+            block.entry = min(
+                block.entry,
+                sqrt(block.exit**2 + 2.0 * block.accel * block.length)
+                )
+            if block.prev is not None and not block.stop_before:
+                block.prev.exit = block.entry
+        for block in blocks:
+            block.exit = min(
+                block.exit,
+                sqrt(block.entry**2 + 2.0 * block.accel * block.length)
+                )
+            if block.next is not None and not block.next.stop_before:
+                block.next.entry = block.exit
+            block.plan()
+
+    def __getitem__(self, command):
+        return self.block_for.get(id(command))
+
+    @property
+    def time(self):
+        return sum(block.time for block in self.blocks)
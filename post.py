@@ -28,7 +28,27 @@ CRITICAL = logger.critical
 import argparse
 
 from script import Script
+from reorder_retract import ReorderRetract
+from reorder_retract import WIPE_SPEED
+from decelerate import ExtrusionDecelerator
+from decelerate import SLOW_XY_RATE
+from decelerate import SLOW_BEFORE
 from smooth import Smooth
+from linear_advance import LinearAdvance
+from bed_mesh import BedMesh
+from bed_mesh import BedMeshCompensation
+from bed_mesh import MESH_MIN
+from bed_mesh import MESH_MAX
+from preheat import PredictivePreheat
+from flow import FlowLimit
+from travel_order import TravelOrder
+from step_rate import StepRateLimit
+from flow import FILAMENT_DIAMETER
+from thermal import HEATERS
+from thermal import load_heaters
+from machine_state import MachineState
+from marlin import CONFIG_DIR
+from marlin import load_profile
 
 def main():
     arguments = argparse.ArgumentParser(
@@ -40,6 +60,17 @@ def main():
         type=str,
         help="Input gcode filename"
         )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input_pp.gcode)",
+        )
+    arguments.add_argument(
+        '--numbered',
+        action='store_true',
+        help="Write line numbers and checksums for streamer.py, see numbered.py",
+        )
     arguments.add_argument(
         '--reorder-retract',
         action='store_true',
@@ -48,8 +79,34 @@ def main():
     arguments.add_argument(
         '--wipe-speed',
         type=float,
-        help="(mm/s)",
-        default=1
+        help="(mm/s) for --reorder-retract (default: %(default)s)",
+        default=WIPE_SPEED,
+        )
+    arguments.add_argument(
+        '--slow-e',
+        type=float,
+        metavar='E_MM',
+        help="(mm of filament) slow down printing over this much before"
+        " retracting (0 disables) (default: 0)",
+        default=0,
+        )
+    arguments.add_argument(
+        '--slow-rate',
+        type=float,
+        help="(mm/s) for --slow-e (default: %(default)s)",
+        default=SLOW_XY_RATE,
+        )
+    arguments.add_argument(
+        '--slow-before',
+        choices=('retract', 'any'),
+        help="for --slow-e, retracts or any pause in extrusion"
+        " (default: %(default)s)",
+        default=SLOW_BEFORE,
+        )
+    arguments.add_argument(
+        '--travel-order',
+        action='store_true',
+        help="Print the islands in each layer in a shorter order",
         )
     arguments.add_argument(
         '--max-command-rate',
@@ -64,17 +121,159 @@ def main():
         help='(mm) (0 disables) (default: 0)',
         default=0,
         )
+    arguments.add_argument(
+        '--max-flow',
+        type=float,
+        metavar='MM3_S',
+        help='(mm^3/s) cap printing moves to the hotend\'s max flow'
+        ' and speed up slow ones under it',
+        default=None,
+        )
+    arguments.add_argument(
+        '--filament-diameter',
+        type=float,
+        help='(mm) for --max-flow (default: %(default)s)',
+        default=FILAMENT_DIAMETER,
+        )
+    arguments.add_argument(
+        '--max-step-load',
+        type=float,
+        metavar='LOAD',
+        help='Slow down moves that would need more than this fraction'
+        ' of the MCU for stepping (0.9 is sensible)',
+        default=None,
+        )
+    arguments.add_argument(
+        '--linear-advance',
+        type=float,
+        metavar='K',
+        help='Apply linear advance K on the host and M900 K0 the firmware',
+        default=None,
+        )
+    arguments.add_argument(
+        '--bed-mesh',
+        type=str,
+        metavar='MESH.txt',
+        help='Apply the mesh from captured M420 V output and M420 S0',
+        default=None,
+        )
+    arguments.add_argument(
+        '--mesh-min',
+        type=float,
+        nargs=2,
+        metavar=('X', 'Y'),
+        help='(mm) first probe point (default: %(default)s)',
+        default=MESH_MIN,
+        )
+    arguments.add_argument(
+        '--mesh-max',
+        type=float,
+        nargs=2,
+        metavar=('X', 'Y'),
+        help='(mm) last probe point (default: %(default)s)',
+        default=MESH_MAX,
+        )
+    arguments.add_argument(
+        '--fade-height',
+        type=float,
+        help='(mm) like M420 Z (0 disables) (default: 0)',
+        default=0,
+        )
+    arguments.add_argument(
+        '--preheat',
+        action='store_true',
+        help="Change temperatures early instead of waiting (M109/M190)"
+        )
+    arguments.add_argument(
+        '--heaters',
+        type=str,
+        metavar='heaters.json',
+        help="Heater constants from thermal.py --fit (default: built in)",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Start from the limits in DIR/Configuration.h"
+        " (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--no-marlin-config',
+        action='store_true',
+        help="Only know what the gcode sets (M201, M203...)",
+        )
     args = arguments.parse_args()
+    if args.output is None:
+        args.output = '_pp.'.join(args.input.rsplit('.', 1))
     logging.basicConfig(stream=sys.stderr,level=logging.DEBUG)
-    script = Script.from_file(args.input)
-    if args.reorder_retract:
-        raise NotImplementedError()
-        script = ReorderRetract(script, args.wipe_speed)
+    if not args.no_marlin_config:
+        MachineState.profile = load_profile(args.marlin_config)
+    with open(args.input, 'r') as fh:
+        commands = Script.read(fh)
+        if args.reorder_retract:
+            commands = ReorderRetract(
+                wipe_speed=args.wipe_speed,
+                ).stream(commands)
+        if args.slow_e > 0:
+            commands = ExtrusionDecelerator(
+                slow_e=args.slow_e,
+                slow_rate=args.slow_rate,
+                before=args.slow_before,
+                ).stream(commands)
+        if not (
+            args.travel_order
+            or args.smooth_corners > 0
+            or args.max_flow is not None
+            or args.max_step_load is not None
+            or args.bed_mesh is not None
+            or args.linear_advance is not None
+            or args.preheat
+            ):
+            # Nothing needs the whole script, stream it straight through
+            if args.numbered:
+                return Script.write_numbered(commands, args.output)
+            return Script.write(commands, args.output)
+        INFO(f"Parsing {args.input}")
+        script = Script.from_commands(
+            commands,
+            args.input,
+            analyzed=args.reorder_retract or args.slow_e > 0,
+            )
+    if args.travel_order:
+        script = TravelOrder(script)
     if args.smooth_corners > 0:
         script = Smooth(script,
                         args.smooth_corners,
                         args.max_command_rate,
                         )
+    if args.max_flow is not None:
+        script = FlowLimit(script,
+                           args.max_flow,
+                           args.filament_diameter,
+                           profile=MachineState.profile,
+                           )
+    if args.max_step_load is not None:
+        script = StepRateLimit(script,
+                               args.max_step_load,
+                               profile=MachineState.profile,
+                               )
+    if args.bed_mesh is not None:
+        mesh = BedMesh.from_file(
+            args.bed_mesh,
+            args.mesh_min,
+            args.mesh_max,
+            args.fade_height,
+            )
+        script = BedMeshCompensation(script, mesh)
+    if args.linear_advance is not None:
+        script = LinearAdvance(script, args.linear_advance)
+    if args.preheat:
+        heaters = HEATERS
+        if args.heaters is not None:
+            heaters = load_heaters(args.heaters)
+        script = PredictivePreheat(script, heaters)
+    script.to_file(args.output, numbered=args.numbered)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# preflight.py -- Check a gcode file for things the printer will refuse or get wrong
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./preflight.py <input.gcode> [--json] [--marlin-config DIR]
+Exits with 1 if there are any errors, so it can gate uploads.
+Reads the file straight into columns, about 5 s for a million lines.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import json
+import time
+from collections import namedtuple
+
+import numpy
+
+from machine_state import MachineState
+from columns import Columns
+from columns import E
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+# Marlin won't do these or does something else instead
+ERRORS = 'error'
+# Marlin will do it, but probably not what was meant
+WARNINGS = 'warning'
+
+# One contiguous run of commands breaking a rule, first and last are
+# lines in the input file
+Problem = namedtuple('Problem', 'rule severity first last count')
+
+def runs(lines, mask):
+    # (first, last, count) of each run of mask in a row
+    where = numpy.nonzero(mask)[0]
+    if len(where) == 0:
+        return []
+    breaks = numpy.nonzero(numpy.diff(where) != 1)[0]
+    starts = numpy.concatenate(([0], breaks + 1))
+    ends = numpy.concatenate((breaks, [len(where) - 1]))
+    return [
+        (int(lines[where[s]]), int(lines[where[e]]), int(e - s + 1))
+        for s, e in zip(starts, ends)
+        ]
+
+class Preflight:
+    def __init__(
+        self,
+        commands,
+        profile,
+        unknown=(),
+        columns=None,
+        malformed=(),
+        ):
+        self.commands = commands
+        self.profile = profile
+        self.unknown = list(unknown)
+        self.malformed = list(malformed)
+        self.problems = []
+        if columns is None:
+            columns = Columns(commands)
+        # Just the rules, not getting the columns out of the commands
+        start = time.perf_counter()
+        self.check(columns)
+        self.elapsed = time.perf_counter() - start
+
+    def flag(self, rule, severity, lines, mask):
+        for (first, last, count) in runs(lines, mask):
+            self.problems.append(Problem(rule, severity, first, last, count))
+
+    def check(self, columns):
+        profile = self.profile
+        n = len(columns)
+        if self.commands is None:
+            # Columns.from_lines(), one row for each line in the file
+            lines = numpy.arange(1, n + 1)
+        else:
+            lines = numpy.array([c.oln for c in self.commands], dtype=int)
+        move = columns.is_move
+        delta = columns.delta
+        after = columns.after
+        dist = columns.dist_xyz
+        dist = numpy.where(dist > 0.0, dist, numpy.abs(delta[:, E]))
+        moved = move & (dist > 0.0)
+        # Runs are over moves only, so comments and such in the middle of a
+        # run don't split it
+        move_lines = lines[move]
+        unknown = numpy.zeros(n, dtype=bool)
+        unknown[numpy.searchsorted(lines, self.unknown)] = True
+        self.flag('unknown-code', ERRORS, lines, unknown)
+        # Left out of the columns, like unknown codes
+        malformed = numpy.zeros(n, dtype=bool)
+        malformed[numpy.searchsorted(lines, self.malformed)] = True
+        self.flag('missing-value', ERRORS, lines, malformed)
+        with numpy.errstate(invalid='ignore'):
+            low = numpy.array(profile.min_pos, dtype=float) - 1e-6
+            high = numpy.array(profile.max_pos, dtype=float) + 1e-6
+            outside = (after[:, :E] < low) | (after[:, :E] > high)
+            for ai, axis in enumerate('XYZ'):
+                self.flag(
+                    f"{axis.lower()}-out-of-bounds",
+                    ERRORS,
+                    move_lines,
+                    (moved & outside[:, ai])[move],
+                    )
+            extrudes = moved & (delta[:, E] > 0.0)
+            if profile.extrude_mintemp is not None:
+                # Unknown or off counts as cold, M104 without M109 is
+                # still a gamble
+                cold = ~(columns.head_temp >= profile.extrude_mintemp)
+                self.flag(
+                    'cold-extrusion',
+                    ERRORS,
+                    move_lines,
+                    (extrudes & cold)[move],
+                    )
+            if profile.extrude_maxlength is not None:
+                long = numpy.abs(delta[:, E]) > profile.extrude_maxlength
+                self.flag(
+                    'long-extrusion',
+                    ERRORS,
+                    move_lines,
+                    (moved & long)[move],
+                    )
+            hot = numpy.zeros(n, dtype=bool)
+            if profile.head_maxtemp is not None:
+                head = numpy.diff(columns.head_temp, append=numpy.nan) != 0.0
+                limit = profile.head_maxtemp - profile.head_overshoot
+                # after is the next before
+                head_after = numpy.append(columns.head_temp[1:], numpy.nan)
+                hot |= head & (head_after > limit)
+            if profile.bed_maxtemp is not None:
+                bed = numpy.diff(columns.bed_temp, append=numpy.nan) != 0.0
+                limit = profile.bed_maxtemp - profile.bed_overshoot
+                bed_after = numpy.append(columns.bed_temp[1:], numpy.nan)
+                hot |= bed & (bed_after > limit)
+            self.flag('too-hot', ERRORS, lines, hot)
+            speed = columns.feedrate * columns.feedrate_mult
+            limits = numpy.where(
+                numpy.isnan(columns.speed_limit),
+                numpy.array(profile.max_feedrate, dtype=float),
+                columns.speed_limit,
+                )
+            axis_speed = speed[:, None] * numpy.abs(delta) / dist[:, None]
+            fast = numpy.any(axis_speed > limits * (1.0 + 1e-6), axis=1)
+            self.flag(
+                'over-max-feedrate',
+                WARNINGS,
+                move_lines,
+                (moved & fast)[move],
+                )
+            self.flag(
+                'no-feedrate',
+                WARNINGS,
+                move_lines,
+                (moved & numpy.isnan(speed))[move],
+                )
+        self.problems.sort(key=lambda p: p.first)
+
+    @property
+    def errors(self):
+        return [p for p in self.problems if p.severity == ERRORS]
+
+    @property
+    def ok(self):
+        return len(self.errors) == 0
+
+    def summary(self):
+        # rule: (severity, runs, commands)
+        rules = dict()
+        for p in self.problems:
+            (severity, count, commands) = rules.get(p.rule, (p.severity, 0, 0))
+            rules[p.rule] = (severity, count + 1, commands + p.count)
+        return rules
+
+    def report(self, max_runs=20):
+        lines = []
+        for rule, (severity, count, commands) in sorted(self.summary().items()):
+            lines.append(f"{severity:>7} {rule}: {commands} commands in {count} runs")
+            for p in [p for p in self.problems if p.rule == rule][:max_runs]:
+                if p.first == p.last:
+                    lines.append(f"        line {p.first}")
+                else:
+                    lines.append(f"        lines {p.first}-{p.last} ({p.count})")
+            if count > max_runs:
+                lines.append(f"        ... {count - max_runs} more")
+        if self.ok:
+            lines.append("OK")
+        else:
+            lines.append(f"{len(self.errors)} errors")
+        return "\n".join(lines)
+
+    def to_json(self):
+        return json.dumps({
+            'ok': self.ok,
+            'problems': [p._asdict() for p in self.problems],
+            }, indent=1)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Check gcode against the printer\'s limits before printing'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--json',
+        action='store_true',
+        help="Print the problems as JSON",
+        )
+    arguments.add_argument(
+        '--max-runs',
+        type=int,
+        help="Runs to list for each rule (default: %(default)s)",
+        default=20,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    start = time.perf_counter()
+    unknown = []
+    malformed = []
+    with open(args.input, 'r') as fh:
+        columns = Columns.from_lines(fh, unknown, malformed)
+    preflight = Preflight(None, profile, unknown, columns, malformed)
+    elapsed = time.perf_counter() - start
+    INFO(
+        f"Checked {len(columns)} lines in {elapsed:0.3f} s"
+        f" ({len(columns) / elapsed:0.0f} lines/s,"
+        f" {preflight.elapsed:0.3f} s of it the rules)"
+        )
+    if args.json:
+        print(preflight.to_json())
+    else:
+        print(preflight.report(args.max_runs))
+    sys.exit(0 if preflight.ok else 1)
+
+if __name__ == '__main__':
+    main()
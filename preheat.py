@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# preheat.py -- Change temperatures early instead of waiting for them
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import numpy
+
+from command import parse
+from commands import SetTemp
+from commands import PreheatHeadTemp
+from commands import PreheatBedTemp
+from mutator import Mutator
+from thermal import HEATERS
+from thermal import ThermalSimulation
+
+PREHEAT_CODES = {
+    'head': PreheatHeadTemp.code,
+    'bed': PreheatBedTemp.code,
+    }
+
+class PredictivePreheat(Mutator):
+    def __init__(self, script, heaters=HEATERS, lead=1.0):
+        self.heaters = heaters
+        self.lead = lead # multiplies the predicted ramp time
+        super().__init__(script)
+
+    def first_extrusion(self):
+        for ci, command in enumerate(self.original):
+            e = command.head_dist_e
+            if e is not None and e > 0.0 and command.moves_head:
+                return ci
+        return len(self.original)
+
+    def schedule(self):
+        self.early = dict() # ci -> commands to insert before it
+        self.moved = set()
+        start_times = ThermalSimulation(self.original, self.heaters).start
+        printing = self.first_extrusion()
+        previous = {heater: printing for heater in self.heaters}
+        self.saved = 0.0
+        for ci in range(printing, len(self.original)):
+            command = self.original[ci]
+            if not isinstance(command, SetTemp):
+                continue
+            heater = command.heater
+            if heater == 'head':
+                setpoint = command.before.head_temp
+            else:
+                setpoint = command.before.bed_temp
+            target = command.target
+            if (
+                setpoint is None
+                or target == 0.0
+                or target == setpoint
+                ):
+                previous[heater] = ci
+                continue
+            ramp = self.heaters[heater].ramp_time(setpoint, target)
+            t_insert = start_times[ci] - ramp * self.lead
+            ei = numpy.searchsorted(start_times, t_insert, side='right') - 1
+            ei = max(ei, previous[heater] + 1)
+            previous[heater] = ci
+            if ei >= ci:
+                continue
+            available = start_times[ci] - start_times[ei]
+            DEBUG(
+                f"{heater} {setpoint}->{target} needs {ramp:0.1f} s, "
+                f"moving {ci-ei} commands and {available:0.1f} s earlier"
+                )
+            self.early.setdefault(ei, []).append(parse(
+                f"{PREHEAT_CODES[heater]} S{target:g}"
+                " ; early by preheat.py"
+                ))
+            if command.waits and available < ramp:
+                self.saved += available # still waits, but not as long
+            else:
+                if command.waits:
+                    self.saved += ramp
+                self.moved.add(ci)
+        INFO(f"Moved {len(self.moved)} temperature changes earlier")
+        INFO(f"Predicted heating wait saved: {self.saved:0.1f} s")
+
+    def process(self):
+        self.schedule()
+        super().process()
+
+    def process_command(self, ci, old):
+        if ci in self.early:
+            self.replace(ci, old, self.early[ci])
+        # The prediction could be off, so a wait stays as it was, S or R.
+        # If the heater's already there, it doesn't take any time.
+        if ci in self.moved and not old.waits:
+            return self.replace(ci, old, [
+                parse(f"; preheat.py moved earlier: {old.g_code}")
+                ])
+        return self.keep(ci, old)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# reorder_retract.py -- Retract before the travel moves, and wipe during them
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./reorder_retract.py <input.gcode> [-o output.gcode] [--wipe-speed mm/s]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+from collections import deque
+
+from command import parse
+from command import unparse
+from commands import Move
+from mutator import Mutator
+from script import Script
+
+WIPE_SPEED = 1.0 # mm/s
+# Only the last this many travel moves before a retract get slowed down,
+# which is also all we have to hold in memory
+MAX_PENDING = 32
+
+def moves_head_args(command):
+    return (
+        hasattr(command, 'X')
+        or hasattr(command, 'Y')
+        or hasattr(command, 'Z')
+        )
+
+def is_travel(command):
+    return (
+        isinstance(command, Move)
+        and moves_head_args(command)
+        and not hasattr(command, 'E')
+        )
+
+def is_retract(command):
+    if not isinstance(command, Move) or moves_head_args(command):
+        return False
+    e = command.head_dist_e
+    return e is not None and e < 0.0
+
+# Cura travels and then retracts, which oozes all the way. Instead retract
+# first and do the travel moves slowly, so they wipe the nozzle.
+class ReorderRetract(Mutator):
+    def __init__(self, script=None, wipe_speed=WIPE_SPEED, max_pending=MAX_PENDING):
+        self.wipe_speed = wipe_speed # mm/s
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.moved = 0
+        super().__init__(script)
+
+    def flush(self):
+        while len(self.pending) > 0:
+            self.keep(*self.pending.popleft())
+
+    def finish(self):
+        self.flush()
+        INFO(f"Moved {self.moved} retractions")
+
+    def wipe(self, ci, old):
+        self.replace(ci, old, [parse(
+            f"{old.g_code} ; moved before {len(self.pending)} travel moves"
+            " by reorder_retract.py"
+            )])
+        while len(self.pending) > 0:
+            (cj, travel) = self.pending.popleft()
+            args = travel.args
+            args['F'] = self.wipe_speed * 60.0 # mm/m in gcode
+            self.replace(cj, travel, [
+                parse(unparse(args, " slowed by reorder_retract.py"))
+                ])
+        # The travel moves were slowed down, the next ones shouldn't be
+        if old.after.feedrate is not None:
+            self.replace(ci, old, [parse(unparse(
+                {'G': 1.0, 'F': old.after.feedrate * 60.0},
+                " restored by reorder_retract.py",
+                ))])
+        self.moved += 1
+
+    def process_command(self, ci, old):
+        if is_travel(old):
+            if len(self.pending) >= self.max_pending:
+                self.keep(*self.pending.popleft())
+            self.pending.append((ci, old))
+            return
+        if is_retract(old) and len(self.pending) > 0:
+            return self.wipe(ci, old)
+        self.flush()
+        return self.keep(ci, old)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Move retracts to before non-printing moves (Cura)'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input_rr.gcode)",
+        )
+    arguments.add_argument(
+        '--wipe-speed',
+        type=float,
+        help="(mm/s) (default: %(default)s)",
+        default=WIPE_SPEED,
+        )
+    arguments.add_argument(
+        '--max-pending',
+        type=int,
+        help="Travel moves to slow down before each retract"
+        " (default: %(default)s)",
+        default=MAX_PENDING,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.output is None:
+        args.output = '_rr.'.join(args.input.rsplit('.', 1))
+    reorder = ReorderRetract(
+        wipe_speed=args.wipe_speed,
+        max_pending=args.max_pending,
+        )
+    with open(args.input, 'r') as fh:
+        Script.write(reorder.stream(Script.read(fh)), args.output)
+
+if __name__ == '__main__':
+    main()
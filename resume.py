@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+# resume.py -- Carry on a failed print from a layer or line
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./resume.py input.gcode --layer 180 [-o output.gcode]
+       ./resume.py input.gcode --line 123456
+       ./resume.py input.gcode --z 36.2
+       ./resume.py input.gcode --index
+Writes a file that heats up, homes X and Y, sets the modes, offsets, fan,
+feedrate, accelerations and jerk to what they were, goes to where the
+print was Z first, and then carries on with the rest of input.gcode.
+Z isn't homed, the print's in the way. If the printer was turned off, move
+Z to where the print was by hand and use --set-z.
+The first time, the whole file is analyzed once and every layer and every
+CHECKPOINT_LINES lines is saved next to it in input.gcode.checkpoints (run
+--index while it's still printing), after that it only has to analyze from
+the checkpoint before the line.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from bisect import bisect_right
+
+from command import parse
+from command import unparse
+from commands import Move
+from machine_state import Axis
+from machine_state import MachineState
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+CHECKPOINT_SUFFIX = '.checkpoints'
+CHECKPOINT_LINES = 10000 # at most this many lines to analyze for a resume
+CLEARANCE = 5.0 # mm above the print before moving over it
+Z_FEEDRATE = 10.0 # mm/s, HOMING_FEEDRATE_Z
+TRAVEL_FEEDRATE = 50.0 # mm/s
+
+def state_to_dict(state):
+    d = dict(state.__dict__)
+    for name in 'xyze':
+        d[name] = dict(d[name].__dict__)
+    return d
+
+def state_from_dict(d):
+    # Skips __init__ like Axis.copy(), nothing to reset
+    state = MachineState.__new__(MachineState)
+    state.__dict__.update(d)
+    for name in 'xyze':
+        axis = Axis.__new__(Axis)
+        axis.__dict__.update(d[name])
+        setattr(state, name, axis)
+    return state
+
+def settings():
+    # Checkpoints from a different profile start from different defaults
+    profile = json.dumps(
+        MachineState.profile_settings(),
+        sort_keys=True,
+        default=str,
+        )
+    return hashlib.sha256(profile.encode('utf-8')).hexdigest()
+
+def read(fh, line=1, state=None):
+    # (line number, byte offset, command) for each line from wherever fh
+    # is, which is line, analyzed starting from state
+    if state is None:
+        state = MachineState()
+    offset = fh.tell()
+    for raw in fh:
+        command = parse(raw.decode('utf-8', errors='replace').rstrip())
+        command.oln = command.ln = line
+        state = command.evolve(state)
+        yield (line, offset, command)
+        line += 1
+        offset += len(raw)
+
+def printing(command):
+    # Like Columns.printing
+    if not isinstance(command, Move):
+        return False
+    dist_e = command.head_dist_e
+    dist_xy = command.head_dist_xy
+    return (
+        dist_e is not None and dist_e > 0.0
+        and dist_xy is not None and dist_xy > 0.0
+        )
+
+class Checkpoints:
+    def __init__(self, lines, offsets, states, layers):
+        self.lines = lines # line numbers, in order
+        self.offsets = offsets # bytes into the file
+        self.states = states # MachineState before each line, as dicts
+        self.layers = layers # [(line, z)] where each layer starts
+
+    @classmethod
+    def build(cls, file_name):
+        # Analyzes the whole file once, without keeping the commands
+        INFO(f"Indexing {file_name}")
+        start = time.monotonic()
+        new = cls([], [], [], [])
+        top = None
+        printed = False
+        after_print = None # (line, offset, state) after the last printed
+        with open(file_name, 'rb') as fh:
+            for (line, offset, command) in read(fh):
+                if printed:
+                    after_print = (line, offset, command.before)
+                    printed = False
+                if line % CHECKPOINT_LINES == 1:
+                    new.add(line, offset, command.before)
+                if not printing(command):
+                    continue
+                printed = True
+                z = command.after.z.position
+                if z is not None and (top is None or z > top):
+                    # Counts the same as Columns.layer, but starts after
+                    # the last thing printed below, so the travel,
+                    # retracts and Z moves up to it are in the new layer
+                    top = z
+                    if after_print is None:
+                        after_print = (line, offset, command.before)
+                    new.add(*after_print)
+                    new.layers.append((after_print[0], z))
+        INFO(
+            f"{len(new.layers)} layers, {len(new.lines)} checkpoints"
+            f" in {time.monotonic() - start:0.1f} s"
+            )
+        return new
+
+    def add(self, line, offset, state):
+        i = bisect_right(self.lines, line)
+        if i > 0 and self.lines[i - 1] == line:
+            return
+        self.lines.insert(i, line)
+        self.offsets.insert(i, offset)
+        self.states.insert(i, state_to_dict(state))
+
+    def save(self, file_name):
+        stat = os.stat(file_name)
+        with open(file_name + CHECKPOINT_SUFFIX, 'w') as fh:
+            json.dump({
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'settings': settings(),
+                'lines': self.lines,
+                'offsets': self.offsets,
+                'states': self.states,
+                'layers': self.layers,
+                }, fh)
+
+    @classmethod
+    def load(cls, file_name):
+        # None if there aren't any for this version of the file
+        try:
+            with open(file_name + CHECKPOINT_SUFFIX, 'r') as fh:
+                saved = json.load(fh)
+        except FileNotFoundError:
+            return None
+        stat = os.stat(file_name)
+        if (
+            saved['size'] != stat.st_size
+            or saved['mtime'] != stat.st_mtime
+            or saved['settings'] != settings()
+            ):
+            WARNING(f"{file_name}{CHECKPOINT_SUFFIX} is out of date")
+            return None
+        return cls(
+            saved['lines'],
+            saved['offsets'],
+            saved['states'],
+            [tuple(layer) for layer in saved['layers']],
+            )
+
+    @classmethod
+    def for_file(cls, file_name):
+        checkpoints = cls.load(file_name)
+        if checkpoints is None:
+            checkpoints = cls.build(file_name)
+            checkpoints.save(file_name)
+        return checkpoints
+
+    def layer_line(self, layer):
+        if not 0 <= layer < len(self.layers):
+            raise ValueError(f"No layer {layer}, there are {len(self.layers)}")
+        return self.layers[layer][0]
+
+    def z_line(self, z):
+        # The first layer at or above z
+        for (line, layer_z) in self.layers:
+            if layer_z >= z - 1e-6:
+                return line
+        raise ValueError(f"Nothing printed at or above Z{z}")
+
+    def state_at(self, file_name, line):
+        # (byte offset of line, state before it), from the checkpoint
+        # before it
+        i = bisect_right(self.lines, line) - 1
+        if i < 0:
+            raise ValueError(f"No line {line}")
+        state = state_from_dict(self.states[i])
+        with open(file_name, 'rb') as fh:
+            fh.seek(self.offsets[i])
+            for (ln, offset, command) in read(fh, self.lines[i], state):
+                if ln == line:
+                    return (offset, command.before)
+        raise ValueError(f"No line {line}, the file is shorter")
+
+def preamble(state, set_z=False, comment=None):
+    # Gcode to get the printer back to state, with the head where it was
+    fresh = MachineState()
+    g_codes = []
+    def add(args, comment=None):
+        g_codes.append(unparse(args, comment))
+    if comment is not None:
+        g_codes.append(f";{comment}")
+    if set_z and state.z.position is not None:
+        add({'G': 92.0, 'Z': state.z.position}, "where Z was moved to by hand")
+    add({'G': 91.0})
+    add({'G': 1.0, 'Z': CLEARANCE, 'F': Z_FEEDRATE * 60.0}, "off the print")
+    add({'G': 90.0})
+    add({'G': 28.0, 'X': '', 'Y': ''})
+    heaters = (('M140', 'M190', state.bed_temp), ('M104', 'M109', state.head_temp))
+    for (preheat, wait, target) in heaters:
+        if target is not None and target > 0.0:
+            add({'M': float(preheat[1:]), 'S': target})
+    for (preheat, wait, target) in heaters:
+        if target is not None and target > 0.0:
+            add({'M': float(wait[1:]), 'S': target})
+    # Accelerations, limits and jerk, only what the file changed
+    accels = {
+        'P': state.print_accel,
+        'R': state.retract_accel,
+        'T': state.travel_accel,
+        }
+    fresh_accels = (fresh.print_accel, fresh.retract_accel, fresh.travel_accel)
+    if tuple(accels.values()) != fresh_accels:
+        add({'M': 204.0, **{k: v for k, v in accels.items() if v is not None}})
+    for (code, attribute) in ((201.0, 'accel_limit'), (203.0, 'speed_limit'), (205.0, 'jerk')):
+        args = {
+            letter: getattr(axis, attribute)
+            for letter, axis, fresh_axis in zip('XYZE', state.axes, fresh.axes)
+            if getattr(axis, attribute) is not None
+            and getattr(axis, attribute) != getattr(fresh_axis, attribute)
+            }
+        if len(args) > 0:
+            add({'M': code, **args})
+    if state.feedrate_mult != 1.0:
+        add({'M': 220.0, 'S': state.feedrate_mult * 100.0})
+    if state.flowrate_mult != 1.0:
+        add({'M': 221.0, 'S': state.flowrate_mult * 100.0})
+    if state.la_k is not None and state.la_k != fresh.la_k:
+        add({'M': 900.0, 'K': state.la_k})
+    if state.fan_speed is not None:
+        if state.fan_speed > 0.0:
+            add({'M': 106.0, 'S': round(state.fan_speed * 255.0)})
+        else:
+            add({'M': 107.0})
+    # Z first, so nothing drags over the print
+    (x, y, z, e) = state.position
+    if z is not None:
+        add({'G': 1.0, 'Z': z + CLEARANCE, 'F': Z_FEEDRATE * 60.0})
+    if x is not None and y is not None:
+        add({'G': 1.0, 'X': x, 'Y': y, 'F': TRAVEL_FEEDRATE * 60.0})
+    if z is not None:
+        add({'G': 1.0, 'Z': z, 'F': Z_FEEDRATE * 60.0})
+    # G28 cleared any G92s, so put back the file's coordinates
+    offsets = {
+        letter: position - axis.offset
+        for letter, axis, position in zip('XYZ', state.axes, (x, y, z))
+        if position is not None and axis.offset != 0.0
+        }
+    if e is not None:
+        offsets['E'] = e - state.e.offset
+    if len(offsets) > 0:
+        add({'G': 92.0, **offsets})
+    if state.feedrate is not None:
+        add({'G': 1.0, 'F': state.feedrate * 60.0})
+    if state.x.relative:
+        add({'G': 91.0})
+    if state.e.relative is True:
+        add({'M': 83.0})
+    elif state.e.relative is False:
+        add({'M': 82.0})
+    return g_codes
+
+def resume(file_name, output, line, checkpoints, set_z=False, comment=None):
+    (offset, state) = checkpoints.state_at(file_name, line)
+    if comment is None:
+        comment = f"resume.py: {os.path.basename(file_name)} from line {line}"
+    with open(output, 'wb') as out:
+        for g_code in preamble(state, set_z, comment):
+            out.write(g_code.encode('utf-8') + b'\n')
+        with open(file_name, 'rb') as fh:
+            fh.seek(offset)
+            shutil.copyfileobj(fh, out)
+    return state
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Carry on a failed print from a layer or line'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="The gcode that was printing",
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input_resume.gcode)",
+        )
+    where = arguments.add_mutually_exclusive_group(required=True)
+    where.add_argument(
+        '--layer',
+        type=int,
+        help="Start at this layer, counting the first as 0",
+        )
+    where.add_argument(
+        '--line',
+        type=int,
+        help="Start at this line of input.gcode, counting from 1",
+        )
+    where.add_argument(
+        '--z',
+        type=float,
+        help="Start at the first layer at or above this height",
+        )
+    where.add_argument(
+        '--index',
+        action='store_true',
+        help="Only save the checkpoints",
+        )
+    where.add_argument(
+        '--list',
+        action='store_true',
+        help="Show where each layer starts",
+        )
+    arguments.add_argument(
+        '--set-z',
+        action='store_true',
+        help="G92 Z to where the print was, after moving Z there by hand",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Defaults from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    MachineState.profile = load_profile(args.marlin_config)
+    start = time.monotonic()
+    checkpoints = Checkpoints.for_file(args.input)
+    if args.index:
+        return
+    if args.list:
+        for layer, (line, z) in enumerate(checkpoints.layers):
+            print(f"{layer:>6} {z:>8.3f} {line:>10}")
+        return
+    try:
+        if args.layer is not None:
+            line = checkpoints.layer_line(args.layer)
+        elif args.z is not None:
+            line = checkpoints.z_line(args.z)
+        else:
+            line = args.line
+        if args.output is None:
+            args.output = '_resume.'.join(args.input.rsplit('.', 1))
+        state = resume(args.input, args.output, line, checkpoints, args.set_z)
+    except ValueError as e:
+        ERROR(e)
+        sys.exit(1)
+    INFO(
+        f"Saved {args.output} from line {line} at Z{state.z.position}"
+        f" in {time.monotonic() - start:0.2f} s"
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+
+# scheduler.py -- Share a queue of print jobs out between printers
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./scheduler.py --printers 4 job1.gcode job2.gcode ... [--json]
+       ./scheduler.py --printers left,right --queue queue.txt
+Estimates every job with Script.analyze() and thermal.py, then packs them
+onto printers so the last one finishes as early as it can. A printer that
+just finished a job at the same bed temperature doesn't have to heat up
+again, so jobs that match go together.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+
+from commands import Move
+from commands import SetTemp
+from script import Script
+from machine_state import MachineState
+from thermal import HEATERS
+from thermal import ThermalSimulation
+from thermal import load_heaters
+from calibrate import Calibration
+from calibrate import features
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+CACHE = 'estimates.json'
+# Getting the last print off and starting the next, heaters are off
+SWAP_TIME = 120.0 # s
+# Moves and swaps tried after the greedy packing, at most
+IMPROVE_ROUNDS = 1000
+
+# Everything about a job the schedule needs. seconds is the whole thing from
+# a cold printer, base is that without the first heat up, which depends on
+# what the printer did before. heat_up is [heater, target, waits, cooling]
+# for each M104/M109/M140/M190 up to the last of those first waits, for
+# heat_time(). *_temp are what it heats to first, *_end and *_setpoint are
+# where the heaters are when it's done.
+Estimate = namedtuple('Estimate', [
+    'seconds',
+    'base',
+    'heating',
+    'heat_up',
+    'head_temp',
+    'bed_temp',
+    'head_end',
+    'bed_end',
+    'head_setpoint',
+    'bed_setpoint',
+    'filament',
+    'commands',
+    ])
+
+# A job where it goes on a printer's timeline
+Slot = namedtuple('Slot', 'file start heating end')
+
+def file_hash(file_name, settings):
+    digest = hashlib.sha256(settings.encode('utf-8'))
+    with open(file_name, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def heat_time(heaters, temps, heat_up):
+    # How long the start gcode waits, starting from temps (ambient if
+    # they're not there). Every heater heads for its setpoint while
+    # another one is waited for, like in ThermalSimulation.
+    temps = dict(temps)
+    setpoints = dict()
+    total = 0.0
+    for (name, target, waits, cooling) in heat_up:
+        if name not in heaters:
+            continue
+        setpoints[name] = target
+        if not waits:
+            continue
+        wait = heaters[name].wait_time(temps.get(name), target, cooling)
+        if wait == float('inf'):
+            wait = 0.0
+        total += wait
+        for other, heater in heaters.items():
+            temps[other] = heater.advance(
+                temps.get(other),
+                setpoints.get(other),
+                wait,
+                )
+    return total
+
+def estimate(file_name, heaters=HEATERS, calibration=None):
+    script = Script.from_file(file_name)
+    script.analyze()
+    commands = script.commands
+    simulation = ThermalSimulation(commands, heaters)
+    seconds = simulation.duration
+    wait = simulation.wait
+    if calibration is not None:
+        # From calibrate.py, fitted to how long prints really took
+        seconds = calibration.predict(features(commands, heaters, simulation)).sum()
+        wait = wait * calibration.factors['heater']
+    heater_factor = 1.0
+    if calibration is not None:
+        heater_factor = calibration.factors['heater']
+    targets = dict()
+    first_waits = dict()
+    for ci, command in enumerate(commands):
+        if not isinstance(command, SetTemp) or command.heater not in heaters:
+            continue
+        if command.heater not in targets and (command.waits or command.target > 0.0):
+            targets[command.heater] = command.target
+        if command.waits and command.heater not in first_waits:
+            first_waits[command.heater] = ci
+    # The first M109/M190 for each heater is where a printer that's still
+    # warm from the last job saves time, even after an M104/M140 for it
+    heat_up = []
+    first_wait = 0.0
+    for ci, command in enumerate(commands[:max(first_waits.values(), default=-1) + 1]):
+        if isinstance(command, SetTemp) and command.heater in heaters:
+            heat_up.append((
+                command.heater,
+                command.target,
+                command.waits,
+                not hasattr(command, 'S'),
+                ))
+            first_wait += wait[ci]
+    base = seconds - first_wait
+    # From cold, Schedule should come out the same as the simulation
+    cold = heat_time(heaters, dict(), heat_up) * heater_factor
+    if abs(base + cold - seconds) > max(1.0, 0.01 * seconds):
+        WARNING(
+            f"{file_name}: heating up from cold takes {cold:0.1f} s"
+            f" but the whole print has {first_wait:0.1f} s of it"
+            )
+    filament = 0.0
+    for command in commands:
+        if isinstance(command, Move) and command.head_dist_e is not None:
+            filament += command.head_dist_e
+    last = commands[-1].after
+    return Estimate(
+        seconds=float(seconds),
+        base=float(base),
+        heating=float(wait.sum()),
+        heat_up=heat_up,
+        head_temp=targets.get('head'),
+        bed_temp=targets.get('bed'),
+        head_end=float(simulation.temps['head'][-1]),
+        bed_end=float(simulation.temps['bed'][-1]),
+        head_setpoint=last.head_temp,
+        bed_setpoint=last.bed_temp,
+        filament=float(filament),
+        commands=len(commands),
+        )
+
+def _estimate(job):
+    (file_name, heaters, calibration) = job
+    return (file_name, estimate(file_name, heaters, calibration))
+
+def estimate_all(
+    file_names,
+    heaters=HEATERS,
+    cache=None,
+    processes=None,
+    calibration=None,
+    ):
+    # {file_name: Estimate}, analyzing only what isn't in cache already.
+    # Different heaters, printer limits or calibration mean different
+    # estimates.
+    settings = json.dumps({
+        'fields': Estimate._fields,
+        'heaters': {name: heater.__dict__ for name, heater in heaters.items()},
+        'profile': MachineState.profile_settings(),
+        'calibration': None if calibration is None else calibration.factors,
+        }, sort_keys=True, default=str)
+    known = dict()
+    if cache is not None and os.path.exists(cache):
+        with open(cache, 'r') as fh:
+            known = json.load(fh)
+    hashes = {file_name: file_hash(file_name, settings) for file_name in file_names}
+    estimates = dict()
+    todo = []
+    for file_name, digest in hashes.items():
+        if digest in known:
+            estimates[file_name] = Estimate(**known[digest])
+        elif file_name not in todo:
+            todo.append(file_name)
+    INFO(f"{len(hashes) - len(todo)} estimates cached, {len(todo)} to do")
+    jobs = [(file_name, heaters, calibration) for file_name in todo]
+    if len(jobs) <= 1 or processes == 1:
+        results = map(_estimate, jobs)
+    else:
+        # fork, so the workers get MachineState.profile too
+        context = multiprocessing.get_context('fork')
+        pool = context.Pool(processes)
+        results = pool.imap_unordered(_estimate, jobs)
+    try:
+        for (file_name, result) in results:
+            estimates[file_name] = result
+            known[hashes[file_name]] = result._asdict()
+    finally:
+        if len(jobs) > 1 and processes != 1:
+            pool.close()
+            pool.join()
+    if cache is not None and len(todo) > 0:
+        with open(cache, 'w') as fh:
+            json.dump(known, fh, indent=1)
+    return estimates
+
+class Schedule:
+    # queue can have the same file more than once, so jobs are indices
+    # into it
+    def __init__(
+        self,
+        queue,
+        estimates,
+        printers,
+        heaters=HEATERS,
+        swap=SWAP_TIME,
+        calibration=None,
+        ):
+        self.queue = list(queue)
+        self.estimates = estimates # {file_name: Estimate}
+        self.printers = list(printers)
+        self.heaters = heaters
+        self.swap = swap
+        self.heater_factor = 1.0
+        if calibration is not None:
+            self.heater_factor = calibration.factors['heater']
+        self.jobs = {printer: [] for printer in self.printers}
+        self.pack()
+
+    def job(self, i):
+        return self.estimates[self.queue[i]]
+
+    def heat_time(self, temps, job):
+        return heat_time(self.heaters, temps, job.heat_up) * self.heater_factor
+
+    def cooled(self, job):
+        # Heaters after the swap
+        temps = dict()
+        for name in ('head', 'bed'):
+            temps[name] = self.heaters[name].advance(
+                getattr(job, f"{name}_end"),
+                getattr(job, f"{name}_setpoint"),
+                self.swap,
+                )
+        return temps
+
+    def lay_out(self, jobs):
+        slots = []
+        clock = 0.0
+        temps = dict() # ambient
+        for i in jobs:
+            job = self.job(i)
+            if len(slots) > 0:
+                clock += self.swap
+            heating = self.heat_time(temps, job)
+            end = clock + heating + job.base
+            slots.append(Slot(self.queue[i], clock, heating, end))
+            clock = end
+            temps = self.cooled(job)
+        return slots
+
+    def end(self, jobs):
+        slots = self.lay_out(jobs)
+        return slots[-1].end if len(slots) > 0 else 0.0
+
+    def order(self, jobs):
+        # Same temperatures in a row, hottest first since M109/M190 S
+        # don't wait for cooling
+        def key(i):
+            job = self.job(i)
+            return (-(job.bed_temp or 0.0), -(job.head_temp or 0.0), i)
+        return sorted(jobs, key=key)
+
+    def pack(self):
+        # Longest first onto whichever printer would finish it first
+        start = time.perf_counter()
+        by_length = sorted(
+            range(len(self.queue)),
+            key=lambda i: -self.job(i).seconds,
+            )
+        ends = {printer: 0.0 for printer in self.printers}
+        for i in by_length:
+            best = min(
+                self.printers,
+                key=lambda printer: (
+                    self.end(self.order(self.jobs[printer] + [i])),
+                    ends[printer],
+                    ),
+                )
+            self.jobs[best] = self.order(self.jobs[best] + [i])
+            ends[best] = self.end(self.jobs[best])
+        rounds = 0
+        while rounds < IMPROVE_ROUNDS and self.improve():
+            rounds += 1
+        INFO(
+            f"Packed {len(self.queue)} jobs onto {len(self.printers)}"
+            f" printers in {time.perf_counter() - start:0.2f} s"
+            f" ({rounds} improvements)"
+            )
+
+    def improve(self, tries=8):
+        # Move a job off the printer that finishes last, or swap it for a
+        # shorter one. Guess from base times which ones look best, then
+        # lay out the few best guesses properly.
+        ends = {printer: self.end(self.jobs[printer]) for printer in self.printers}
+        latest = max(self.printers, key=lambda printer: ends[printer])
+        span = ends[latest]
+        guesses = []
+        for i in self.jobs[latest]:
+            base = self.job(i).base
+            for other in self.printers:
+                if other == latest:
+                    continue
+                # Moving it adds a swap there as well as the job
+                guesses.append((
+                    max(span - base, ends[other] + base + self.swap),
+                    other,
+                    i,
+                    None,
+                    ))
+                for j in self.jobs[other]:
+                    d = base - self.job(j).base
+                    if d > 0.0:
+                        guesses.append((
+                            max(span - d, ends[other] + d), other, i, j
+                            ))
+        guesses.sort(key=lambda guess: guess[0])
+        for (guess, other, i, j) in guesses[:tries]:
+            if guess >= span - 1e-6:
+                break
+            here = [k for k in self.jobs[latest] if k != i]
+            there = [k for k in self.jobs[other] if k != j] + [i]
+            if j is not None:
+                here.append(j)
+            (here, there) = (self.order(here), self.order(there))
+            rest = [ends[p] for p in self.printers if p not in (latest, other)]
+            if max([self.end(here), self.end(there)] + rest) < span - 1e-6:
+                self.jobs[latest] = here
+                self.jobs[other] = there
+                return True
+        return False
+
+    @property
+    def makespan(self):
+        return max(self.end(self.jobs[printer]) for printer in self.printers)
+
+    def to_dict(self):
+        makespan = self.makespan
+        printers = []
+        for printer in self.printers:
+            slots = self.lay_out(self.jobs[printer])
+            end = slots[-1].end if len(slots) > 0 else 0.0
+            printers.append({
+                'printer': printer,
+                'end': end,
+                'idle': makespan - end,
+                'heating': sum(slot.heating for slot in slots),
+                'filament': sum(
+                    self.estimates[slot.file].filament for slot in slots
+                    ),
+                'jobs': [slot._asdict() for slot in slots],
+                })
+        return {'makespan': makespan, 'swap': self.swap, 'printers': printers}
+
+    def report(self):
+        lines = []
+        for printer in self.to_dict()['printers']:
+            lines.append(
+                f"{printer['printer']}: {len(printer['jobs'])} jobs,"
+                f" done at {hms(printer['end'])},"
+                f" heating {hms(printer['heating'])},"
+                f" idle {hms(printer['idle'])},"
+                f" {printer['filament'] / 1000.0:0.1f} m filament"
+                )
+            for slot in printer['jobs']:
+                job = self.estimates[slot['file']]
+                lines.append(
+                    f"    {hms(slot['start'])} {slot['file']}"
+                    f" ({hms(slot['end'] - slot['start'])},"
+                    f" heat {slot['heating']:0.0f} s,"
+                    f" bed {job.bed_temp or 0:g} head {job.head_temp or 0:g})"
+                    )
+        lines.append(f"Everything done at {hms(self.makespan)}")
+        return "\n".join(lines)
+
+def hms(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Plan which printer prints what'
+        )
+    arguments.add_argument(
+        'jobs',
+        metavar='job.gcode',
+        type=str,
+        nargs='*',
+        help="Gcode files to print",
+        )
+    arguments.add_argument(
+        '--queue',
+        type=str,
+        metavar='queue.txt',
+        help="More gcode files, one per line",
+        )
+    arguments.add_argument(
+        '--printers',
+        type=lambda s: list(range(1, int(s) + 1)) if s.isdigit() else s.split(','),
+        help="How many printers, or their names like left,right"
+        " (default: %(default)s)",
+        default=[1],
+        )
+    arguments.add_argument(
+        '--swap-time',
+        type=float,
+        help="Seconds between one job ending and the next starting"
+        " (default: %(default)s)",
+        default=SWAP_TIME,
+        )
+    arguments.add_argument(
+        '--heaters',
+        type=str,
+        metavar='heaters.json',
+        help="Heater constants from thermal.py --fit (default: built in)",
+        )
+    arguments.add_argument(
+        '--calibration',
+        type=str,
+        metavar='calibration.json',
+        help="Correction factors from calibrate.py (default: none)",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--cache',
+        type=str,
+        metavar='estimates.json',
+        help="Estimates by file hash (default: %(default)s)",
+        default=CACHE,
+        )
+    arguments.add_argument(
+        '--no-cache',
+        action='store_true',
+        )
+    arguments.add_argument(
+        '-j', '--processes',
+        type=int,
+        help="Worker processes for estimates (default: one per CPU)",
+        )
+    arguments.add_argument(
+        '--json',
+        action='store_true',
+        help="Print the schedule as JSON",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    file_names = list(args.jobs)
+    if args.queue is not None:
+        with open(args.queue, 'r') as fh:
+            file_names += [line.strip() for line in fh if line.strip() != '']
+    if len(file_names) == 0:
+        arguments.error("Nothing to schedule")
+    MachineState.profile = load_profile(args.marlin_config)
+    heaters = HEATERS
+    if args.heaters is not None:
+        heaters = load_heaters(args.heaters)
+    calibration = None
+    if args.calibration is not None:
+        calibration = Calibration.load(args.calibration)
+    estimates = estimate_all(
+        file_names,
+        heaters,
+        None if args.no_cache else args.cache,
+        args.processes,
+        calibration,
+        )
+    schedule = Schedule(
+        file_names,
+        estimates,
+        args.printers,
+        heaters,
+        args.swap_time,
+        calibration,
+        )
+    if args.json:
+        print(json.dumps(schedule.to_dict(), indent=1))
+    else:
+        print(schedule.report())
+
+if __name__ == '__main__':
+    main()
@@ -32,25 +32,64 @@ class Script:
         if script is None:
             self.commands = None
             self.file_name = None
+            self.analyzed = False
         else:
             self.commands = list(script.commands)
             self.file_name = script.file_name
+            self.analyzed = script.analyzed
     
     @classmethod
     def from_file(cls, file_name):
-        INFO(f"Parsing {file_name}")
         with open(file_name, 'r') as fh:
-            commands = list(map(parse, map(str.rstrip, fh)))
-        for i in range(len(commands)):
-            assert commands[i].oln is None
-            commands[i].oln = i+1
-            commands[i].ln = i+1
-        INFO(f"Parsed {commands[-1].ln} commands")
+            return cls.from_lines(fh, file_name)
+    
+    @staticmethod
+    def read(lines):
+        # Parse one line at a time, for Mutator.stream()
+        for i, line in enumerate(lines):
+            command = parse(line.rstrip())
+            command.oln = i+1
+            command.ln = i+1
+            yield command
+    
+    @classmethod
+    def from_commands(cls, commands, file_name=None, analyzed=False):
+        # analyzed: the commands came from Mutator.stream()
         new = cls()
-        new.commands = commands
+        new.commands = list(commands)
         new.file_name = file_name
+        new.analyzed = analyzed
+        return new
+    
+    @classmethod
+    def from_lines(cls, lines, file_name=None):
+        INFO(f"Parsing {file_name}")
+        new = cls.from_commands(cls.read(lines), file_name)
+        INFO(f"Parsed {new.commands[-1].ln} commands")
         return new
     
+    @staticmethod
+    def write(commands, file_name):
+        INFO(f"Saving {file_name}")
+        n = 0
+        with open(file_name, 'w') as fh:
+            for command in commands:
+                print(command.g_code, file=fh)
+                n += 1
+        INFO(f"Saved {n} commands")
+    
+    @staticmethod
+    def write_numbered(commands, file_name):
+        # For streamer.py, see numbered.py
+        import numbered
+        numbered.write((command.g_code for command in commands), file_name)
+    
+    def to_file(self, file_name, numbered=False):
+        if numbered:
+            self.write_numbered(self.commands, file_name)
+        else:
+            self.write(self.commands, file_name)
+    
     def analyze_one(self, command):
         try:
             self.state = command.evolve(self.state)
@@ -69,3 +108,4 @@ class Script:
             if ci > 0:
                 assert self.commands[ci-1].after is self.commands[ci].before
         del self.ci
+        self.analyzed = True
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# sdcard.py -- Upload gcode to the printer's SD card
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./sdcard.py /dev/ttyUSB0 input_pp.gcode [--name JOB.GCO] [--print]
+       ./sdcard.py --fake input_pp.gcode
+Same flow control and resends as streamer.py, but between M28 and M29, so
+everything goes to the SD card and the print doesn't need the host.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import os
+import time
+
+from command import TEXT_CODES
+from streamer import PrinterError
+from streamer import Protocol
+from streamer import Streamer
+from streamer import open_serial
+from streamer import strip
+from marlin import CONFIG_DIR
+from marlin import load_profile
+from machine_state import MachineState
+import fake_printer
+
+# Marlin's M28 only takes 8.3 names
+NAME_LENGTH = 8
+EXTENSION = 'GCO'
+
+def sd_name(file_name):
+    base = os.path.basename(file_name).rsplit('.', 1)[0]
+    base = ''.join(c for c in base.upper() if c.isalnum() or c in '_-')
+    return f"{base[:NAME_LENGTH] or 'UPLOAD'}.{EXTENSION}"
+
+def shorten(value):
+    # "10.500" -> "10.5", "0.25" -> ".25", "-0.0" -> "0", Marlin's strtod()
+    # reads them all the same. Anything that isn't a number stays as it is.
+    try:
+        float(value)
+    except ValueError:
+        return value
+    if '.' in value:
+        value = value.rstrip('0').rstrip('.')
+    negative = value.startswith('-')
+    if negative:
+        value = value[1:]
+    if value.startswith('0') and len(value) > 1:
+        value = value.lstrip('0') or '0'
+    if value in ('', '0', '.'):
+        return '0'
+    return '-' + value if negative else value
+
+def minify(g_code):
+    # strip() and no more digits than it takes, every byte goes over the
+    # wire with N and a checksum on top
+    line = strip(g_code)
+    words = line.split()
+    if len(words) == 0 or words[0].upper() in TEXT_CODES:
+        return line
+    return ' '.join(word[0] + shorten(word[1:]) for word in words)
+
+class Upload:
+    def __init__(self, fd, name, minified=True, timeout=None, **options):
+        self.fd = fd
+        self.name = name
+        self.minified = minified
+        self.protocol = Protocol(checksums=True, **options)
+        self.streamer = Streamer(fd, self.protocol, on_message=self.message)
+        if timeout is not None:
+            self.streamer.timeout = timeout
+        self.messages = []
+        self.original_bytes = 0
+
+    def message(self, message):
+        DEBUG(f"< {message}")
+        self.messages.append(message)
+
+    def expect(self, g_code, reply):
+        # Send one line and make sure the printer said reply for it
+        self.messages = []
+        self.streamer.run([g_code])
+        for message in self.messages:
+            if message.startswith(reply):
+                return message
+        raise PrinterError(
+            f"{g_code}: expected {reply!r}, got {self.messages!r}"
+            )
+
+    def lines(self, g_codes):
+        for g_code in g_codes:
+            self.original_bytes += len(g_code.rstrip('\r\n')) + 1
+            yield minify(g_code) if self.minified else g_code
+
+    def run(self, g_codes):
+        # If M28 didn't work, the lines would be printed instead of saved,
+        # so nothing else goes until it says it's writing
+        self.expect(f"M28 {self.name}", "Writing to file")
+        start = time.monotonic()
+        sent = self.protocol.sent_bytes
+        self.streamer.run(self.lines(g_codes))
+        self.expect("M29", "Done saving file")
+        self.elapsed = time.monotonic() - start
+        self.sent_bytes = self.protocol.sent_bytes - sent
+        return {
+            'name': self.name,
+            'lines': self.protocol.lines - 2, # not M28 and M29
+            'original_bytes': self.original_bytes,
+            'sent_bytes': self.sent_bytes,
+            'seconds': self.elapsed,
+            'bytes_per_second': self.sent_bytes / self.elapsed,
+            'resends': self.protocol.resends,
+            }
+
+    def start_print(self):
+        self.expect(f"M23 {self.name}", "File opened")
+        self.streamer.run(["M24"])
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Save gcode on the printer\'s SD card over serial'
+        )
+    arguments.add_argument(
+        'port',
+        type=str,
+        nargs='?',
+        help="Serial port, like /dev/ttyUSB0",
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Gcode filename, post.py's output say",
+        )
+    arguments.add_argument(
+        '--name',
+        type=str,
+        help="8.3 name on the card (default: from the input's)",
+        )
+    arguments.add_argument(
+        '--print',
+        action='store_true',
+        help="Start printing it from the card after (M23, M24)",
+        )
+    arguments.add_argument(
+        '--no-minify',
+        action='store_true',
+        help="Send numbers as they are in the file",
+        )
+    arguments.add_argument(
+        '--fake',
+        action='store_true',
+        help="Upload to fake_printer.py instead of a real printer",
+        )
+    arguments.add_argument(
+        '--error-rate',
+        type=float,
+        help="For --fake, fraction of lines to corrupt (default: %(default)s)",
+        default=0.0,
+        )
+    arguments.add_argument(
+        '--baud',
+        type=int,
+        help="(default: from the config)",
+        default=None,
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Buffer sizes from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.port is not None and args.fake:
+        # Only one positional, so it's the input
+        arguments.error("--fake doesn't take a port")
+    if args.port is None and not args.fake:
+        arguments.error("Need a port or --fake")
+    name = args.name or sd_name(args.input)
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    baud = args.baud or profile.baudrate
+    printer = None
+    if args.fake:
+        printer = fake_printer.FakePrinter(
+            rx_buffer_size=profile.rx_buffer_size,
+            bufsize=profile.bufsize,
+            block_buffer_size=profile.block_buffer_size,
+            baud=baud,
+            advanced_ok=profile.advanced_ok,
+            error_rate=args.error_rate,
+            )
+        (port, stop) = fake_printer.start(printer)
+    else:
+        port = args.port
+    fd = open_serial(port, baud)
+    try:
+        upload = Upload(
+            fd,
+            name,
+            minified=not args.no_minify,
+            rx_buffer_size=profile.rx_buffer_size,
+            bufsize=profile.bufsize,
+            advanced_ok=profile.advanced_ok,
+            )
+        with open(args.input, 'r') as fh:
+            result = upload.run(fh)
+        if args.print:
+            upload.start_print()
+    finally:
+        os.close(fd)
+        if printer is not None:
+            stop.set()
+    INFO(
+        f"Saved {result['lines']} lines as {name}:"
+        f" {result['sent_bytes']} bytes ({result['original_bytes']} in the file)"
+        f" in {result['seconds']:0.1f} s,"
+        f" {result['bytes_per_second']:0.0f} bytes/s,"
+        f" {result['resends']} resends"
+        )
+    if printer is not None:
+        with open(args.input, 'r') as fh:
+            expected = [
+                line for line in (
+                    minify(g_code) if not args.no_minify else strip(g_code)
+                    for g_code in fh
+                    )
+                if len(line) > 0
+                ]
+        if printer.files.get(name) != expected:
+            ERROR(f"{name} on the fake card doesn't match {args.input}")
+            sys.exit(1)
+        INFO(f"{name} on the fake card matches")
+
+if __name__ == '__main__':
+    main()
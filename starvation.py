@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+# starvation.py -- Find where sending the gcode over serial can't keep up with the printer
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./starvation.py <input.gcode> [--char-count] [--checksum]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+from collections import deque
+
+import numpy
+
+from commands import Move
+from script import Script
+from columns import Columns
+from planner import Planner
+from streamer import strip
+from streamer import with_checksum
+from machine_state import MachineState
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+OK = b"ok\n"
+# Round trip through USB and the host's serial stack before it notices the
+# ok and sends the next line
+HOST_LATENCY = 0.001 # s
+# About how long Marlin on an ATmega2560 takes to parse a command, and to
+# plan a move
+PARSE_TIME = 0.0002 # s
+PLAN_TIME = 0.0008 # s
+# Gaps shorter than this aren't worth showing
+MIN_GAP = 0.001 # s
+
+class Starvation:
+    def __init__(
+        self,
+        commands,
+        char_count=False,
+        checksums=False,
+        latency=HOST_LATENCY,
+        profile=None,
+        ):
+        if profile is None:
+            profile = load_profile()
+        self.profile = profile
+        self.commands = commands
+        self.char_count = char_count
+        self.checksums = checksums
+        self.latency = latency
+        columns = Columns(commands)
+        self.layer = columns.layer
+        self.layer_z = columns.layer_z
+        self.simulate(Planner(commands))
+
+    def line_bytes(self):
+        sent = numpy.zeros(len(self.commands), dtype=int)
+        n = 1
+        for ci, command in enumerate(self.commands):
+            line = strip(command.g_code)
+            if len(line) == 0:
+                continue
+            if self.checksums:
+                line = with_checksum(line, n)
+                n += 1
+            sent[ci] = len(line) + 1 # newline
+        return sent
+
+    def simulate(self, planner):
+        sent = self.line_bytes()
+        n = len(self.commands)
+        self.bytes = sent
+        self.arrived = numpy.full(n, numpy.nan) # at the printer
+        self.planned = numpy.full(n, numpy.nan) # move is in the planner
+        self.queued = numpy.zeros(n, dtype=int) # planner blocks after it
+        self.duration = numpy.zeros(n) # after SLOWDOWN
+        self.stretched = numpy.zeros(n) # by SLOWDOWN
+        self.slowed = numpy.zeros(n, dtype=bool)
+        self.gaps = [] # (ci, start, seconds)
+        profile = self.profile
+        block_buffer_size = profile.block_buffer_size
+        min_segment_time = profile.min_segment_time
+        byte_time = 10.0 / profile.baudrate # s, 8N1
+        if self.char_count:
+            window_lines = profile.bufsize
+            window_bytes = profile.rx_buffer_size
+        else:
+            window_lines = 1 # wait for ok every line
+            window_bytes = float('inf')
+        ok_time = len(OK) * byte_time
+        in_flight = deque() # (ok seen by host, bytes)
+        in_flight_bytes = 0
+        wire_free = 0.0 # host -> printer
+        marlin_free = 0.0
+        blocks = deque() # end times of blocks in the planner
+        last_end = 0.0
+        waited = True # nothing to starve until the first move
+        for ci, command in enumerate(self.commands):
+            if sent[ci] == 0:
+                continue
+            # Host sends as soon as there's room
+            start = wire_free
+            while len(in_flight) > 0 and (
+                len(in_flight) >= window_lines
+                or in_flight_bytes + sent[ci] > window_bytes
+                ):
+                (seen, size) = in_flight.popleft()
+                in_flight_bytes -= size
+                start = max(start, seen)
+            wire_free = start + sent[ci] * byte_time
+            self.arrived[ci] = wire_free
+            now = max(wire_free, marlin_free) + PARSE_TIME
+            block = planner[command] if isinstance(command, Move) else None
+            if block is not None:
+                while len(blocks) > 0 and blocks[0] <= now:
+                    blocks.popleft()
+                if len(blocks) >= block_buffer_size - 1:
+                    # Planner's full, wait for a block to finish
+                    now = blocks.popleft()
+                now += PLAN_TIME
+                while len(blocks) > 0 and blocks[0] <= now:
+                    blocks.popleft()
+                if len(blocks) == 0 and not waited and now - last_end > MIN_GAP:
+                    self.gaps.append((ci, last_end, now - last_end))
+                waited = False
+                duration = block.time
+                if (
+                    profile.slowdown
+                    and 2 <= len(blocks) < block_buffer_size // 2
+                    and duration < min_segment_time
+                    ):
+                    # Marlin stretches short moves to let the queue fill up
+                    stretch = 2.0 * (min_segment_time - duration) / len(blocks)
+                    duration += stretch
+                    self.stretched[ci] = stretch
+                    self.slowed[ci] = True
+                last_end = max(now, last_end) + duration
+                blocks.append(last_end)
+                self.planned[ci] = now
+                self.queued[ci] = len(blocks)
+                self.duration[ci] = duration
+            elif getattr(command, 'waits', False):
+                # Finishes the moves on purpose, that's not starving
+                now = max(now, last_end)
+                now += self.wait_time(command)
+                blocks.clear()
+                last_end = now
+                waited = True
+            marlin_free = now
+            seen = now + ok_time + self.latency
+            in_flight.append((seen, sent[ci]))
+            in_flight_bytes += sent[ci]
+        self.end = max(last_end, marlin_free)
+        self.starved = sum(gap for (_, _, gap) in self.gaps)
+        INFO(
+            f"Starved {len(self.gaps)} times for {self.starved:0.2f} s"
+            f" of {self.end:0.1f} s"
+            )
+        INFO(
+            f"SLOWDOWN stretched {self.slowed.sum()} moves"
+            f" by {self.stretched.sum():0.2f} s"
+            )
+
+    def wait_time(self, command):
+        # Dwells are in the MachineState time, heating isn't known
+        if command.before.time is None or command.after.time is None:
+            return 0.0
+        return command.after.time - command.before.time
+
+    def layers(self):
+        # (layer, z, moves, gaps, starved seconds, slowed, slowed seconds,
+        # min queued)
+        gap_ci = numpy.array([g[0] for g in self.gaps], dtype=int)
+        gap_s = numpy.array([g[2] for g in self.gaps])
+        gap_layer = self.layer[gap_ci]
+        moves = ~numpy.isnan(self.planned)
+        rows = []
+        for layer in numpy.unique(self.layer):
+            here = self.layer == layer
+            here_moves = here & moves
+            if not here_moves.any():
+                continue
+            z = self.layer_z[here]
+            z = z[~numpy.isnan(z)]
+            in_layer = gap_layer == layer
+            rows.append((
+                layer,
+                z[0] if len(z) > 0 else numpy.nan,
+                here_moves.sum(),
+                in_layer.sum(),
+                gap_s[in_layer].sum(),
+                (self.slowed & here).sum(),
+                self.stretched[here].sum(),
+                self.queued[here_moves].min(),
+                ))
+        return rows
+
+    def report(self, all_layers=False, intervals=True):
+        lines = []
+        if intervals:
+            for (ci, start, gap) in self.gaps:
+                command = self.commands[ci]
+                lines.append(
+                    f"{start:10.3f} s +{gap * 1000.0:7.1f} ms"
+                    f" layer {self.layer[ci]}"
+                    f" waiting for {command.oln}: {strip(command.g_code)}"
+                    )
+        lines.append(
+            f"{'layer':>5} {'z':>7} {'moves':>6} {'starved':>7}"
+            f" {'seconds':>8} {'slowed':>6} {'seconds':>8} {'min queue':>9}"
+            )
+        for (layer, z, moves, gaps, seconds, slowed, stretched, queued) in (
+            self.layers()
+            ):
+            if not all_layers and gaps + slowed == 0:
+                continue
+            lines.append(
+                f"{layer:>5} {z:>7.2f} {moves:>6} {gaps:>7}"
+                f" {seconds:>8.3f} {slowed:>6} {stretched:>8.3f} {queued:>9}"
+                )
+        lines.append(
+            f"Total: starved {len(self.gaps)} times for {self.starved:0.2f} s,"
+            f" {self.slowed.sum()} moves slowed down by SLOWDOWN"
+            f" for {self.stretched.sum():0.2f} s,"
+            f" {self.bytes.sum()} bytes in {self.end:0.1f} s"
+            )
+        return "\n".join(lines)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Find where the planner runs out of moves'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '--char-count',
+        action='store_true',
+        help="Host keeps the RX buffer full instead of waiting for each ok",
+        )
+    arguments.add_argument(
+        '--checksum',
+        action='store_true',
+        help="Host sends line numbers and checksums",
+        )
+    arguments.add_argument(
+        '--latency',
+        type=float,
+        help="(s) from ok to the next line (default: %(default)s)",
+        default=HOST_LATENCY,
+        )
+    arguments.add_argument(
+        '--all-layers',
+        action='store_true',
+        help="List layers that didn't starve too",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Buffer sizes and limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--summary',
+        action='store_true',
+        help="Only the per layer summary, not every interval",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    script = Script.from_file(args.input)
+    script.analyze()
+    starvation = Starvation(
+        script.commands,
+        char_count=args.char_count,
+        checksums=args.checksum,
+        latency=args.latency,
+        profile=profile,
+        )
+    print(starvation.report(args.all_layers, not args.summary))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# step_rate.py -- Find moves that step faster than the printer's MCU can keep up with
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./step_rate.py <input.gcode> [--clamp [-o output.gcode]] [--max-load 0.9]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+
+import numpy
+
+from mutator import FeedrateMutator
+from script import Script
+from columns import Columns
+from columns import E
+from machine_state import MachineState
+from marlin import CONFIG_DIR
+from marlin import load_profile
+
+# From marlin_config/Configuration_adv.h, what the ISR costs below is for
+ADAPTIVE_STEP_SMOOTHING = True
+S_CURVE_ACCELERATION = True
+LIN_ADVANCE = True
+
+# ATmega2560 on a RAMPS 1.4, and roughly what Marlin's stepper.h counts
+# the stepper ISR as costing there (in CPU cycles)
+F_CPU = 16000000 # Hz
+ISR_BASE_CYCLES = 752
+ISR_S_CURVE_CYCLES = 40 if S_CURVE_ACCELERATION else 0
+ISR_LA_BASE_CYCLES = 30 if LIN_ADVANCE else 0
+ISR_LA_LOOP_CYCLES = 177 if LIN_ADVANCE else 0
+ISR_LOOP_BASE_CYCLES = 32
+ISR_STEPPER_CYCLES = 88
+ISR_LOOP_CYCLES = ISR_LOOP_BASE_CYCLES + 4 * ISR_STEPPER_CYCLES # XYZE
+
+ISR_CALL_CYCLES = (
+    ISR_BASE_CYCLES
+    + ISR_S_CURVE_CYCLES
+    + ISR_LA_BASE_CYCLES
+    + ISR_LA_LOOP_CYCLES
+    )
+
+def isr_cycles(multistep):
+    # Cycles per step when doing multistep steps per call
+    return (ISR_CALL_CYCLES + ISR_LOOP_CYCLES * multistep) / multistep
+
+MULTISTEPS = 2 ** numpy.arange(8) # 1, 2, 4 ... 128
+MAX_STEP_FREQUENCY = F_CPU / isr_cycles(MULTISTEPS) # Hz for each of those
+# Above this fraction of the CPU there's nothing left for the planner and
+# serial, which is what stutters
+MAX_LOAD = 0.9
+
+def multistep(rate):
+    # Marlin goes up to the next multistep when the 1x, 2x... rate is too slow
+    k = numpy.searchsorted(MAX_STEP_FREQUENCY, rate)
+    return MULTISTEPS[numpy.minimum(k, len(MULTISTEPS) - 1)]
+
+def isr_rate(rate):
+    # ADAPTIVE_STEP_SMOOTHING doubles the ISR rate of slow moves until they
+    # get to at least half of the 1x rate, so slow moves aren't free either
+    if not ADAPTIVE_STEP_SMOOTHING:
+        return rate
+    half = MAX_STEP_FREQUENCY[0] / 2.0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        doublings = numpy.ceil(numpy.log2(half / rate))
+    doublings = numpy.where(rate > 0.0, numpy.clip(doublings, 0, None), 0)
+    return rate * 2.0 ** numpy.nan_to_num(doublings)
+
+def load(rate):
+    # Fraction of the CPU spent stepping at this step event rate, the extra
+    # calls from smoothing only cost the overhead since they don't step
+    calls = isr_rate(rate) / multistep(rate)
+    return (calls * ISR_CALL_CYCLES + rate * ISR_LOOP_CYCLES) / F_CPU
+
+def safe_rates(max_load):
+    # The fastest step event rate under max_load for each multistep that
+    # has one, load jumps down every time the multistep goes up
+    rates = MAX_STEP_FREQUENCY * max_load
+    reachable = rates > numpy.concatenate(([0.0], MAX_STEP_FREQUENCY[:-1]))
+    return rates[reachable]
+
+def max_rate(max_load):
+    return numpy.max(safe_rates(max_load))
+
+def slower_rate(rate, max_load):
+    # The fastest safe rate that isn't faster than rate, or rate if there
+    # isn't one
+    rates = safe_rates(max_load)
+    k = numpy.searchsorted(rates, rate) - 1
+    return numpy.where(k >= 0, rates[numpy.maximum(k, 0)], rate)
+
+class StepRates:
+    def __init__(self, commands, steps_per_unit=None, profile=None):
+        if profile is None:
+            profile = load_profile()
+        if steps_per_unit is None:
+            steps_per_unit = profile.steps_per_unit
+        self.min_steps_per_segment = profile.min_steps_per_segment
+        self.min_segment_time = profile.min_segment_time
+        columns = Columns(commands)
+        self.commands = commands
+        delta = columns.delta
+        self.dist = columns.dist_xyz
+        # Marlin measures E-only moves by E
+        self.dist = numpy.where(
+            self.dist > 0.0,
+            self.dist,
+            numpy.abs(delta[:, E]),
+            )
+        self.steps_per_unit = numpy.where(
+            numpy.isnan(columns.steps_per_unit),
+            steps_per_unit,
+            columns.steps_per_unit,
+            )
+        self.steps = numpy.round(numpy.abs(delta) * self.steps_per_unit)
+        self.steps = numpy.nan_to_num(self.steps)
+        self.step_events = numpy.max(self.steps, axis=1) # Bresenham
+        self.speed = columns.feedrate * columns.feedrate_mult # mm/s
+        axis_speed = columns.axis_speed(profile.max_feedrate, self.dist)
+        self.speed = numpy.fmin(self.speed, axis_speed)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.moves = (
+                columns.is_move
+                & (self.dist > 0.0)
+                & (self.speed > 0.0)
+                )
+            self.time = numpy.where(self.moves, self.dist / self.speed, 0.0)
+            # Steps per second at the cruising speed, per axis and all together
+            self.axis_rate = numpy.where(
+                self.moves[:, None],
+                self.steps / self.time[:, None],
+                0.0,
+                )
+        self.rate = numpy.max(self.axis_rate, axis=1)
+        self.multistep = multistep(self.rate)
+        self.load = numpy.where(self.moves, load(self.rate), 0.0)
+        self.layer = columns.layer
+        self.layer_z = columns.layer_z
+        # Marlin throws these away and lets the error pile up into the next
+        self.dropped = (
+            columns.is_move
+            & (self.step_events > 0)
+            & (self.step_events < self.min_steps_per_segment)
+            )
+        # SLOWDOWN stretches these out when the planner is running dry
+        self.short = self.moves & ~self.dropped & (self.time < self.min_segment_time)
+
+    def stutters(self, max_load=MAX_LOAD):
+        return self.load > max_load
+
+    def layers(self, max_load=MAX_LOAD):
+        # (layer, z, moves, peak rate, peak load, multistepping, stutters,
+        # dropped, short) for each layer with anything going on
+        stutters = self.stutters(max_load)
+        rows = []
+        layers = numpy.unique(self.layer)
+        for layer in layers:
+            here = self.layer == layer
+            moves = here & self.moves
+            if not moves.any():
+                continue
+            z = self.layer_z[here]
+            z = z[~numpy.isnan(z)]
+            rows.append((
+                layer,
+                z[0] if len(z) > 0 else numpy.nan,
+                moves.sum(),
+                self.rate[moves].max(),
+                self.load[moves].max(),
+                (self.multistep[moves] > 1).sum(),
+                (stutters & here).sum(),
+                (self.dropped & here).sum(),
+                (self.short & here).sum(),
+                ))
+        return rows
+
+    def hotspots(self, count=10):
+        worst = numpy.argsort(-self.load, kind='stable')[:count]
+        return [ci for ci in worst if self.moves[ci]]
+
+    def report(self, max_load=MAX_LOAD, hotspots=10, all_layers=False):
+        lines = []
+        lines.append(
+            f"{'layer':>5} {'z':>7} {'moves':>6} {'steps/s':>8} {'load':>5}"
+            f" {'multi':>5} {'stutter':>7} {'dropped':>7} {'short':>6}"
+            )
+        for (layer, z, moves, rate, load, multi, stutters, dropped, short) in (
+            self.layers(max_load)
+            ):
+            if not all_layers and stutters + dropped + short == 0:
+                continue
+            lines.append(
+                f"{layer:>5} {z:>7.2f} {moves:>6} {rate:>8.0f} {load:>5.2f}"
+                f" {multi:>5} {stutters:>7} {dropped:>7} {short:>6}"
+                )
+        lines.append(
+            f"Total: {self.moves.sum()} moves,"
+            f" {self.stutters(max_load).sum()} over {max_load:g} load,"
+            f" {self.dropped.sum()} under {self.min_steps_per_segment} steps,"
+            f" {self.short.sum()} under {self.min_segment_time * 1000:g} ms"
+            )
+        if self.moves.any():
+            peak = numpy.argmax(self.rate)
+            lines.append(
+                f"Peak: {self.rate[peak]:0.0f} steps/s"
+                f" ({self.multistep[peak]}x multistepping)"
+                f" max {max_rate(max_load):0.0f} steps/s"
+                f" under {max_load:g} load"
+                )
+        for ci in self.hotspots(hotspots):
+            command = self.commands[ci]
+            lines.append(
+                f"{command.oln}: {self.load[ci]:0.2f}"
+                f" {self.rate[ci]:0.0f} steps/s {command.g_code}"
+                )
+        return "\n".join(lines)
+
+class StepRateLimit(FeedrateMutator):
+    changed_comment = " clamped by step_rate.py"
+
+    def __init__(
+        self,
+        script,
+        max_load=MAX_LOAD,
+        steps_per_unit=None,
+        profile=None,
+        ):
+        self.max_load = max_load
+        self.steps_per_unit = steps_per_unit
+        self.profile = profile
+        super().__init__(script)
+
+    def plan(self):
+        rates = StepRates(self.original, self.steps_per_unit, self.profile)
+        self.rates = rates
+        self.changed = rates.stutters(self.max_load)
+        columns = Columns(self.original)
+        self.feedrate = columns.feedrate.copy()
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Just slow enough to get under the limit, and a bit more so
+            # rounding F doesn't put it back over
+            scale = (
+                slower_rate(rates.rate[self.changed], self.max_load)
+                / rates.rate[self.changed]
+                ) * 0.999
+        self.changed[self.changed] = scale < 1.0
+        scale = scale[scale < 1.0]
+        self.feedrate[self.changed] = (
+            rates.speed[self.changed] * scale
+            / columns.feedrate_mult[self.changed]
+            )
+        slowed = rates.time[self.changed] / scale
+        self.added = numpy.sum(slowed - rates.time[self.changed])
+        INFO(f"Clamped {self.changed.sum()} moves under {self.max_load:g} load")
+        INFO(f"Estimated time added: {self.added:0.1f} s")
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Find moves that step too fast for the MCU'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '--clamp',
+        action='store_true',
+        help="Slow down the moves over --max-load",
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename for --clamp (default: input_steps.gcode)",
+        )
+    arguments.add_argument(
+        '--max-load',
+        type=float,
+        help="Fraction of the CPU the stepper ISR can have"
+        " (default: %(default)s)",
+        default=MAX_LOAD,
+        )
+    arguments.add_argument(
+        '--steps-per-unit',
+        type=float,
+        nargs=4,
+        metavar=('X', 'Y', 'Z', 'E'),
+        help="Unless set by M92 (default: from --marlin-config)",
+        )
+    arguments.add_argument(
+        '--hotspots',
+        type=int,
+        help="Worst moves to list (default: %(default)s)",
+        default=10,
+        )
+    arguments.add_argument(
+        '--all-layers',
+        action='store_true',
+        help="List layers without any problems too",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Limits from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    profile = load_profile(args.marlin_config)
+    MachineState.profile = profile
+    script = Script.from_file(args.input)
+    script.analyze()
+    rates = StepRates(script.commands, args.steps_per_unit, profile)
+    print(rates.report(args.max_load, args.hotspots, args.all_layers))
+    if args.clamp:
+        if args.output is None:
+            args.output = '_steps.'.join(args.input.rsplit('.', 1))
+        limit = StepRateLimit(
+            script,
+            args.max_load,
+            args.steps_per_unit,
+            profile,
+            )
+        limit.to_file(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+# streamer.py -- Send gcode to the printer over serial, keeping its buffers full
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./streamer.py /dev/ttyUSB0 input.gcode [--baud 500000] [--ping-pong]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import mmap
+import os
+import select
+import termios
+import time
+from collections import deque
+
+from marlin import BAUDRATE
+from marlin import BUFSIZE
+from marlin import CONFIG_DIR
+from marlin import RX_BUFFER_SIZE
+from marlin import load_profile
+
+# Lines kept around in case the printer asks for them again
+HISTORY = 256
+# No ok for this long and it probably got lost
+TIMEOUT = 10.0 # s
+# After a Resend:, nothing heard for this long means the printer's done
+# with the lines that were already on their way. At 500000 baud the whole
+# RX buffer takes 2.6 ms.
+QUIET = 0.05 # s
+# numbered.py's files, and where each line starts in them
+NUMBERED_SUFFIX = '.numbered'
+INDEX_SUFFIX = '.idx'
+
+class PrinterError(Exception):
+    pass
+
+def strip(g_code):
+    # What the host actually sends, without comments or extra spaces
+    return g_code.split(';', 1)[0].strip()
+
+def checksum(line):
+    cs = 0
+    for b in line.encode('ascii'):
+        cs ^= b
+    return cs
+
+def with_checksum(line, n):
+    line = f"N{n} {line}"
+    return f"{line}*{checksum(line)}"
+
+def parse_ok(text):
+    # ok N12 P15 B3 from ADVANCED_OK, or just ok
+    n = p = b = None
+    for word in text.split()[1:]:
+        try:
+            if word[0] == 'N':
+                n = int(word[1:])
+            elif word[0] == 'P':
+                p = int(word[1:])
+            elif word[0] == 'B':
+                b = int(word[1:])
+        except ValueError:
+            pass
+    return (n, p, b)
+
+# All of the protocol and none of the I/O: push() lines in, send what
+# data() gives you and feed whatever comes back to receive(). That way the
+# same thing drives a real serial port, a pty or a test.
+class Protocol:
+    def __init__(
+        self,
+        rx_buffer_size=RX_BUFFER_SIZE,
+        bufsize=BUFSIZE,
+        advanced_ok=False,
+        checksums=True,
+        ping_pong=False,
+        depth=None,
+        ):
+        self.rx_buffer_size = rx_buffer_size
+        self.bufsize = bufsize
+        self.advanced_ok = advanced_ok
+        self.checksums = checksums
+        self.ping_pong = ping_pong
+        self.depth = depth # lines in flight at most, as well as bytes
+        # Called with n when a line goes out and when it's ok'd
+        self.on_sent = None
+        self.on_ack = None
+        self.pending = deque() # lines not sent yet
+        self.ready = deque() # (n, encoded) numbered, and resends
+        self.in_flight = deque() # (n, size) sent and not ok'd
+        self.in_flight_bytes = 0
+        # Sent after the line the printer asked for again. Marlin flushes
+        # its RX buffer and rejects whatever arrives after that, one
+        # Resend: each, and there's no telling which happened to which
+        # line, so nothing more goes out until the printer's quiet().
+        self.stale_bytes = 0
+        self.holding = None # n it asked for
+        self.history = deque(maxlen=HISTORY) # (n, encoded)
+        self.flush_oks = 0 # oks that came with a Resend:, not for a line
+        self.free_commands = bufsize # from ADVANCED_OK
+        self.partial = b''
+        self.n = 0
+        self.lines = 0
+        self.sent_bytes = 0
+        self.resends = 0
+        if checksums:
+            # Marlin wants N to count up from whatever M110 says
+            self.pending.append('M110 N0')
+            self.n = -1
+
+    def push(self, g_code):
+        line = strip(g_code)
+        if len(line) > 0:
+            self.pending.append(line)
+            self.lines += 1
+
+    @property
+    def done(self):
+        return (
+            len(self.pending) == 0
+            and len(self.ready) == 0
+            and len(self.in_flight) == 0
+            )
+
+    def encode(self, line):
+        if self.checksums:
+            self.n += 1
+            line = with_checksum(line, self.n)
+        else:
+            self.n += 1
+        return (self.n, (line + '\n').encode('ascii'))
+
+    def room(self, size):
+        if self.holding is not None:
+            return False
+        if len(self.in_flight) == 0:
+            return True
+        if self.ping_pong:
+            return False
+        if self.depth is not None and len(self.in_flight) >= self.depth:
+            return False
+        if self.advanced_ok and self.free_commands <= 0:
+            # B on the last ok, less what's gone out since
+            return False
+        if self.checksums and self.in_flight[0][0] == 0:
+            # Marlin sets the line number again when M110 runs, so anything
+            # it read before then would be out of order
+            return False
+        # Anything not ok'd yet might still be sitting in the RX buffer
+        return self.in_flight_bytes + size <= self.rx_buffer_size - 1
+
+    def data(self):
+        # Everything that fits in the printer's buffers right now
+        out = []
+        while len(self.ready) > 0 or len(self.pending) > 0:
+            if len(self.ready) == 0:
+                # Numbered once, so a resend gets the same N
+                (n, encoded) = self.encode(self.pending.popleft())
+                self.history.append((n, encoded))
+                self.ready.append((n, encoded))
+            (n, encoded) = self.ready[0]
+            if not self.room(len(encoded)):
+                break
+            self.ready.popleft()
+            self.in_flight.append((n, len(encoded)))
+            self.in_flight_bytes += len(encoded)
+            self.free_commands -= 1
+            self.sent_bytes += len(encoded)
+            out.append(encoded)
+            if self.on_sent is not None:
+                self.on_sent(n)
+        return b''.join(out)
+
+    def acknowledge(self, n=None):
+        if n is None:
+            if len(self.in_flight) == 0:
+                return
+            n = self.in_flight[0][0]
+        # ADVANCED_OK says which line, so lost oks don't matter
+        while len(self.in_flight) > 0 and self.in_flight[0][0] <= n:
+            (acked, size) = self.in_flight.popleft()
+            self.in_flight_bytes -= size
+            if self.on_ack is not None:
+                self.on_ack(acked)
+
+    def resend(self, n):
+        # Marlin sends an ok right after the Resend:
+        self.flush_oks += 1
+        if n == self.holding:
+            # One of the lines that was already on its way got rejected
+            return
+        self.resends += 1
+        while len(self.in_flight) > 0 and self.in_flight[-1][0] >= n:
+            (sn, size) = self.in_flight.pop()
+            self.in_flight_bytes -= size
+            if sn > n:
+                # n itself is the one it just threw away
+                self.stale_bytes += size
+        self.rewind(n)
+        if self.stale_bytes > 0:
+            self.holding = n
+
+    def rewind(self, n):
+        again = [(hn, encoded) for (hn, encoded) in self.history if hn >= n]
+        if len(again) == 0 or again[0][0] != n:
+            raise PrinterError(f"Can't resend line {n}, it's too old")
+        # Anything already numbered and waiting is in again too
+        self.ready = deque(again)
+
+    def quiet(self):
+        # Everything sent before the Resend: has been flushed or rejected
+        self.stale_bytes = 0
+        self.holding = None
+
+    def lost(self):
+        # Nothing heard for a while. With line numbers, sending the oldest
+        # line again is safe: if the printer already has it, it'll ask for
+        # the one it actually wants.
+        if not self.checksums:
+            return self.acknowledge()
+        if len(self.in_flight) > 0:
+            self.resend(self.in_flight[0][0])
+            self.flush_oks -= 1 # no Resend:, so no extra ok either
+            self.quiet()
+
+    def receive(self, data):
+        # Returns the lines that weren't oks, and whatever came with one
+        messages = []
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            text = line.decode('ascii', errors='replace').strip()
+            if len(text) == 0:
+                continue
+            if text.startswith('ok'):
+                (n, _, b) = parse_ok(text)
+                if self.flush_oks > 0:
+                    # Marlin sends this right after the Resend:
+                    self.flush_oks -= 1
+                    continue
+                if b is not None:
+                    self.free_commands = b
+                self.acknowledge(n if self.advanced_ok else None)
+                if 'T:' in text:
+                    # M105 puts the temperatures on its ok
+                    messages.append(text[2:].strip())
+                continue
+            low = text.lower()
+            if low.startswith('resend:') or low.startswith('rs:'):
+                self.resend(int(text.split(':', 1)[1].split()[0]))
+            elif low.startswith('error:') and 'last line' in low:
+                pass # the Resend: comes next
+            elif low.startswith('echo:unknown command') and self.holding is not None:
+                # Part of a line that came in after the RX buffer was
+                # flushed, its ok isn't for any line
+                self.flush_oks += 1
+            elif low.startswith('error:'):
+                raise PrinterError(text)
+            elif text == 'start':
+                raise PrinterError("Printer reset")
+            messages.append(text)
+        return messages
+
+# Sends a file from numbered.py, so there's nothing to do for each line but
+# copy it, and resending any line is just going back to it
+class NumberedProtocol(Protocol):
+    def __init__(self, encoded, offsets, **options):
+        options['checksums'] = True
+        super().__init__(**options)
+        self.pending.clear() # M110 N0 is already line 0
+        self.encoded = encoded
+        self.offsets = offsets
+        self.count = len(offsets) - 1
+        self.next = 0
+        self.lines = self.count - 1
+
+    def push(self, g_code):
+        raise TypeError("Lines are already in the file")
+
+    @property
+    def done(self):
+        return self.next >= self.count and len(self.in_flight) == 0
+
+    def data(self):
+        first = self.next
+        offsets = self.offsets
+        while self.next < self.count:
+            size = offsets[self.next + 1] - offsets[self.next]
+            if not self.room(size):
+                break
+            self.in_flight.append((self.next, size))
+            self.in_flight_bytes += size
+            self.free_commands -= 1
+            if self.on_sent is not None:
+                self.on_sent(self.next)
+            self.next += 1
+        # What fits is always one run of lines in the file
+        out = self.encoded[offsets[first]:offsets[self.next]]
+        self.sent_bytes += len(out)
+        return out
+
+    def rewind(self, n):
+        if not 0 <= n < self.count:
+            raise PrinterError(f"Can't resend line {n}, there's no such line")
+        self.next = n
+
+def open_numbered(file_name):
+    # (encoded, offsets) mapped straight from the files numbered.py wrote
+    with open(file_name, 'rb') as fh:
+        encoded = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(file_name + INDEX_SUFFIX, 'rb') as fh:
+        index = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder != 'little':
+        raise PrinterError(f"{file_name}{INDEX_SUFFIX} is little endian")
+    return (encoded, memoryview(index).cast('q'))
+
+def open_serial(path, baud=BAUDRATE):
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        attrs = termios.tcgetattr(fd)
+    except termios.error:
+        return fd # not a tty, a pipe or a socket maybe
+    # Raw 8N1, like flash.sh's stty
+    (iflag, oflag, cflag, lflag, ispeed, ospeed, cc) = attrs
+    iflag = 0
+    oflag = 0
+    lflag = 0
+    cflag &= ~(termios.PARENB | termios.CSTOPB | termios.CSIZE | termios.CRTSCTS)
+    cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+    speed = getattr(termios, f"B{baud}", None)
+    if speed is None:
+        WARNING(f"No B{baud} in termios, leaving the port's speed alone")
+        speed = ispeed
+    cc[termios.VMIN] = 1
+    cc[termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, [
+        iflag, oflag, cflag, lflag, speed, speed, cc,
+        ])
+    return fd
+
+class Streamer:
+    def __init__(self, fd, protocol, timeout=TIMEOUT, on_message=None, log=None):
+        self.fd = fd
+        self.protocol = protocol
+        self.timeout = timeout
+        self.on_message = on_message
+        # "time > sent" and "time < received" lines, for calibrate.py
+        self.log = log
+        self.log_partial = b''
+        self.out = b''
+
+    def write_log(self, direction, data):
+        now = time.time()
+        if direction == '<':
+            (*lines, self.log_partial) = (self.log_partial + data).split(b'\n')
+        else:
+            lines = data.split(b'\n')[:-1]
+        for line in lines:
+            text = line.decode('ascii', errors='replace').strip()
+            print(f"{now:0.3f} {direction} {text}", file=self.log)
+
+    def step(self, wait=1.0):
+        protocol = self.protocol
+        data = protocol.data()
+        if self.log is not None and len(data) > 0:
+            self.write_log('>', data)
+        self.out += data
+        writing = [self.fd] if len(self.out) > 0 else []
+        (readable, writable, _) = select.select([self.fd], writing, [], wait)
+        if len(writable) > 0:
+            try:
+                sent = os.write(self.fd, self.out)
+                self.out = self.out[sent:]
+            except BlockingIOError:
+                pass
+        if len(readable) > 0:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                data = b''
+            if len(data) > 0:
+                self.heard = time.monotonic()
+                if self.log is not None:
+                    self.write_log('<', data)
+            for message in protocol.receive(data):
+                if self.on_message is not None:
+                    self.on_message(message)
+                else:
+                    DEBUG(f"< {message}")
+        if protocol.holding is not None and len(self.out) == 0:
+            # Make sure it's all gone out before waiting for quiet
+            try:
+                termios.tcdrain(self.fd)
+            except termios.error:
+                pass
+            if time.monotonic() - self.heard > QUIET:
+                protocol.quiet()
+
+    def run(self, g_codes):
+        protocol = self.protocol
+        for g_code in g_codes:
+            protocol.push(g_code)
+        start = time.monotonic()
+        self.heard = start
+        while not protocol.done or len(self.out) > 0:
+            self.step(QUIET if protocol.holding is not None else 1.0)
+            if (
+                len(protocol.in_flight) > 0
+                and time.monotonic() - self.heard > self.timeout
+                ):
+                # busy: messages keep this from happening while the printer
+                # is heating or homing
+                WARNING(f"No ok for {self.timeout} s")
+                protocol.lost()
+                self.heard = time.monotonic()
+        self.elapsed = time.monotonic() - start
+        return self.elapsed
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Print a gcode file over serial'
+        )
+    arguments.add_argument(
+        'port',
+        type=str,
+        help="Serial port, like /dev/ttyUSB0"
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help=f"Input gcode filename, or a {NUMBERED_SUFFIX} from numbered.py"
+        )
+    arguments.add_argument(
+        '--baud',
+        type=int,
+        help="(default: from --marlin-config)",
+        )
+    arguments.add_argument(
+        '--ping-pong',
+        action='store_true',
+        help="Wait for ok after every line, like flash.sh",
+        )
+    arguments.add_argument(
+        '--advanced-ok',
+        action='store_true',
+        help="The firmware has ADVANCED_OK, even if the config doesn't",
+        )
+    arguments.add_argument(
+        '--no-checksum',
+        action='store_true',
+        help="Don't send line numbers and checksums",
+        )
+    arguments.add_argument(
+        '--rx-buffer-size',
+        type=int,
+        help="(bytes) (default: from --marlin-config)",
+        )
+    arguments.add_argument(
+        '--bufsize',
+        type=int,
+        help="(commands) Free before the first ADVANCED_OK says"
+        " (default: from --marlin-config)",
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Buffer sizes and baud rate from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--log',
+        type=str,
+        metavar='print.log',
+        help="Save what was sent and received with timestamps, for calibrate.py",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    profile = load_profile(args.marlin_config)
+    options = dict(
+        rx_buffer_size=args.rx_buffer_size or profile.rx_buffer_size,
+        bufsize=args.bufsize or profile.bufsize,
+        advanced_ok=args.advanced_ok or profile.advanced_ok,
+        checksums=not args.no_checksum,
+        ping_pong=args.ping_pong,
+        )
+    numbered = os.path.exists(args.input + INDEX_SUFFIX)
+    if numbered:
+        protocol = NumberedProtocol(*open_numbered(args.input), **options)
+    else:
+        protocol = Protocol(**options)
+    log = None
+    if args.log is not None:
+        log = open(args.log, 'w')
+    fd = open_serial(args.port, args.baud or profile.baudrate)
+    try:
+        streamer = Streamer(fd, protocol, log=log)
+        if numbered:
+            elapsed = streamer.run(())
+        else:
+            with open(args.input, 'r') as fh:
+                elapsed = streamer.run(fh)
+    finally:
+        os.close(fd)
+        if log is not None:
+            log.close()
+    print(
+        f"Sent {protocol.lines} lines ({protocol.sent_bytes} bytes)"
+        f" in {elapsed:0.1f} s, {protocol.lines / elapsed:0.0f} lines/s,"
+        f" {protocol.resends} resends"
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+# telemetry.py -- Keep what the printer reports on its own
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./telemetry.py /dev/ttyUSB0 [--interval 1] [--seconds 60] [--json]
+       ./telemetry.py --fake --seconds 10
+AUTO_REPORT_TEMPERATURES and HOST_KEEPALIVE_FEATURE make Marlin say its
+temperatures and that it's busy without being asked, so nothing has to
+poll with M105 in between the moves. This keeps the last so many of each
+in ring buffers.
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import json
+import os
+import select
+import time
+
+import numpy
+
+from streamer import open_serial
+from marlin import CONFIG_DIR
+from marlin import load_profile
+import fake_printer
+
+INTERVAL = 1 # s, M155 S only takes whole seconds
+RING_SIZE = 1 << 14 # samples, 4.5 hours of temperatures at 1 Hz
+POINTS = 100 # for a dashboard's graph
+
+# What Marlin calls them in temperature reports, and what they're called
+# here and in thermal.py
+TEMP_KEYS = {
+    'T': 'head',
+    'B': 'bed',
+    '@': 'head_power',
+    'B@': 'bed_power',
+    }
+TEMP_COLUMNS = ('head', 'head_target', 'bed', 'bed_target', 'head_power', 'bed_power')
+POSITION_COLUMNS = ('x', 'y', 'z', 'e')
+TEMPS = 'temps'
+POSITION = 'position'
+BUSY = 'busy'
+
+# The last size rows of (time, columns...), oldest overwritten first
+class Ring:
+    def __init__(self, columns, size=RING_SIZE):
+        self.columns = tuple(columns)
+        self.size = size
+        self.data = numpy.full((size, len(columns) + 1), numpy.nan)
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, values):
+        row = self.data[self.next]
+        row[0] = t
+        row[1:] = values
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def rows(self):
+        # Oldest first. A copy only once it's wrapped around.
+        if self.count < self.size:
+            return self.data[:self.count]
+        return numpy.concatenate((self.data[self.next:], self.data[:self.next]))
+
+    def last(self):
+        if self.count == 0:
+            return None
+        row = self.data[self.next - 1]
+        return dict(zip(('time',) + self.columns, row.tolist()))
+
+    def query(self, start=None, end=None, points=None):
+        # Rows from start to end, or the mean of each of points equal
+        # slices of that time, which is all a graph needs. Slices with
+        # nothing in them are nan.
+        rows = self.rows()
+        times = rows[:, 0]
+        first = 0 if start is None else numpy.searchsorted(times, start)
+        last = len(rows) if end is None else numpy.searchsorted(times, end, 'right')
+        rows = rows[first:last]
+        if points is None or len(rows) <= points:
+            return rows
+        if start is None:
+            start = rows[0, 0]
+        if end is None:
+            end = rows[-1, 0]
+        edges = numpy.linspace(start, end, points + 1)
+        bounds = numpy.searchsorted(rows[:, 0], edges)
+        bounds[-1] = len(rows)
+        # Sums over each slice from running sums, skipping nans
+        zero = numpy.zeros((1, rows.shape[1]))
+        sums = numpy.concatenate((zero, numpy.cumsum(numpy.nan_to_num(rows), axis=0)))
+        valid = numpy.concatenate((zero, numpy.cumsum(~numpy.isnan(rows), axis=0)))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            means = (
+                (sums[bounds[1:]] - sums[bounds[:-1]])
+                / (valid[bounds[1:]] - valid[bounds[:-1]])
+                )
+        # Middle of each slice, not the mean of when the samples happened
+        means[:, 0] = (edges[:-1] + edges[1:]) / 2.0
+        return means
+
+def parse_temps(text):
+    # "ok T:200.00 /200.00 B:60.00 /60.00 @:40 B@:20" or the same without
+    # the ok, from M155 or while M109 waits. {'head': 200.0, 'head_target':
+    # 200.0, ..., 'head_power': 40.0}
+    temps = dict()
+    key = None
+    for word in text.split():
+        if word[0] == '/':
+            if key is not None:
+                try:
+                    temps[key + '_target'] = float(word[1:])
+                except ValueError:
+                    pass
+            key = None
+            continue
+        (marlin, sep, value) = word.partition(':')
+        key = TEMP_KEYS.get(marlin) if sep == ':' else None
+        if key is None:
+            continue
+        try:
+            temps[key] = float(value)
+        except ValueError:
+            key = None
+    return temps
+
+def parse_position(text):
+    # M114: "X:10.00 Y:20.00 Z:0.30 E:1.23 Count X:800 Y:1600 Z:120", the
+    # Count part is steps
+    position = dict()
+    for word in text.partition(' Count')[0].split():
+        (axis, sep, value) = word.partition(':')
+        if sep == ':' and axis in ('X', 'Y', 'Z', 'E'):
+            try:
+                position[axis.lower()] = float(value)
+            except ValueError:
+                pass
+    return position
+
+def parse_busy(text):
+    # "echo:busy: processing", "busy: paused for user"...
+    if text.startswith('echo:'):
+        text = text[5:]
+    if not text.startswith('busy:'):
+        return None
+    return text[5:].strip()
+
+def kind(text):
+    # Which of the reports this is, without parsing it yet
+    if text.startswith('ok'):
+        text = text[2:].lstrip()
+    if text.startswith('T:') or text.startswith('B:'):
+        return TEMPS
+    if text.startswith('X:'):
+        return POSITION
+    if text.startswith('busy:') or text.startswith('echo:busy:'):
+        return BUSY
+    return None
+
+class Telemetry:
+    def __init__(self, size=RING_SIZE):
+        self.temps = Ring(TEMP_COLUMNS, size)
+        self.positions = Ring(POSITION_COLUMNS, size)
+        self.busy = Ring(('reason',), size)
+        self.reasons = [] # busy's reason is an index into these
+
+    def feed(self, text, t=None):
+        # One line from the printer, returns which kind of report it was
+        # or None if it wasn't one
+        what = kind(text)
+        if what is None:
+            return None
+        if t is None:
+            t = time.time()
+        if what == TEMPS:
+            temps = parse_temps(text)
+            if len(temps) == 0:
+                return None
+            self.temps.append(
+                t,
+                [temps.get(column, numpy.nan) for column in TEMP_COLUMNS],
+                )
+        elif what == POSITION:
+            position = parse_position(text)
+            if len(position) == 0:
+                return None
+            self.positions.append(
+                t,
+                [position.get(column, numpy.nan) for column in POSITION_COLUMNS],
+                )
+        else:
+            reason = parse_busy(text)
+            if reason not in self.reasons:
+                self.reasons.append(reason)
+            self.busy.append(t, [self.reasons.index(reason)])
+        return what
+
+    def last_temps(self):
+        # {'head': (200.0, 200.0), 'bed': (60.0, 60.0)} like farm.py shows
+        last = self.temps.last()
+        if last is None:
+            return dict()
+        return {
+            name: (last[name], last[name + '_target'])
+            for name in ('head', 'bed')
+            if not numpy.isnan(last[name])
+            }
+
+    def summary(self, start=None, end=None, points=POINTS):
+        def table(ring):
+            rows = ring.query(start, end, points)
+            return {
+                column: [None if numpy.isnan(v) else v for v in rows[:, i].tolist()]
+                for i, column in enumerate(('time',) + ring.columns)
+                }
+        return {
+            TEMPS: table(self.temps),
+            POSITION: table(self.positions),
+            BUSY: {
+                'time': self.busy.rows()[:, 0].tolist(),
+                'reason': [
+                    self.reasons[int(i)] for i in self.busy.rows()[:, 1]
+                    ],
+                },
+            }
+
+def watch(fd, telemetry, seconds=None, interval=INTERVAL):
+    # Turn auto reporting on and keep what comes back until seconds are up
+    # or ^C
+    os.write(fd, f"M155 S{interval}\n".encode('ascii'))
+    start = time.monotonic()
+    partial = b''
+    try:
+        while seconds is None or time.monotonic() - start < seconds:
+            (readable, _, _) = select.select([fd], [], [], 0.5)
+            if len(readable) == 0:
+                continue
+            (*lines, partial) = (partial + os.read(fd, 4096)).split(b'\n')
+            now = time.time()
+            for line in lines:
+                text = line.decode('ascii', errors='replace').strip()
+                if telemetry.feed(text, now) is None and len(text) > 0:
+                    DEBUG(f"< {text}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.write(fd, b"M155 S0\n")
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Record the temperatures the printer reports by itself'
+        )
+    arguments.add_argument(
+        'port',
+        type=str,
+        nargs='?',
+        help="Serial port, like /dev/ttyUSB0",
+        )
+    arguments.add_argument(
+        '--fake',
+        action='store_true',
+        help="Watch fake_printer.py instead of a real printer",
+        )
+    arguments.add_argument(
+        '--baud',
+        type=int,
+        help="(default: from the config)",
+        default=None,
+        )
+    arguments.add_argument(
+        '--marlin-config',
+        type=str,
+        metavar='DIR',
+        help="Baud rate from DIR/Configuration.h (default: %(default)s)",
+        default=CONFIG_DIR,
+        )
+    arguments.add_argument(
+        '--interval',
+        type=int,
+        help="Seconds between reports (default: %(default)s)",
+        default=INTERVAL,
+        )
+    arguments.add_argument(
+        '--seconds',
+        type=float,
+        help="How long to watch (default: until ^C)",
+        )
+    arguments.add_argument(
+        '--points',
+        type=int,
+        help="Points in the summary (default: %(default)s)",
+        default=POINTS,
+        )
+    arguments.add_argument(
+        '--json',
+        action='store_true',
+        help="Print the summary as JSON",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.port is None and not args.fake:
+        arguments.error("Need a port or --fake")
+    profile = load_profile(args.marlin_config)
+    baud = args.baud or profile.baudrate
+    stop = None
+    if args.fake:
+        (port, stop) = fake_printer.start()
+    else:
+        port = args.port
+    telemetry = Telemetry()
+    fd = open_serial(port, baud)
+    try:
+        watch(fd, telemetry, args.seconds, args.interval)
+    finally:
+        os.close(fd)
+        if stop is not None:
+            stop.set()
+    summary = telemetry.summary(points=args.points)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+        return
+    INFO(f"{len(telemetry.temps)} temperature reports")
+    rows = telemetry.temps.query(points=args.points)
+    for row in rows:
+        if numpy.isnan(row[1]):
+            continue
+        print(
+            time.strftime('%H:%M:%S', time.localtime(row[0])),
+            ' '.join(
+                f"{column} {value:0.1f}"
+                for column, value in zip(TEMP_COLUMNS, row[1:])
+                if not numpy.isnan(value)
+                ),
+            )
+
+if __name__ == '__main__':
+    main()
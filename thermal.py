@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# thermal.py -- Model how fast the heaters heat up and cool down
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import sys
+import json
+import argparse
+from math import log
+from math import exp
+from datetime import datetime
+
+import numpy
+
+from commands import SetTemp
+
+AMBIENT = 20.0 # °C
+# From marlin_config/Configuration.h
+TEMP_WINDOW = 1.0 # °C
+TEMP_RESIDENCY_TIME = 1.0 # s
+# Marlin reports heater power (M105 @: and B@:) out of this
+POWER_REPORT_MAX = 127.0
+
+# A lump of metal with a heater in it, losing heat in proportion to how much
+# hotter it is than the room: capacity * dT/dt = power - loss * (T - ambient)
+# So it approaches ambient + power/loss exponentially with tau = capacity/loss
+class Heater:
+    def __init__(self, power, capacity, loss, ambient=AMBIENT):
+        self.power = power # W
+        self.capacity = capacity # J/°C
+        self.loss = loss # W/°C
+        self.ambient = ambient # °C
+
+    @property
+    def tau(self):
+        return self.capacity / self.loss # s
+
+    @property
+    def max_temp(self):
+        return self.ambient + self.power / self.loss # °C at full power
+
+    def ramp_time(self, start, target):
+        if start is None:
+            start = self.ambient
+        if target > start:
+            if target >= self.max_temp:
+                return float('inf')
+            return self.tau * log(
+                (self.max_temp - start) / (self.max_temp - target)
+                )
+        elif target < start:
+            if target <= self.ambient:
+                return float('inf')
+            return self.tau * log(
+                (start - self.ambient) / (target - self.ambient)
+                )
+        return 0.0
+
+    def advance(self, temp, setpoint, dt):
+        # Full power until the setpoint, then PID holds it
+        if temp is None:
+            temp = self.ambient
+        if setpoint is None:
+            setpoint = 0.0
+        if temp < setpoint:
+            if self.ramp_time(temp, setpoint) <= dt:
+                return setpoint
+            return self.max_temp + (temp - self.max_temp) * exp(-dt / self.tau)
+        floor = max(setpoint, self.ambient)
+        if temp > floor:
+            cooled = self.ambient + (temp - self.ambient) * exp(-dt / self.tau)
+            return max(cooled, floor)
+        return temp
+
+    def wait_time(self, temp, target, cooling=False):
+        # M109 S/M190 S only wait for heating, R waits for cooling too
+        if temp is None:
+            temp = self.ambient
+        if target > temp + TEMP_WINDOW:
+            ramp = self.ramp_time(temp, target - TEMP_WINDOW)
+        elif cooling and target < temp - TEMP_WINDOW:
+            ramp = self.ramp_time(temp, target + TEMP_WINDOW)
+        else:
+            return 0.0
+        return ramp + TEMP_RESIDENCY_TIME
+
+    @classmethod
+    def fit(cls, times, temps, duty, power, ambient=AMBIENT):
+        # capacity * dT/dt = power * duty - loss * (T - ambient)
+        # is linear in power/capacity and loss/capacity
+        times = numpy.asarray(times, dtype=float)
+        temps = numpy.asarray(temps, dtype=float)
+        duty = numpy.asarray(duty, dtype=float)
+        dt = numpy.diff(times)
+        ok = dt > 0
+        slope = numpy.diff(temps)[ok] / dt[ok]
+        a = numpy.stack((
+            ((duty[:-1] + duty[1:]) / 2.0)[ok],
+            -((temps[:-1] + temps[1:]) / 2.0 - ambient)[ok],
+            ), axis=1)
+        (heating, losing), *_ = numpy.linalg.lstsq(a, slope, rcond=None)
+        if heating <= 0.0 or losing <= 0.0:
+            raise ValueError(f"Can't fit heater to {len(times)} reports")
+        capacity = float(power / heating)
+        return cls(power, capacity, float(losing * capacity), ambient)
+
+# 40 W cartridge takes about 90 s to get to 200 °C
+HOTEND = Heater(power=40.0, capacity=15.0, loss=0.1)
+# 220 W bed takes about 2 minutes to get to 60 °C
+BED = Heater(power=220.0, capacity=565.0, loss=1.5)
+HEATERS = {'head': HOTEND, 'bed': BED}
+
+def load_heaters(file_name):
+    with open(file_name, 'r') as fh:
+        return {
+            name: Heater(**params) for name, params in json.load(fh).items()
+            }
+
+def save_heaters(heaters, file_name):
+    with open(file_name, 'w') as fh:
+        json.dump(
+            {name: heater.__dict__ for name, heater in heaters.items()},
+            fh,
+            indent=4,
+            )
+
+# Temperatures along the script's timeline, including the time spent
+# waiting for M109/M190 that the analysis counts as instantaneous
+class ThermalSimulation:
+    def __init__(self, commands, heaters=HEATERS):
+        self.heaters = heaters
+        n = len(commands)
+        self.wait = numpy.zeros(n) # s
+        self.start = numpy.zeros(n) # s
+        self.temps = {name: numpy.zeros(n) for name in heaters} # °C after
+        temps = {name: heater.ambient for name, heater in heaters.items()}
+        clock = 0.0
+        for ci, command in enumerate(commands):
+            self.start[ci] = clock
+            dt = command.after.time - command.before.time
+            if (
+                isinstance(command, SetTemp)
+                and command.waits
+                and command.heater in heaters
+                ):
+                wait = heaters[command.heater].wait_time(
+                    temps[command.heater],
+                    command.target,
+                    cooling=not hasattr(command, 'S'),
+                    )
+                if wait == float('inf'):
+                    WARNING(f"{command.heater} can't reach {command.target}")
+                    wait = 0.0
+                self.wait[ci] = wait
+                dt += wait
+            for name, heater in heaters.items():
+                temps[name] = heater.advance(
+                    temps[name],
+                    getattr(command.after, f"{name}_temp"),
+                    dt,
+                    )
+                self.temps[name][ci] = temps[name]
+            clock += dt
+        self.duration = clock
+        INFO(f"Waiting for heaters: {self.wait.sum():0.1f} s")
+
+def parse_report(line):
+    # "2020-10-10 12:00:00,123 - Recv: ok T:200.00 /200.00 B:60.00 /60.00 @:64 B@:0"
+    # or "1602345600.123 < T:200.00 /200.00 ..."
+    if ' - Recv: ' in line:
+        (stamp, line) = line.split(' - Recv: ', 1)
+        try:
+            when = datetime.strptime(stamp.strip(), '%Y-%m-%d %H:%M:%S,%f')
+        except ValueError:
+            return None
+        when = when.timestamp()
+    else:
+        words = line.split(None, 1)
+        if len(words) < 2:
+            return None
+        try:
+            when = float(words[0])
+        except ValueError:
+            return None
+        line = words[1]
+    report = dict()
+    words = line.split()
+    for wi, word in enumerate(words):
+        if ':' not in word:
+            continue
+        (key, value) = word.split(':', 1)
+        if key not in ('T', 'B', '@', 'B@'):
+            continue
+        try:
+            report[key] = float(value)
+        except ValueError:
+            continue
+        if (
+            key in ('T', 'B')
+            and wi + 1 < len(words)
+            and words[wi + 1].startswith('/')
+            ):
+            report[key + '/'] = float(words[wi + 1][1:])
+    if 'T' not in report:
+        return None
+    return (when, report)
+
+def fit_heaters(lines, heaters=HEATERS):
+    reports = [r for r in map(parse_report, lines) if r is not None]
+    INFO(f"Fitting heaters to {len(reports)} temperature reports")
+    fitted = dict(heaters)
+    for name, temp_key, power_key in (('head', 'T', '@'), ('bed', 'B', 'B@')):
+        samples = [
+            (when, r[temp_key], r[power_key] / POWER_REPORT_MAX)
+            for when, r in reports
+            if temp_key in r and power_key in r
+            ]
+        if len(samples) < 3:
+            WARNING(f"Not enough {name} reports to fit")
+            continue
+        (times, temps, duty) = zip(*samples)
+        heater = heaters[name]
+        try:
+            fitted[name] = Heater.fit(
+                times,
+                temps,
+                duty,
+                heater.power,
+                heater.ambient,
+                )
+        except ValueError as e:
+            WARNING(f"{name}: {e}")
+            continue
+        INFO(f"{name}: {fitted[name].__dict__} tau={fitted[name].tau:0.1f} s")
+    return fitted
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Estimate print time including waiting for heaters'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        nargs='?',
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '--heaters',
+        type=str,
+        metavar='heaters.json',
+        help="Heater constants (default: built in)",
+        )
+    arguments.add_argument(
+        '--fit',
+        type=str,
+        metavar='serial.log',
+        help="Fit heater constants to logged M105 reports",
+        )
+    arguments.add_argument(
+        '--save',
+        type=str,
+        metavar='heaters.json',
+        help="Save (fitted) heater constants",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    heaters = HEATERS
+    if args.heaters is not None:
+        heaters = load_heaters(args.heaters)
+    if args.fit is not None:
+        with open(args.fit, 'r') as fh:
+            heaters = fit_heaters(fh, heaters)
+    if args.save is not None:
+        save_heaters(heaters, args.save)
+    if args.input is not None:
+        from script import Script
+        script = Script.from_file(args.input)
+        script.analyze()
+        simulation = ThermalSimulation(script.commands, heaters)
+        for ci in numpy.flatnonzero(simulation.wait):
+            command = script.commands[ci]
+            print(f"{command.oln}: {command.g_code}: {simulation.wait[ci]:0.1f} s")
+        print(f"Moving: {script.state.time:0.1f} s")
+        print(f"Total: {simulation.duration:0.1f} s")
+
+if __name__ == '__main__':
+    main()
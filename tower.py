@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# tower.py -- Change a setting every floor of a calibration tower
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./tower.py <input.gcode> <setting> <start> <end> <floors>
+Usage: ./tower.py Temp_Tower.gcode temp 180 230 8
+Usage: ./tower.py Temp_Tower.gcode temp 180 230 8 --variant 200 240 5
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+import multiprocessing
+import os
+from math import isnan
+
+from command import parse
+from commands import SetHeadTemp
+from commands import LinearAdvanceFactor
+from commands import SetFan
+from commands import SetFeedrateMult
+from commands import SetFlowMult
+from columns import scan
+from mutator import Mutator
+from script import Script
+
+class Sweep:
+    overrides = ()
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def value(self, floor, floors):
+        if floors < 2:
+            return self.start
+        return self.start + (self.end - self.start) * floor / (floors - 1)
+
+    def describe(self, value):
+        return f"{self.name} {value:g}"
+
+    def overrides_command(self, command):
+        return isinstance(command, self.overrides)
+
+class TemperatureSweep(Sweep):
+    name = 'temp'
+    overrides = (SetHeadTemp,) # and M104
+
+    def value(self, floor, floors):
+        return int(super().value(floor, floors))
+
+    def overrides_command(self, command):
+        # but still turn the heater off at the end
+        return super().overrides_command(command) and command.target != 0.0
+
+    def commands(self, value):
+        return [f"M104 S{value}"]
+
+class LinearAdvanceSweep(Sweep):
+    name = 'k'
+    overrides = (LinearAdvanceFactor,)
+
+    def commands(self, value):
+        return [
+            "M400 ; wait for gcode buffer to finish moves",
+            f"M900 K{value:0.5}",
+            ]
+
+class FanSweep(Sweep):
+    name = 'fan'
+    overrides = (SetFan,)
+
+    def value(self, floor, floors):
+        return int(super().value(floor, floors))
+
+    def commands(self, value):
+        return [f"M106 S{value}"]
+
+class FeedrateSweep(Sweep):
+    name = 'speed'
+    overrides = (SetFeedrateMult,)
+
+    def value(self, floor, floors):
+        return int(super().value(floor, floors))
+
+    def commands(self, value):
+        return [f"M220 S{value}"]
+
+class FlowSweep(Sweep):
+    name = 'flow'
+    overrides = (SetFlowMult,)
+
+    def value(self, floor, floors):
+        return int(super().value(floor, floors))
+
+    def commands(self, value):
+        return [f"M221 S{value}"]
+
+SWEEPS = {
+    s.name: s for s in (
+        TemperatureSweep,
+        LinearAdvanceSweep,
+        FanSweep,
+        FeedrateSweep,
+        FlowSweep,
+        )
+    }
+
+def measure(lines, file_name=None):
+    # First pass, straight from the gcode without keeping anything:
+    # (first layer, top, [(ci, z)] for each extrusion higher than any
+    # before it)
+    first = None
+    top = None
+    rises = []
+    before = [float('nan')] * 4
+    for (ln, is_move, row) in scan(lines):
+        after = row[0:4]
+        if (
+            is_move
+            and after[3] - before[3] > 0.0
+            and not isnan(after[2])
+            and after[0:3] != before[0:3]
+            ):
+            z = after[2]
+            if first is None:
+                first = z
+            if top is None or z > top:
+                top = z
+                rises.append((ln - 1, z))
+        before = after
+    if first is None:
+        raise ValueError(f"Nothing printed in {file_name}")
+    INFO(f"Height: {top}")
+    return (first, top, rises)
+
+def floor_changes(first, top, rises, floors):
+    # {ci: (floor, z)} where each floor starts
+    floor_size = top / floors
+    INFO(f"Floor height: {floor_size}")
+    changes = dict()
+    floor = None
+    for (ci, z) in rises:
+        if z <= first:
+            continue
+        if min(int(z / floor_size), floors - 1) != floor:
+            floor = min(int(z / floor_size), floors - 1)
+            changes[ci] = (floor, z)
+    return changes
+
+class CalibrationTower(Mutator):
+    # Where the floors start comes from measure(), so this only has to
+    # look at each command by itself
+    needs_state = False
+
+    def __init__(self, sweep, floors, changes):
+        self.sweep = sweep
+        self.floors = floors
+        self.changes = changes
+        self.floor = None
+        super().__init__()
+
+    def finish(self):
+        if self.floor != self.floors - 1:
+            WARNING(f"Only got to floor {self.floor} of {self.floors}")
+
+    def insert(self, ci, old, g_code):
+        self.replace(ci, old, [parse(f"{g_code} ; added by tower.py")])
+
+    def change(self, ci, old, z):
+        value = self.sweep.value(self.floor, self.floors)
+        INFO(
+            f"Step {self.floor} at height {z}"
+            f" {self.sweep.describe(value)}"
+            )
+        self.replace(ci, old, [
+            parse(f"; tower.py: step {self.floor}"),
+            parse(f"; tower.py: {self.sweep.describe(value)}"),
+            ])
+        for g_code in self.sweep.commands(value):
+            self.insert(ci, old, g_code)
+        self.insert(
+            ci,
+            old,
+            f"M117 Tower Floor {self.floor+1}/{self.floors}"
+            f" {self.sweep.describe(value)}"
+            )
+
+    def process_command(self, ci, old):
+        if ci in self.changes:
+            (self.floor, z) = self.changes[ci]
+            self.change(ci, old, z)
+        if (
+            self.floor is not None
+            and self.sweep.overrides_command(old)
+            ):
+            return self.replace(ci, old, [
+                parse(f"; overriden by tower.py: {old.g_code}")
+                ])
+        return self.keep(ci, old)
+
+def render(file_name, changes, sweep, floors, output):
+    tower = CalibrationTower(sweep, floors, changes)
+    with open(file_name, 'r') as fh:
+        Script.write(tower.stream(Script.read(fh)), output)
+    return output
+
+def _render(job):
+    return render(*job)
+
+def tee(commands, fh):
+    # Save commands while measure() goes through them
+    for command in commands:
+        print(command.g_code, file=fh)
+        yield command.g_code
+
+def batch(file_name, jobs, processes=None, prepare=None):
+    # jobs: [(sweep, floors, output.gcode), ...]
+    # Two passes over the file for each, so it never has to be in memory.
+    # prepare(commands) yields the commands with other streaming mutators
+    # applied first, that's saved once and the towers are made from that.
+    source = file_name
+    if prepare is not None:
+        source = f"{file_name}.{os.getpid()}.tmp"
+    try:
+        with open(file_name, 'r') as fh:
+            if prepare is None:
+                (first, top, rises) = measure(fh, file_name)
+            else:
+                with open(source, 'w') as out:
+                    lines = tee(prepare(Script.read(fh)), out)
+                    (first, top, rises) = measure(lines, file_name)
+        work = [
+            (source, floor_changes(first, top, rises, floors), sweep, floors, output)
+            for (sweep, floors, output) in jobs
+            ]
+        if len(work) == 1 or processes == 1:
+            return [render(*job) for job in work]
+        # fork, so the workers get MachineState.profile too
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes) as pool:
+            return pool.map(_render, work, chunksize=1)
+    finally:
+        if source != file_name and os.path.exists(source):
+            os.remove(source)
+
+def variant_output(input_file, setting, start, end, floors):
+    return f".{setting}_tower_{start:g}-{end:g}x{floors}.".join(
+        input_file.rsplit('.', 1)
+        )
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Change a setting every floor of a calibration tower'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        'setting',
+        choices=sorted(SWEEPS),
+        help="temp (M104), k (M900), fan (M106), speed (M220), flow (M221)"
+        )
+    arguments.add_argument('start', type=float)
+    arguments.add_argument('end', type=float)
+    arguments.add_argument('floors', type=int)
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input.setting_tower.gcode)",
+        )
+    arguments.add_argument(
+        '--variant',
+        nargs=3,
+        action='append',
+        default=[],
+        metavar=('START', 'END', 'FLOORS'),
+        help="Also write a tower with these values (can be repeated), "
+        "output to input.setting_tower_START-ENDxFLOORS.gcode",
+        )
+    arguments.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help="Worker processes for --variant (default: one per CPU)",
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.output is None:
+        if len(args.variant) > 0:
+            args.output = variant_output(
+                args.input, args.setting, args.start, args.end, args.floors
+                )
+        else:
+            args.output = f".{args.setting}_tower.".join(
+                args.input.rsplit('.', 1)
+                )
+    sweep = SWEEPS[args.setting]
+    jobs = [(sweep(args.start, args.end), args.floors, args.output)]
+    for (start, end, floors) in args.variant:
+        (start, end, floors) = (float(start), float(end), int(floors))
+        jobs.append((
+            sweep(start, end),
+            floors,
+            variant_output(args.input, args.setting, start, end, floors),
+            ))
+    batch(args.input, jobs, args.jobs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# travel_order.py -- Print the islands in each layer in a shorter order
+# Copyright (C) 2020 Hazel Victoria Campbell
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Usage: ./travel_order.py <input.gcode> [-o output.gcode]
+"""
+
+import sys
+import logging
+logger = logging.getLogger(__name__)
+DEBUG = logger.debug
+INFO = logger.info
+WARNING = logger.warning
+ERROR = logger.error
+CRITICAL = logger.critical
+
+import argparse
+
+import numpy
+
+from command import NoOp
+from command import parse
+from command import unparse
+from commands import Move
+from mutator import Mutator
+from script import Script
+from columns import Columns
+from columns import X, Y, Z, E
+
+TWO_OPT_PASSES = 4
+# Don't bother for less than this (mm)
+MIN_SAVING = 1.0
+
+def distance(a, b):
+    return numpy.hypot(a[..., X] - b[..., X], a[..., Y] - b[..., Y])
+
+def nearest_neighbour(entry, starts, ends):
+    n = len(starts)
+    left = numpy.ones(n, dtype=bool)
+    order = numpy.zeros(n, dtype=int)
+    here = entry
+    for k in range(n):
+        d = distance(starts, here)
+        d[~left] = numpy.inf
+        order[k] = numpy.argmin(d)
+        left[order[k]] = False
+        here = ends[order[k]]
+    return order
+
+def path_length(entry, starts, ends, order):
+    s = starts[order]
+    e = ends[order]
+    return distance(entry, s[0]) + distance(e[:-1], s[1:]).sum()
+
+# Reversing a run of islands changes which way we travel between each of
+# them, so keep running sums of both directions to check every possible
+# end of the run for each start at once
+def two_opt(entry, starts, ends, order, passes=TWO_OPT_PASSES):
+    order = numpy.array(order)
+    n = len(order)
+    for _ in range(passes):
+        improved = False
+        changed = True
+        for i in range(n - 1):
+            if changed:
+                s = starts[order]
+                e = ends[order]
+                ahead = numpy.concatenate(
+                    ([0.0], numpy.cumsum(distance(e[:-1], s[1:])))
+                    )
+                behind = numpy.concatenate(
+                    ([0.0], numpy.cumsum(distance(e[1:], s[:-1])))
+                    )
+                changed = False
+            if i == 0:
+                prev = entry
+            else:
+                prev = e[i-1]
+            j = numpy.arange(i + 1, n)
+            last = j == n - 1
+            after = s[numpy.minimum(j + 1, n - 1)]
+            old = (
+                distance(prev, s[i])
+                + ahead[j] - ahead[i]
+                + numpy.where(last, 0.0, distance(e[j], after))
+                )
+            new = (
+                distance(prev, s[j])
+                + behind[j] - behind[i]
+                + numpy.where(last, 0.0, distance(e[i], after))
+                )
+            gain = old - new
+            best = numpy.argmax(gain)
+            if gain[best] > 1e-6:
+                order[i:j[best]+1] = order[i:j[best]+1][::-1]
+                improved = True
+                changed = True
+        if not improved:
+            break
+    return order
+
+# Islands of printing moves at the same Z with only travel moves (and
+# retracts, z hops, comments...) between them. The travel moves before the
+# k-th island stay the k-th, only the islands move, so the layer change,
+# retracts and z hops all still happen in the same places.
+class Islands:
+    def __init__(self, start, z):
+        self.start = start
+        self.z = z
+        self.leads = [] # (start, end) of the travel moves before each island
+        self.islands = [] # (start, end)
+        self.order = None
+
+    @property
+    def end(self):
+        return self.islands[-1][1]
+
+class TravelOrder(Mutator):
+    def __init__(self, script, passes=TWO_OPT_PASSES):
+        self.passes = passes
+        super().__init__(script)
+
+    def find(self, columns):
+        printing = columns.printing
+        noop = numpy.array([isinstance(c, NoOp) for c in self.original])
+        relative = numpy.array([
+            c.before.x.relative or c.before.y.relative for c in self.original
+            ])
+        groups = []
+        group = None
+        island = None
+        last_print = None
+        lead = None
+        def close():
+            nonlocal group, island
+            if island is not None:
+                group.islands.append((island, last_print + 1))
+                island = None
+            if group is not None and len(group.islands) > 1:
+                groups.append(group)
+            group = None
+        for ci in range(len(self.original)):
+            if noop[ci]:
+                continue
+            if relative[ci] or not (printing[ci] or columns.is_move[ci]):
+                close()
+                lead = None
+            elif printing[ci]:
+                z = columns.after[ci, Z]
+                if group is not None and z != group.z:
+                    close()
+                if island is None:
+                    if lead is None:
+                        lead = ci
+                    if group is None:
+                        group = Islands(lead, z)
+                    group.leads.append((lead, ci))
+                    island = ci
+                    lead = None
+                last_print = ci
+            else:
+                if island is not None:
+                    group.islands.append((island, last_print + 1))
+                    island = None
+                    lead = last_print + 1
+                elif lead is None:
+                    lead = ci
+        close()
+        return groups
+
+    def plan(self):
+        columns = Columns(self.original)
+        groups = self.find(columns)
+        self.groups = dict()
+        self.saved = 0.0 # mm
+        self.saved_time = 0.0 # s
+        travel = columns.is_move & ~numpy.isnan(columns.feedrate)
+        xy = columns.is_move & (columns.dist_xy > 0.0)
+        self.combed = 0
+        for group in groups:
+            # Combing or avoiding perimeters takes several XY moves to get
+            # around what's printed. That path only fits the islands it
+            # was between, and a straight line to the new one would cross
+            # whatever it went around, so leave those layers alone.
+            if any(xy[start:end].sum() > 1 for (start, end) in group.leads):
+                self.combed += 1
+                continue
+            islands = numpy.array(group.islands)
+            starts = columns.before[islands[:, 0], :Z]
+            ends = columns.after[islands[:, 1] - 1, :Z]
+            entry = columns.before[group.start, :Z]
+            if numpy.isnan(starts).any() or numpy.isnan(ends).any():
+                continue
+            if numpy.isnan(entry).any():
+                entry = starts[0]
+            original = numpy.arange(len(starts))
+            before = path_length(entry, starts, ends, original)
+            order = nearest_neighbour(entry, starts, ends)
+            if path_length(entry, starts, ends, order) > before:
+                order = original
+            order = two_opt(entry, starts, ends, order, self.passes)
+            after = path_length(entry, starts, ends, order)
+            if before - after < MIN_SAVING:
+                continue
+            group.order = order
+            group.targets = starts
+            # The fastest travel in the group for the travel moves we add
+            leads = numpy.concatenate(
+                [numpy.arange(*lead) for lead in group.leads]
+                ).astype(int)
+            speeds = columns.feedrate[leads][travel[leads]]
+            if len(speeds) > 0:
+                group.travel_speed = numpy.max(speeds)
+                self.saved_time += (before - after) / group.travel_speed
+            else:
+                group.travel_speed = None
+            self.saved += before - after
+            self.groups[group.start] = group
+        INFO(f"Reordered islands in {len(self.groups)} of {len(groups)} layers")
+        if self.combed > 0:
+            INFO(f"Left {self.combed} layers alone, their travel goes around things")
+        INFO(
+            f"Travel saved: {self.saved:0.1f} mm"
+            f" (about {self.saved_time:0.1f} s)"
+            )
+
+    def process(self):
+        self.plan()
+        self.skip_until = 0
+        super().process()
+
+    def moved(self, ci, old, xy=None):
+        # Same Z and change in E as before, but from wherever we are now
+        position = [None, None, old.after.z.position, None]
+        if xy is not None:
+            (position[X], position[Y]) = xy
+        de = old.head_dist_e
+        if de is None or self.state.e.position is None:
+            position[E] = old.after.e.position
+        elif de != 0.0:
+            position[E] = self.state.e.position + de
+        feedrate = old.before.feedrate # Move puts its F in before
+        if feedrate == self.state.feedrate:
+            feedrate = None
+        new = Move.to(self.state, position, feedrate, old.comment)
+        if len(new.aargs) > 0:
+            self.replace(ci, old, [new])
+
+    def travel(self, ci, old, xy, feedrate):
+        if feedrate == self.state.feedrate:
+            feedrate = None
+        self.replace(ci, old, [Move.to(
+            self.state,
+            [xy[X], xy[Y], None, None],
+            feedrate,
+            " travel added by travel_order.py",
+            )])
+
+    def lead(self, group, start, end, target, ci, old):
+        # Go to target at the XY move, or right after retracting if there
+        # isn't one
+        moves = [
+            cj for cj in range(start, end)
+            if isinstance(self.original[cj], Move)
+            ]
+        xy_moves = [cj for cj in moves if self.original[cj].head_dist_xy]
+        retracts = [
+            cj for cj in moves
+            if (self.original[cj].head_dist_e or 0.0) < 0.0
+            ]
+        if len(xy_moves) > 0:
+            travel_at = xy_moves[-1]
+        elif len(retracts) > 0:
+            travel_at = retracts[-1]
+        else:
+            travel_at = None
+            self.travel(ci, old, target, group.travel_speed)
+        for cj in range(start, end):
+            command = self.original[cj]
+            if not isinstance(command, Move):
+                self.keep(cj, command)
+            elif cj == travel_at and len(xy_moves) > 0:
+                self.moved(cj, command, target)
+            else:
+                self.moved(cj, command)
+                if cj == travel_at:
+                    self.travel(cj, command, target, group.travel_speed)
+
+    def reorder(self, group):
+        for k, ii in enumerate(group.order):
+            (start, end) = group.islands[ii]
+            (lead_start, lead_end) = group.leads[k]
+            self.lead(
+                group,
+                lead_start,
+                lead_end,
+                group.targets[ii],
+                start,
+                self.original[start],
+                )
+            for cj in range(start, end):
+                command = self.original[cj]
+                if isinstance(command, Move):
+                    self.moved(cj, command, command.after.position[:Z])
+                else:
+                    self.keep(cj, command)
+        # Whatever comes next might be relying on the last F
+        last = self.original[group.end - 1]
+        feedrate = last.after.feedrate
+        if feedrate is not None and feedrate != self.state.feedrate:
+            self.replace(group.end - 1, last, [parse(unparse(
+                {'G': 1.0, 'F': feedrate * 60.0},
+                " restored by travel_order.py",
+                ))])
+
+    def process_command(self, ci, old):
+        if ci in self.groups:
+            group = self.groups[ci]
+            self.reorder(group)
+            self.skip_until = group.end
+        if ci < self.skip_until:
+            return
+        return self.keep(ci, old)
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description='Print the islands in each layer in a shorter order'
+        )
+    arguments.add_argument(
+        'input',
+        metavar='input.gcode',
+        type=str,
+        help="Input gcode filename"
+        )
+    arguments.add_argument(
+        '-o', '--output',
+        metavar='output.gcode',
+        type=str,
+        help="Output gcode filename (default: input_to.gcode)",
+        )
+    arguments.add_argument(
+        '--passes',
+        type=int,
+        help="2-opt passes over each layer (default: %(default)s)",
+        default=TWO_OPT_PASSES,
+        )
+    args = arguments.parse_args()
+    logging.basicConfig(stream=sys.stderr,level=logging.INFO)
+    if args.output is None:
+        args.output = '_to.'.join(args.input.rsplit('.', 1))
+    script = Script.from_file(args.input)
+    reordered = TravelOrder(script, args.passes)
+    reordered.to_file(args.output)
+    print(
+        f"Travel saved: {reordered.saved:0.1f} mm"
+        f" (about {reordered.saved_time:0.1f} s)"
+        )
+
+if __name__ == '__main__':
+    main()